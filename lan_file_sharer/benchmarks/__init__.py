@@ -0,0 +1,4 @@
+# benchmarks/
+# Stand-alone performance checks. Run from lan_file_sharer/, e.g.
+#   python -m benchmarks.discovery_bench   (simulated, thousands of peers)
+#   python -m benchmarks.loopback_bench    (real nodes on 127.0.0.1, JSON results)
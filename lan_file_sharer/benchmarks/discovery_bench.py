@@ -0,0 +1,129 @@
+# benchmarks/discovery_bench.py
+# Discovery at LAN scale: how long until every node knows every other node,
+# how many beacons the LAN carries, and what receiving them costs in CPU.
+#
+#   python -m benchmarks.discovery_bench --peers 1000 --loss 0.01
+#
+# Convergence is simulated on a virtual clock using the real interval and
+# jitter policy from p2p_app.discovery (no sockets, so it runs in seconds).
+# CPU cost is measured for real by pushing encoded beacons from every
+# simulated peer through discovery.handle_beacon.
+import argparse
+import heapq
+import json
+import random
+import time
+from p2p_app import comms
+from p2p_app import config
+from p2p_app import discovery
+
+
+def simulate_convergence(peer_count, loss, startup_spread, rng):
+    """Virtual-time run of `peer_count` nodes. Returns (convergence_seconds, beacons_sent)."""
+    everyone = (1 << peer_count) - 1
+    heard = [1 << node for node in range(peer_count)]  # bitset of peers each node knows (incl. itself)
+    known_counts = [0] * peer_count
+    complete = 0
+    beacons = 0
+    # (time, node): nodes boot at random within startup_spread and beacon right away
+    schedule = [(rng.uniform(0, startup_spread), node) for node in range(peer_count)]
+    heapq.heapify(schedule)
+    started = [False] * peer_count  # a node hears nothing before it boots
+
+    while schedule:
+        now, sender = heapq.heappop(schedule)
+        started[sender] = True
+        beacons += 1
+        bit = 1 << sender
+        for receiver in range(peer_count):
+            if receiver == sender or not started[receiver] or heard[receiver] & bit:
+                continue
+            if rng.random() < loss:
+                continue
+            heard[receiver] |= bit
+            known_counts[receiver] += 1
+            if heard[receiver] == everyone:
+                complete += 1
+        if complete == peer_count:
+            return now, beacons
+        interval = discovery.beacon_interval(known_counts[sender])
+        next_time = now + interval * rng.uniform(1 - config.BEACON_JITTER, 1 + config.BEACON_JITTER)
+        heapq.heappush(schedule, (next_time, sender))
+    return float("inf"), beacons
+
+
+def encoded_beacons(peer_count, as_json=False):
+    beacons = []
+    for node in range(peer_count):
+        ip = f"10.{node // 65536 % 256}.{node // 256 % 256}.{node % 256}"
+        if as_json:
+            data = json.dumps({
+                "username": f"user{node}", "port": 19001, "type": "discovery",
+                "ip": ip, "data_port": 19101, "catalog_version": 1000 + node,
+            }).encode("utf-8")
+        else:
+            data = comms.encode_beacon(f"user{node}", 19001, ip=ip, data_port=19101,
+                                       catalog_version=1000 + node,
+                                       interval=discovery.beacon_interval(peer_count))
+        beacons.append((data, (ip, 19000)))
+    return beacons
+
+
+def measure_receive_cost(peer_count, rounds, as_json=False):
+    """CPU seconds per received beacon once every peer is known (steady state)."""
+    beacons = encoded_beacons(peer_count, as_json)
+    for data, addr in beacons:  # "Discovered new peer" is logged at INFO, which isn't shown here
+        discovery.handle_beacon(data, addr)
+    started = time.process_time()
+    for _ in range(rounds):
+        for data, addr in beacons:
+            discovery.handle_beacon(data, addr)
+    per_beacon = (time.process_time() - started) / (rounds * peer_count)
+    assert len(discovery.discovered_peers) == peer_count
+    started = time.process_time()
+    expired = discovery.discovered_peers.expire(now=time.time() + 10 * config.MAX_BROADCAST_INTERVAL * config.BEACON_MISSES_BEFORE_TIMEOUT)
+    sweep_seconds = time.process_time() - started
+    assert len(expired) == peer_count
+    return per_beacon, sweep_seconds, len(beacons[0][0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--peers", type=int, default=1000)
+    parser.add_argument("--loss", type=float, default=0.01, help="fraction of beacons each receiver misses")
+    parser.add_argument("--startup-spread", type=float, default=10.0, help="seconds over which nodes boot")
+    parser.add_argument("--rounds", type=int, default=20, help="beacon rounds for the CPU measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    converged_at, beacons_sent = simulate_convergence(args.peers, args.loss, args.startup_spread, rng)
+    steady_interval = discovery.beacon_interval(args.peers - 1)
+    lan_rate = args.peers / steady_interval
+    per_beacon, sweep_seconds, beacon_bytes = measure_receive_cost(args.peers, args.rounds)
+    json_per_beacon, _, json_bytes = measure_receive_cost(args.peers, args.rounds, as_json=True)
+
+    results = {
+        "peers": args.peers,
+        "loss": args.loss,
+        "convergence_seconds": round(converged_at, 2),
+        "beacons_until_converged": beacons_sent,
+        "steady_interval_seconds": round(steady_interval, 2),
+        "lan_beacons_per_second": round(lan_rate, 1),
+        "beacon_bytes": beacon_bytes,
+        "legacy_json_beacon_bytes": json_bytes,
+        "receive_us_per_beacon": round(per_beacon * 1e6, 2),
+        "legacy_json_receive_us_per_beacon": round(json_per_beacon * 1e6, 2),
+        "receive_cpu_percent": round(per_beacon * lan_rate * 100, 3),
+        "expiry_sweep_ms": round(sweep_seconds * 1e3, 2),
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, value in results.items():
+        print(f"{name:36} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+# benchmarks/loopback_bench.py
+# End-to-end numbers from real nodes: N node processes on loopback, each with
+# its own data directory, serving synthetic files over the real HTTP servers.
+#
+#   python -m benchmarks.loopback_bench --nodes 4 --output before.json
+#   python -m benchmarks.loopback_bench --nodes 4 --compare before.json
+#
+# Measured:
+#   discovery  - seconds from starting discovery on every node until each
+#                lists all the others (multicast on 127.0.0.1, on its own port)
+#   list_files - /p2p/list_files latency for a catalog of --catalog-files
+#                files: the whole listing, the first page, and a 304 revalidation
+#   download   - throughput of a --file-size MB file from the data server with
+#                1 and --clients clients at once, and from the Flask server
+#   proxy      - the same file fetched directly and through another node's
+#                download proxy (its content cache turned off)
+#
+# Results are JSON (stdout, or --output), with the commit and parameters, so
+# runs on different commits can be compared with --compare. The clients run in
+# this process, so the multi-client figures are a lower bound on a fast machine.
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+from p2p_app import config
+
+BENCH_MULTICAST_PORT = 19900  # Away from config.MULTICAST_PORT, so a running node isn't disturbed
+READ_SIZE = 1024 * 1024
+
+
+# --- Node process ---
+
+def run_node(args):
+    """Body of one node process: a full node whose state lives under --workdir.
+
+    Discovery starts when "go" arrives on stdin, so the harness can start it on
+    every node at once; the node exits when stdin closes.
+    """
+    data_dir = os.path.join(args.workdir, "data")
+    config.DATA_DIR = data_dir
+    config.HASH_CACHE_PATH = os.path.join(data_dir, "hash_cache.json")
+    config.MANIFEST_DIR = os.path.join(data_dir, "manifests")
+    config.CACHE_DIR = os.path.join(data_dir, "cache")
+    config.SHARE_INDEX_PATH = os.path.join(data_dir, "shares.db")
+    config.DOWNLOAD_DIR = os.path.join(args.workdir, "downloads")
+    config.UPLOAD_DIR = os.path.join(args.workdir, "uploads")
+    config.BLOB_DIR = os.path.join(config.UPLOAD_DIR, "blobs")
+    config.BLOB_TEMP_DIR = os.path.join(config.BLOB_DIR, "tmp")
+    config.CACHE_MAX_BYTES = 0  # Proxied downloads must reach the peer every time
+    config.SHARE_RESCAN_INTERVAL = 0
+    config.MULTICAST_PORT = args.multicast_port
+    config.MULTICAST_INTERFACES = ["127.0.0.1"]
+
+    from p2p_app import data_server, discovery, logs, server
+    logs.setup("WARNING")
+    discovery.set_identity(username=args.name, server_port=args.port)
+    discovery.my_ip = "127.0.0.1"
+    data_server.start_data_server(args.data_port)
+
+    def wait_for_go():
+        for line in sys.stdin:
+            if line.strip() == "go":
+                discovery.start_discovery(username=args.name, server_port_to_advertise=args.port)
+                discovery.my_ip = "127.0.0.1"
+        os._exit(0)  # The harness is gone
+
+    threading.Thread(target=wait_for_go, daemon=True).start()
+    server.run_server(port=args.port)
+
+
+# --- Harness ---
+
+class Node:
+    def __init__(self, index, port, data_port, workdir, multicast_port):
+        self.name = f"bench{index}"
+        self.port = port
+        self.data_port = data_port
+        self.base = f"http://127.0.0.1:{port}"
+        os.makedirs(workdir, exist_ok=True)
+        self.log = open(os.path.join(workdir, "node.log"), "wb")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.loopback_bench", "--node",
+             "--name", self.name, "--port", str(port), "--data-port", str(data_port),
+             "--workdir", workdir, "--multicast-port", str(multicast_port)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdin=subprocess.PIPE, stdout=self.log, stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} exited with {self.process.returncode}; see {self.log.name}")
+            try:
+                if requests.get(self.base + "/p2p/hello", timeout=1).ok:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f"{self.name} did not start within {timeout}s")
+
+    def start_discovery(self):
+        self.process.stdin.write(b"go\n")
+        self.process.stdin.flush()
+
+    def share(self, path, expected_files, timeout=600):
+        """Share `path` and wait until all its files are listed under their content IDs."""
+        response = requests.post(self.base + "/api/shares", json={"path": path}, timeout=30)
+        response.raise_for_status()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            files = requests.get(self.base + "/p2p/list_files", timeout=30).json()
+            if len(files) >= expected_files and not any(f["id"].startswith("pending-") for f in files):
+                return files
+            time.sleep(0.2)
+        raise RuntimeError(f"{path} was not hashed within {timeout}s")
+
+    def metric(self, sample):
+        """Value of one sample from the node's /metrics, e.g. 'lfs_peers' (0 if absent)."""
+        for line in requests.get(self.base + "/metrics", timeout=5).text.splitlines():
+            if line.startswith(sample + " "):
+                return float(line.rsplit(" ", 1)[1])
+        return 0.0
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()  # The node exits on EOF
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+
+
+def free_ports(count, start):
+    ports = []
+    port = start
+    while len(ports) < count:
+        port = config.find_available_port(port)
+        ports.append(port)
+        port += 1
+    return ports
+
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    return {
+        "requests": len(samples),
+        "mean_ms": round(statistics.fmean(samples) * 1e3, 2),
+        "p50_ms": round(samples[len(samples) // 2] * 1e3, 2),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1e3, 2),
+        "min_ms": round(samples[0] * 1e3, 2),
+    }
+
+
+def timed_get(session, url, repeat, **kwargs):
+    samples = []
+    response = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = session.get(url, timeout=60, **kwargs)
+        response.content
+        samples.append(time.perf_counter() - started)
+        response.raise_for_status()
+    return samples, response
+
+
+def fetch(url, session=None):
+    """POST a download and read the body to the end. Returns (bytes, seconds)."""
+    session = session or requests.Session()
+    started = time.perf_counter()
+    received = 0
+    with session.post(url, json={"password": ""}, stream=True, timeout=(5, 300)) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(READ_SIZE):
+            received += len(chunk)
+    return received, time.perf_counter() - started
+
+
+def throughput(url, clients, rounds):
+    """Aggregate MB/s of `clients` concurrent downloads of `url`, best of `rounds`."""
+    best = None
+    for _ in range(rounds):
+        sessions = [requests.Session() for _ in range(clients)]
+        results = [None] * clients
+        barrier = threading.Barrier(clients + 1)
+
+        def worker(index):
+            barrier.wait()
+            results[index] = fetch(url, sessions[index])
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        rate = sum(received for received, _ in results) / elapsed / 1e6
+        best = rate if best is None else max(best, rate)
+    return round(best, 1)
+
+
+def make_file(path, size):
+    with open(path, "wb") as f:
+        remaining = size
+        block = os.urandom(READ_SIZE)  # Incompressible, so compression never kicks in
+        while remaining:
+            f.write(block[:min(remaining, READ_SIZE)])
+            remaining -= min(remaining, READ_SIZE)
+
+
+def make_catalog(directory, count):
+    # Names of realistic length spread over subfolders, each file a little different
+    for i in range(count):
+        folder = os.path.join(directory, f"album-{i // 500:04d}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"track-{i:06d} some artist - a title.flac"), "wb") as f:
+            f.write(i.to_bytes(8, "big"))
+
+
+def bench_discovery(nodes, timeout):
+    started = time.perf_counter()
+    for node in nodes:
+        node.start_discovery()
+    others = {node.port for node in nodes}
+    pending = list(nodes)
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        for node in list(pending):
+            peers = requests.get(node.base + "/api/peers", timeout=5).json()
+            if {peer["port"] for peer in peers} >= others - {node.port}:
+                pending.remove(node)
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    return {
+        "nodes": len(nodes),
+        "converged": not pending,
+        "convergence_seconds": round(elapsed, 3) if not pending else None,
+        "beacons_sent": int(sum(node.metric('lfs_discovery_beacons_total{kind="sent"}') for node in nodes)),
+    }
+
+
+def bench_list_files(node, file_count, repeat):
+    session = requests.Session()
+    url = node.base + "/p2p/list_files"
+    full, response = timed_get(session, url, repeat)
+    page, _ = timed_get(session, url, repeat, params={"limit": config.LISTING_PAGE_SIZE})
+    not_modified, revalidated = timed_get(session, url, repeat, headers={"If-None-Match": response.headers["ETag"]})
+    return {
+        "files": file_count,
+        "listing_bytes": len(response.content),
+        "full": latency_summary(full),
+        "first_page": latency_summary(page),
+        "not_modified": latency_summary(not_modified) | {"status": revalidated.status_code},
+    }
+
+
+def bench_downloads(node, file_id, file_size, clients, rounds):
+    data_url = f"http://127.0.0.1:{node.data_port}/p2p/download_file/{file_id}"
+    flask_url = f"{node.base}/p2p/download_file/{file_id}"
+    received, _ = fetch(data_url)
+    if received != file_size:
+        raise RuntimeError(f"Downloaded {received} bytes, expected {file_size}")
+    return {
+        "file_bytes": file_size,
+        "data_server_1_client_mb_s": throughput(data_url, 1, rounds),
+        f"data_server_{clients}_clients_mb_s": throughput(data_url, clients, rounds),
+        "flask_1_client_mb_s": throughput(flask_url, 1, rounds),
+    }
+
+
+def bench_proxy(origin, proxy, file_id, rounds):
+    direct_url = f"http://127.0.0.1:{origin.data_port}/p2p/download_file/{file_id}"
+    proxied_url = f"{proxy.base}/api/peers/127.0.0.1/{origin.port}/download/{file_id}"
+    direct = min(fetch(direct_url)[1] for _ in range(rounds))
+    proxied = min(fetch(proxied_url)[1] for _ in range(rounds))
+    return {
+        "direct_seconds": round(direct, 3),
+        "proxied_seconds": round(proxied, 3),
+        "overhead_percent": round((proxied / direct - 1) * 100, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _numbers(tree, prefix=""):
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            yield from _numbers(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def compare(baseline, results):
+    """Print each result next to the baseline's, with the change in percent."""
+    old = dict(_numbers(baseline.get("results", {})))
+    print(f"{'metric':52} {'baseline':>12} {'this run':>12} {'change':>8}", file=sys.stderr)
+    for name, value in _numbers(results["results"]):
+        before = old.get(name)
+        change = f"{(value / before - 1) * 100:+.1f}%" if before else ""
+        print(f"{name:52} {'' if before is None else before:>12} {value:>12} {change:>8}", file=sys.stderr)
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="lfs-bench-")
+    ports = free_ports(2 * args.nodes, args.base_port)
+    nodes = []
+    try:
+        for i in range(args.nodes):
+            nodes.append(Node(i, ports[2 * i], ports[2 * i + 1], os.path.join(workdir, f"node{i}"), args.multicast_port))
+        for node in nodes:
+            node.wait_ready()
+        origin, proxy, catalog_node = nodes[0], nodes[1], nodes[-1]
+
+        results = {}
+        if "discovery" in args.only:
+            results["discovery"] = bench_discovery(nodes, args.discovery_timeout)
+        if "list_files" in args.only:
+            catalog_dir = os.path.join(workdir, "catalog")
+            make_catalog(catalog_dir, args.catalog_files)
+            catalog_node.share(catalog_dir, args.catalog_files)
+            results["list_files"] = bench_list_files(catalog_node, args.catalog_files, args.repeat)
+        if "download" in args.only or "proxy" in args.only:
+            file_size = args.file_size * 1024 * 1024
+            path = os.path.join(workdir, "payload.bin")
+            make_file(path, file_size)
+            files = origin.share(path, 1)
+            file_id = next(f["id"] for f in files if f["name"] == "payload.bin")
+            if "download" in args.only:
+                results["download"] = bench_downloads(origin, file_id, file_size, args.clients, args.rounds)
+            if "proxy" in args.only:
+                results["proxy"] = bench_proxy(origin, proxy, file_id, args.rounds)
+    finally:
+        for node in nodes:
+            node.stop()
+        if args.keep:
+            print(f"Node directories and logs kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "benchmark": "loopback",
+        "commit": git_commit(),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": {
+            "nodes": args.nodes, "catalog_files": args.catalog_files, "file_size_mb": args.file_size,
+            "clients": args.clients, "repeat": args.repeat, "rounds": args.rounds,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=4, help="node processes to start (at least 2)")
+    parser.add_argument("--catalog-files", type=int, default=20000, help="files in the listed catalog")
+    parser.add_argument("--file-size", type=int, default=256, help="MB in the downloaded file")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent clients in the multi-client run")
+    parser.add_argument("--repeat", type=int, default=20, help="requests per latency measurement")
+    parser.add_argument("--rounds", type=int, default=3, help="runs per throughput figure (best is kept)")
+    parser.add_argument("--only", default="discovery,list_files,download,proxy",
+                        help="comma-separated subset of: discovery, list_files, download, proxy")
+    parser.add_argument("--discovery-timeout", type=float, default=60.0)
+    parser.add_argument("--base-port", type=int, default=19500, help="nodes take free ports from here up")
+    parser.add_argument("--multicast-port", type=int, default=BENCH_MULTICAST_PORT)
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the node directories and logs")
+    # Used by the harness to start each node
+    parser.add_argument("--node", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--name", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--data-port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.node:
+        run_node(args)
+        return
+    if args.nodes < 2:
+        parser.error("--nodes must be at least 2 (one serves, another proxies)")
+    args.only = {part.strip() for part in args.only.split(",") if part.strip()}
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
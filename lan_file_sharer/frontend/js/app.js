@@ -8,6 +8,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const fileInput = document.getElementById('file-input');
     const dropZone = document.getElementById('drop-zone');
     const mySharedFilesList = document.getElementById('my-shared-files-list');
+    const uploadsListUL = document.getElementById('uploads-list');
+    const sharePathInput = document.getElementById('share-path-input');
+    const sharePathBtn = document.getElementById('share-path-btn');
 
     const peerListUL = document.getElementById('peer-list'); // Changed from peerList
     const remoteFilesListUL = document.getElementById('remote-files-list'); // Changed from remoteFilesList
@@ -15,16 +18,33 @@ document.addEventListener('DOMContentLoaded', () => {
     const passwordPromptDiv = document.getElementById('password-prompt'); // Changed from passwordPrompt
     const downloadPasswordInput = document.getElementById('download-password-input');
     const submitPasswordBtn = document.getElementById('submit-password-btn');
+    const downloadsListUL = document.getElementById('downloads-list');
+    const browseNetworkBtn = document.getElementById('browse-network-btn');
+    const searchInput = document.getElementById('search-input');
+    const searchBtn = document.getElementById('search-btn');
+    const searchStatus = document.getElementById('search-status');
 
     let currentUsername = '';
     let currentSelectedPeer = null; // Stores {username, address, port} of the peer whose files are being viewed
-    let fileToDownloadWithPassword = null; // Stores {peerAddress, peerPort, fileId, fileName}
+    let viewingNetworkCatalog = false; // True while the network-wide catalog is shown instead of one peer
+    let lastPeerCatalogVersions = ''; // Catalog versions announced by peers at the last peer fetch
+    let fileToDownloadWithPassword = null; // Stores {peerAddress, peerPort, fileId, fileName, fileHash}
 
     const API_BASE_URL = `http://${window.location.hostname}:19001/api`;
+    const UPLOAD_PARALLEL_CHUNKS = 3; // Chunk PUTs in flight per file
+    const UPLOAD_CHUNK_ATTEMPTS = 6; // Tries per chunk before the upload is reported as failed
 
-    // Interval timers
+    // Interval timers (only used when the browser has no EventSource)
     let peerFetchInterval = null;
     let myFilesFetchInterval = null;
+    let downloadsFetchInterval = null;
+    let eventSource = null; // Live updates from /api/events
+    let searchSource = null; // Results of the running search, from /api/search
+
+    // Latest known state, kept current by the event stream
+    const peersByKey = new Map();
+    const mySharesById = new Map();
+    const downloadsById = new Map();
 
     // --- Initialization ---
     fetchIdentity();
@@ -35,7 +55,11 @@ document.addEventListener('DOMContentLoaded', () => {
     dropZone.addEventListener('dragleave', handleDragLeave);
     dropZone.addEventListener('drop', handleDrop);
     fileInput.addEventListener('change', handleFileSelect);
+    sharePathBtn.addEventListener('click', sharePath);
     submitPasswordBtn.addEventListener('click', handlePasswordSubmitForDownload);
+    browseNetworkBtn.addEventListener('click', browseNetworkCatalog);
+    searchBtn.addEventListener('click', searchNetwork);
+    searchInput.addEventListener('keydown', event => { if (event.key === 'Enter') searchNetwork(); });
 
     // --- Core Functions ---
     async function fetchIdentity() {
@@ -101,30 +125,87 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!currentUsername) return;
         stopPeriodicFetches(); // Clear existing intervals if any
 
+        if (window.EventSource) {
+            subscribeToEvents(); // The server pushes changes; nothing to poll
+            return;
+        }
         fetchPeers();
         fetchMySharedFiles();
+        fetchDownloads();
 
         peerFetchInterval = setInterval(fetchPeers, 5000); // Fetch peers every 5 seconds
         myFilesFetchInterval = setInterval(fetchMySharedFiles, 10000); // Fetch own shared files every 10 seconds
+        downloadsFetchInterval = setInterval(fetchDownloads, 2000); // Refresh download progress every 2 seconds
         console.log("Periodic fetching started.");
     }
 
     function stopPeriodicFetches() {
         if (peerFetchInterval) clearInterval(peerFetchInterval);
         if (myFilesFetchInterval) clearInterval(myFilesFetchInterval);
+        if (downloadsFetchInterval) clearInterval(downloadsFetchInterval);
+        if (eventSource) eventSource.close();
         peerFetchInterval = null;
         myFilesFetchInterval = null;
+        downloadsFetchInterval = null;
+        eventSource = null;
         console.log("Periodic fetching stopped.");
     }
 
+    // --- Live Updates ---
+    function peerKey(peer) {
+        return `${peer.address}:${peer.port}`;
+    }
+
+    function replaceAll(map, items, keyOf) {
+        map.clear();
+        items.forEach(item => map.set(keyOf(item), item));
+    }
+
+    function subscribeToEvents() {
+        eventSource = new EventSource(`${API_BASE_URL}/events`);
+        const on = (type, handler) => eventSource.addEventListener(type, event => handler(JSON.parse(event.data)));
+
+        // Sent on every (re)connect, and whenever we fell too far behind
+        on('snapshot', snapshot => {
+            replaceAll(peersByKey, snapshot.peers, peerKey);
+            replaceAll(mySharesById, snapshot.shares, share => share.id);
+            replaceAll(downloadsById, snapshot.downloads, job => job.id);
+            showPeers();
+            showMySharedFiles();
+            showDownloads();
+        });
+        on('peer-joined', peer => { peersByKey.set(peerKey(peer), peer); showPeers(); });
+        on('peer-catalog-changed', peer => { peersByKey.set(peerKey(peer), peer); showPeers(); });
+        on('peer-left', peer => { peersByKey.delete(peerKey(peer)); showPeers(); });
+        on('share-updated', share => { mySharesById.set(share.id, share); showMySharedFiles(); });
+        on('share-removed', share => { mySharesById.delete(share.id); showMySharedFiles(); });
+        on('download-progress', job => { downloadsById.set(job.id, job); showDownloads(); });
+        on('download-removed', job => { downloadsById.delete(job.id); showDownloads(); });
+        eventSource.onerror = () => console.warn('Event stream interrupted; the browser will reconnect.');
+    }
+
+    function showPeers() {
+        const peers = [...peersByKey.values()];
+        renderPeers(peers);
+        refreshOpenListing(peers);
+    }
+
+    function showMySharedFiles() {
+        renderMySharedFiles([...mySharesById.values()]);
+    }
+
+    function showDownloads() {
+        renderDownloads([...downloadsById.values()].sort((a, b) => a.created_at - b.created_at));
+    }
+
     // --- Peer Discovery and Display ---
     async function fetchPeers() {
         if (!currentUsername) return;
         try {
             const response = await fetch(`${API_BASE_URL}/peers`);
             if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-            const peers = await response.json();
-            renderPeers(peers);
+            replaceAll(peersByKey, await response.json(), peerKey);
+            showPeers();
         } catch (error) {
             console.error('Error fetching peers:', error);
             // Optionally clear peer list or show error in UI
@@ -157,9 +238,32 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    function catalogVersionsOf(peers) {
+        return peers.map(peer => `${peer.address}:${peer.port}@${peer.catalog_version}`).sort().join(',');
+    }
+
+    // Peers announce their catalog version in discovery beacons; reload the
+    // listing on screen only when one of the versions behind it has changed.
+    function refreshOpenListing(peers) {
+        const versions = catalogVersionsOf(peers);
+        const changed = versions !== lastPeerCatalogVersions;
+        lastPeerCatalogVersions = versions;
+        if (viewingNetworkCatalog) {
+            if (changed) browseNetworkCatalog();
+            return;
+        }
+        if (!currentSelectedPeer) return;
+        const peer = peers.find(p => p.address === currentSelectedPeer.address && p.port === currentSelectedPeer.port);
+        if (peer && peer.catalog_version !== currentSelectedPeer.catalog_version) {
+            handlePeerSelect(peer);
+        }
+    }
+
     async function handlePeerSelect(peer) {
         console.log('Selected peer:', peer);
+        stopSearch();
         currentSelectedPeer = peer;
+        viewingNetworkCatalog = false;
         selectedPeerUsernameDisplay.textContent = peer.username;
         remoteFilesListUL.innerHTML = '<li>Loading files...</li>';
         passwordPromptDiv.style.display = 'none'; // Hide password prompt
@@ -189,6 +293,26 @@ document.addEventListener('DOMContentLoaded', () => {
             remoteFilesListUL.innerHTML = '<li>This user is not sharing any files.</li>';
             return;
         }
+        // Shared folders (names like "Music/a.mp3") can be fetched as one zip
+        const folders = new Map();
+        files.forEach(file => {
+            const slash = file.name.indexOf('/');
+            if (slash > 0) {
+                const folder = file.name.slice(0, slash);
+                folders.set(folder, (folders.get(folder) || 0) + 1);
+            }
+        });
+        folders.forEach((count, folder) => {
+            const li = document.createElement('li');
+            li.textContent = `${folder}/ (folder, ${count} files)`;
+            const zipBtn = document.createElement('button');
+            zipBtn.textContent = 'Download as .zip';
+            zipBtn.onclick = () => downloadArchive(peer, { folder: folder },
+                files.some(file => file.has_password && file.name.startsWith(`${folder}/`)));
+            li.appendChild(zipBtn);
+            remoteFilesListUL.appendChild(li);
+        });
+
         files.forEach(file => {
             const li = document.createElement('li');
             li.textContent = `${file.name} (${(file.size / 1024 / 1024).toFixed(2)} MB)`;
@@ -202,55 +326,219 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // One request for a whole folder: the peer streams a zip built on the fly.
+    // Submitted as a form so the browser saves the reply like any download
+    // (into a hidden frame, so the page stays put).
+    function downloadArchive(peer, fields, needsPassword) {
+        const password = needsPassword ? prompt('Some of these files are protected. Enter the password:') : '';
+        if (password === null) return;
+        let frame = document.getElementById('archive-download-frame');
+        if (!frame) {
+            frame = document.createElement('iframe');
+            frame.id = frame.name = 'archive-download-frame';
+            frame.style.display = 'none';
+            document.body.appendChild(frame);
+        }
+        const form = document.createElement('form');
+        form.method = 'POST';
+        form.target = frame.name;
+        form.action = `${API_BASE_URL}/peers/${encodeURIComponent(peer.address)}/${peer.port}/archive`;
+        Object.entries({ ...fields, format: 'zip', compress: 'on', password: password }).forEach(([name, value]) => {
+            const input = document.createElement('input');
+            input.type = 'hidden';
+            input.name = name;
+            input.value = value;
+            form.appendChild(input);
+        });
+        document.body.appendChild(form);
+        form.submit();
+        form.remove();
+    }
+
+    // --- Network-wide Catalog ---
+    async function browseNetworkCatalog() {
+        stopSearch();
+        currentSelectedPeer = null;
+        viewingNetworkCatalog = true;
+        selectedPeerUsernameDisplay.textContent = 'everyone';
+        remoteFilesListUL.innerHTML = '<li>Loading files...</li>';
+        passwordPromptDiv.style.display = 'none';
+        try {
+            const response = await fetch(`${API_BASE_URL}/catalog`);
+            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            const networkCatalog = await response.json();
+            renderCatalog(networkCatalog.files);
+        } catch (error) {
+            console.error('Error fetching network catalog:', error);
+            remoteFilesListUL.innerHTML = `<li>Error fetching files: ${error.message}</li>`;
+        }
+    }
+
+    // --- Filename Search ---
+    function stopSearch() {
+        if (searchSource) {
+            searchSource.close();
+            searchSource = null;
+        }
+        searchStatus.textContent = '';
+    }
+
+    function searchNetwork() {
+        const query = searchInput.value.trim();
+        if (!query) return;
+        stopSearch();
+        currentSelectedPeer = null;
+        viewingNetworkCatalog = false;
+        selectedPeerUsernameDisplay.textContent = `"${query}"`;
+        remoteFilesListUL.innerHTML = '<li>Searching...</li>';
+        passwordPromptDiv.style.display = 'none';
+
+        // Results stream in as peers answer; each update is the merged list so far
+        const source = new EventSource(`${API_BASE_URL}/search?q=${encodeURIComponent(query)}`);
+        searchSource = source;
+        const show = update => {
+            renderCatalog(update.results, 'No matching files found.');
+            let status = `${update.answered} of ${update.total} peer(s) answered`;
+            if (update.failed) status += `, ${update.failed} did not`;
+            if (update.truncated) status += ' (broad query: refine it to see every match)';
+            searchStatus.textContent = status;
+        };
+        source.addEventListener('results', event => show(JSON.parse(event.data)));
+        source.addEventListener('done', event => {
+            show(JSON.parse(event.data));
+            source.close(); // Otherwise the browser would reconnect and search again
+            if (searchSource === source) searchSource = null;
+        });
+        source.onerror = () => {
+            // A 400 (query too short) or a dropped connection
+            source.close();
+            if (searchSource === source) searchSource = null;
+            if (remoteFilesListUL.textContent === 'Searching...') {
+                remoteFilesListUL.innerHTML = '<li>Search failed. Use at least two letters.</li>';
+            }
+        };
+    }
+
+    function renderCatalog(files, emptyMessage = 'Nobody on the network is sharing files.') {
+        remoteFilesListUL.innerHTML = '';
+        if (files.length === 0) {
+            remoteFilesListUL.innerHTML = `<li>${emptyMessage}</li>`;
+            return;
+        }
+        files.forEach(entry => {
+            const li = document.createElement('li');
+            const holders = entry.sources.map(src => src.username || src.address).join(', ');
+            li.textContent = `${entry.name} (${(entry.size / 1024 / 1024).toFixed(2)} MB) - ${entry.source_count} peer(s): ${holders}`;
+
+            // Prefer a source that doesn't need a password; the download
+            // manager pulls from the other holders too when the hash is known.
+            const source = entry.sources.find(src => !src.has_password) || entry.sources[0];
+            const downloadBtn = document.createElement('button');
+            downloadBtn.textContent = 'Download';
+            downloadBtn.onclick = () => prepareDownload(
+                { address: source.address, port: source.port, username: source.username },
+                { id: source.id, name: entry.name, hash: entry.hash, has_password: source.has_password }
+            );
+
+            li.appendChild(downloadBtn);
+            remoteFilesListUL.appendChild(li);
+        });
+    }
+
     // --- Own Shared Files Display ---
     async function fetchMySharedFiles() {
         if (!currentUsername) return;
         try {
-            const response = await fetch(`${API_BASE_URL}/shared_files`);
+            const response = await fetch(`${API_BASE_URL}/shares`);
             if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-            const files = await response.json();
-            renderMySharedFiles(files);
+            replaceAll(mySharesById, await response.json(), share => share.id);
+            showMySharedFiles();
         } catch (error) {
             console.error('Error fetching my shared files:', error);
         }
     }
 
-    function renderMySharedFiles(files) {
+    function renderMySharedFiles(shares) {
         mySharedFilesList.innerHTML = '';
-        if (files.length === 0) {
+        if (shares.length === 0) {
             mySharedFilesList.innerHTML = '<li>You are not sharing any files.</li>';
             return;
         }
-        files.forEach(file => {
+        shares.forEach(share => {
             const li = document.createElement('li');
-            li.textContent = `${file.name} (${(file.size / 1024 / 1024).toFixed(2)} MB) ${file.has_password ? '(Protected)' : ''}`;
+            let text = `${share.name} (${(share.size / 1024 / 1024).toFixed(2)} MB)`;
+            if (share.kind === 'dir') {
+                text += ` - ${share.file_count} files`;
+                if (share.scanning) text += ', scanning...';
+            }
+            if (share.hashed_count < share.file_count) text += `, hashing ${share.hashed_count}/${share.file_count}`;
+            if (share.has_password) text += ' (Protected)';
+            li.textContent = text;
+
+            if (share.kind === 'dir') {
+                const rescanBtn = document.createElement('button');
+                rescanBtn.textContent = 'Rescan';
+                rescanBtn.disabled = share.scanning;
+                rescanBtn.onclick = () => rescanShare(share.id);
+                li.appendChild(rescanBtn);
+            }
 
             const unshareBtn = document.createElement('button');
             unshareBtn.textContent = 'Unshare';
             unshareBtn.style.backgroundColor = '#d9534f'; // Reddish color for delete
-            unshareBtn.onclick = () => unshareFile(file.id);
+            unshareBtn.onclick = () => unshareShare(share);
 
             li.appendChild(unshareBtn);
             mySharedFilesList.appendChild(li);
         });
     }
 
-    async function unshareFile(fileId) {
-        if (!confirm("Are you sure you want to stop sharing this file?")) return;
+    async function unshareShare(share) {
+        const what = share.kind === 'dir' ? `the folder ${share.name} (${share.file_count} files)` : share.name;
+        if (!confirm(`Are you sure you want to stop sharing ${what}?`)) return;
         try {
-            const response = await fetch(`${API_BASE_URL}/shared_files/${fileId}`, { method: 'DELETE' });
+            const response = await fetch(`${API_BASE_URL}/shares/${share.id}`, { method: 'DELETE' });
             if (!response.ok) {
                 const errorData = await response.json();
                 throw new Error(errorData.error || `HTTP error! ${response.status}`);
             }
-            console.log(`File ${fileId} unshared.`);
-            fetchMySharedFiles(); // Refresh list
+            console.log(`Share ${share.id} removed.`);
+            if (!eventSource) fetchMySharedFiles(); // Refresh list (the event stream does it otherwise)
         } catch (error) {
             console.error('Error unsharing file:', error);
             alert(`Failed to unshare file: ${error.message}`);
         }
     }
 
+    async function rescanShare(shareId) {
+        try {
+            await postJson(`${API_BASE_URL}/shares/${shareId}/rescan`, {});
+            if (!eventSource) fetchMySharedFiles();
+        } catch (error) {
+            console.error('Error rescanning share:', error);
+            alert(`Failed to rescan: ${error.message}`);
+        }
+    }
+
+    async function sharePath() {
+        if (!currentUsername) {
+            alert("Please set your username before sharing files.");
+            return;
+        }
+        const path = sharePathInput.value.trim();
+        if (!path) return;
+        const password = prompt(`Enter an optional password for ${path} (leave blank for none):`) || "";
+        try {
+            const data = await postJson(`${API_BASE_URL}/shares`, { path, password });
+            console.log(`Shared ${path}:`, data);
+            sharePathInput.value = '';
+            if (!eventSource) fetchMySharedFiles();
+        } catch (error) {
+            console.error('Error sharing path:', error);
+            alert(`Failed to share ${path}: ${error.message}`);
+        }
+    }
+
     // --- File Sharing (Drag/Drop, Input) ---
     function handleDragOver(event) {
         event.preventDefault();
@@ -282,34 +570,133 @@ document.addEventListener('DOMContentLoaded', () => {
         }
         console.log('Files selected for sharing:', files);
 
-        for (const file of files) {
-            const password = prompt(`Enter an optional password for ${file.name} (leave blank for none):`) || "";
+        // Ask for every password first, then upload all the files at once
+        const batch = Array.from(files).map(file => ({
+            file: file,
+            password: prompt(`Enter an optional password for ${file.name} (leave blank for none):`) || ""
+        }));
+        fileInput.value = ''; // Reset file input
+        await Promise.all(batch.map(({ file, password }) => shareFile(file, password)));
+    }
+
+    async function shareFile(file, password) {
+        const row = addUploadRow(file);
+        try {
+            const data = await uploadInChunks(file, password, bytesDone => {
+                row.progress.value = bytesDone;
+                row.label.textContent = `${file.name} - ${(bytesDone / 1024 / 1024).toFixed(2)} / ${(file.size / 1024 / 1024).toFixed(2)} MB`;
+            });
+            console.log(`File ${file.name} shared:`, data);
+            row.item.remove();
+            if (!eventSource) fetchMySharedFiles(); // Refresh list (the event stream does it otherwise)
+        } catch (error) {
+            console.error('Error sharing file:', error);
+            row.label.textContent = `${file.name} - failed: ${error.message} (add the file again to resume)`;
+            row.progress.remove();
+            setTimeout(() => row.item.remove(), 30000);
+        }
+    }
+
+    function addUploadRow(file) {
+        const item = document.createElement('li');
+        const label = document.createElement('span');
+        label.textContent = `${file.name} - starting`;
+        const progress = document.createElement('progress');
+        progress.max = file.size || 1;
+        progress.value = 0;
+        item.appendChild(label);
+        item.appendChild(progress);
+        uploadsListUL.appendChild(item);
+        return { item, label, progress };
+    }
+
+    async function postJson(url, payload) {
+        const response = await fetch(url, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(payload)
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || `HTTP error! status: ${response.status}`);
+        }
+        return data;
+    }
+
+    // Chunked upload: the server keeps what has arrived, so after a dropped
+    // connection (or a page reload) adding the same file again only sends
+    // the missing chunks.
+    async function uploadInChunks(file, password, onProgress) {
+        const session = await postJson(`${API_BASE_URL}/uploads`, {
+            name: file.name,
+            size: file.size,
+            key: `${file.name}:${file.size}:${file.lastModified}`
+        });
+        const queue = missingChunks(session.received, file.size, session.chunk_size);
+        let bytesDone = session.bytes_received;
+        onProgress(bytesDone);
+
+        async function worker() {
+            while (queue.length > 0) {
+                const [start, end] = queue.shift();
+                await putChunk(session.id, file, start, end);
+                bytesDone += end - start + 1;
+                onProgress(bytesDone);
+            }
+        }
+        const workers = [];
+        for (let i = 0; i < Math.min(UPLOAD_PARALLEL_CHUNKS, queue.length); i++) {
+            workers.push(worker());
+        }
+        await Promise.all(workers);
+        return postJson(`${API_BASE_URL}/uploads/${session.id}/finalize`, { password: password });
+    }
+
+    function missingChunks(received, size, chunkSize) {
+        // Inclusive [start, end] spans the server doesn't have yet, at most chunkSize each
+        const gaps = [];
+        let position = 0;
+        for (const [start, end] of received) {
+            if (start > position) gaps.push([position, start - 1]);
+            position = Math.max(position, end + 1);
+        }
+        if (position < size) gaps.push([position, size - 1]);
+
+        const chunks = [];
+        for (const [gapStart, gapEnd] of gaps) {
+            for (let start = gapStart; start <= gapEnd; start += chunkSize) {
+                chunks.push([start, Math.min(start + chunkSize - 1, gapEnd)]);
+            }
+        }
+        return chunks;
+    }
 
+    async function putChunk(uploadId, file, start, end) {
+        let lastError = null;
+        for (let attempt = 0; attempt < UPLOAD_CHUNK_ATTEMPTS; attempt++) {
+            if (attempt > 0) {
+                await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** (attempt - 1)));
+            }
+            let response;
             try {
-                // Create FormData to send the file
-                const formData = new FormData();
-                formData.append('file', file);
-                formData.append('password', password);
-
-                const response = await fetch(`${API_BASE_URL}/shared_files`, {
-                    method: 'POST',
-                    body: formData
+                response = await fetch(`${API_BASE_URL}/uploads/${uploadId}`, {
+                    method: 'PUT',
+                    headers: {
+                        'Content-Type': 'application/octet-stream',
+                        'Content-Range': `bytes ${start}-${end}/${file.size}`
+                    },
+                    body: file.slice(start, end + 1)
                 });
-                
-                if (!response.ok) {
-                    const errorData = await response.json();
-                    throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
-                }
-                const data = await response.json();
-                console.log(`File ${file.name} shared:`, data);
-                fetchMySharedFiles(); // Refresh list
-                alert(`File '${file.name}' is now shared. ID: ${data.file_id}.`);
             } catch (error) {
-                console.error('Error sharing file:', error);
-                alert(`Failed to share file ${file.name}: ${error.message}`);
+                lastError = error; // Connection dropped: try again
+                continue;
             }
+            if (response.ok) return;
+            const errorData = await response.json().catch(() => ({}));
+            lastError = new Error(errorData.error || `HTTP error! status: ${response.status}`);
+            if (response.status < 500) break; // Retrying won't help
         }
-        fileInput.value = ''; // Reset file input
+        throw lastError;
     }
 
     // --- File Downloading ---
@@ -318,7 +705,8 @@ document.addEventListener('DOMContentLoaded', () => {
             peerAddress: peer.address,
             peerPort: peer.port,
             fileId: file.id,
-            fileName: file.name
+            fileName: file.name,
+            fileHash: file.hash
         };
 
         if (file.has_password) {
@@ -361,43 +749,119 @@ document.addEventListener('DOMContentLoaded', () => {
     async function initiateDownload(password) {
         if (!fileToDownloadWithPassword) return;
 
-        const { peerAddress, peerPort, fileId, fileName } = fileToDownloadWithPassword;
-        const encodedPeerAddress = encodeURIComponent(peerAddress);
-        // This is the backend endpoint that will proxy the P2P download
-        const downloadUrl = `${API_BASE_URL}/peers/${encodedPeerAddress}/${peerPort}/download/${fileId}`;
+        const { peerAddress, peerPort, fileId, fileName, fileHash } = fileToDownloadWithPassword;
 
         try {
-            console.log(`Attempting to download ${fileName} from ${peerAddress}:${peerPort} (ID: ${fileId})`);
-            const response = await fetch(downloadUrl, {
-                method: 'POST', // POST to send password in body
+            console.log(`Queueing download of ${fileName} from ${peerAddress}:${peerPort} (ID: ${fileId})`);
+            // The node downloads straight to its download directory; we only track the job.
+            // Files with a content hash are fetched from every peer that has them.
+            const response = await fetch(`${API_BASE_URL}/downloads`, {
+                method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ password: password })
+                body: JSON.stringify({
+                    peer_address: peerAddress,
+                    peer_port: peerPort,
+                    file_id: fileId,
+                    name: fileName,
+                    password: password,
+                    swarm: Boolean(fileHash)
+                })
             });
 
             if (!response.ok) {
-                const errorData = await response.json(); // Try to get error message from backend
+                const errorData = await response.json();
                 throw new Error(errorData.error || `Download failed: ${response.statusText} (Status: ${response.status})`);
             }
 
-            // Handle successful download (file stream)
-            const blob = await response.blob();
-            const link = document.createElement('a');
-            link.href = URL.createObjectURL(blob);
-            link.download = fileName; // Set the default filename for the download
-            document.body.appendChild(link);
-            link.click();
-            document.body.removeChild(link);
-            URL.revokeObjectURL(link.href); // Clean up
-
-            console.log(`${fileName} download initiated.`);
             passwordPromptDiv.style.display = 'none';
             fileToDownloadWithPassword = null;
-
+            if (!eventSource) fetchDownloads();
         } catch (error) {
             console.error('Error downloading file:', error);
             alert(`Download failed for ${fileName}: ${error.message}`);
-            // Keep password prompt open if it was a password error, or hide if other error
-            // For simplicity, just log and user can retry.
+        }
+    }
+
+    // --- Download Jobs ---
+    async function fetchDownloads() {
+        if (!currentUsername) return;
+        try {
+            const response = await fetch(`${API_BASE_URL}/downloads`);
+            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            replaceAll(downloadsById, await response.json(), job => job.id);
+            showDownloads();
+        } catch (error) {
+            console.error('Error fetching downloads:', error);
+        }
+    }
+
+    function renderDownloads(jobs) {
+        downloadsListUL.innerHTML = '';
+        if (jobs.length === 0) {
+            downloadsListUL.innerHTML = '<li>No downloads yet.</li>';
+            return;
+        }
+        jobs.forEach(job => {
+            const li = document.createElement('li');
+            const label = document.createElement('span');
+            const sizeMB = job.size ? (job.size / 1024 / 1024).toFixed(2) : '?';
+            const doneMB = (job.bytes_done / 1024 / 1024).toFixed(2);
+            let text = `${job.name || job.file_id} - ${job.status} (${doneMB} / ${sizeMB} MB)`;
+            if (job.status === 'running') text += ` ${(job.speed / 1024 / 1024).toFixed(2)} MB/s`;
+            if (job.sources) text += ` from ${job.sources.filter(s => s.active).length} peers`;
+            if (job.error) text += ` - ${job.error}`;
+            label.textContent = text;
+            li.appendChild(label);
+
+            const progress = document.createElement('progress');
+            progress.max = job.size || 1;
+            progress.value = job.size ? job.bytes_done : 0;
+            li.appendChild(progress);
+
+            const actions = document.createElement('span');
+            if (job.status === 'queued' || job.status === 'running') {
+                actions.appendChild(makeJobButton('Pause', () => downloadJobAction(job.id, 'pause')));
+            }
+            if (job.status === 'paused' || job.status === 'failed') {
+                actions.appendChild(makeJobButton('Resume', () => downloadJobAction(job.id, 'resume')));
+            }
+            if (job.status === 'completed') {
+                const link = document.createElement('a');
+                link.href = `${API_BASE_URL}/downloads/${job.id}/file`;
+                link.textContent = 'Save';
+                actions.appendChild(link);
+            }
+            const removeLabel = (job.status === 'completed' || job.status === 'cancelled') ? 'Remove' : 'Cancel';
+            const removeBtn = makeJobButton(removeLabel, () => downloadJobAction(job.id, 'cancel'));
+            removeBtn.style.backgroundColor = '#d9534f';
+            actions.appendChild(removeBtn);
+            li.appendChild(actions);
+
+            downloadsListUL.appendChild(li);
+        });
+    }
+
+    function makeJobButton(text, onClick) {
+        const button = document.createElement('button');
+        button.textContent = text;
+        button.onclick = onClick;
+        return button;
+    }
+
+    async function downloadJobAction(jobId, action) {
+        const url = action === 'cancel'
+            ? `${API_BASE_URL}/downloads/${jobId}`
+            : `${API_BASE_URL}/downloads/${jobId}/${action}`;
+        try {
+            const response = await fetch(url, { method: action === 'cancel' ? 'DELETE' : 'POST' });
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.error || `HTTP error! ${response.status}`);
+            }
+            if (!eventSource) fetchDownloads();
+        } catch (error) {
+            console.error(`Error performing ${action} on download:`, error);
+            alert(`Could not ${action} download: ${error.message}`);
         }
     }
 
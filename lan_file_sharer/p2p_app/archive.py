@@ -0,0 +1,174 @@
+# p2p_app/archive.py
+# Many shared files as one streamed tar or zip, built while it is sent: no
+# temporary file, and one request (one password check, one connection) for a
+# whole folder instead of one per file.
+#
+# Tar is the default: its size is known up front (so the response carries a
+# Content-Length) and each member is a header followed by the file's bytes.
+# Zip entries can be deflated one by one; files whose type is compressed
+# already are stored as they are.
+import logging
+import os
+import posixpath
+import tarfile
+import time
+import zipfile
+import zlib
+from . import compression
+from . import config
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("tar", "zip")
+CONTENT_TYPES = {"tar": "application/x-tar", "tar.gz": "application/gzip", "zip": "application/zip"}
+
+
+class Member:
+    """One file going into an archive: where to read it and the name it gets."""
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        st = os.stat(path)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+
+
+def member_names(names):
+    """Safe, unique archive names for the given file names, in order.
+
+    Absolute paths and ".." components are dropped so extracting can't write
+    outside the target folder; repeated names get " (2)", " (3)", ...
+    """
+    seen = set()
+    result = []
+    for name in names:
+        parts = [part for part in posixpath.normpath(name.replace("\\", "/")).split("/")
+                 if part not in ("", ".", "..")]
+        safe = "/".join(parts) or "file"
+        stem, ext = posixpath.splitext(safe)
+        candidate, n = safe, 1
+        while candidate in seen:
+            n += 1
+            candidate = f"{stem} ({n}){ext}"
+        seen.add(candidate)
+        result.append(candidate)
+    return result
+
+
+def _tar_header(member):
+    info = tarfile.TarInfo(member.name)
+    info.size = member.size
+    info.mtime = int(member.mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def _padding(size):
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+def tar_size(members):
+    """Exact byte length of the uncompressed tar of `members`."""
+    return sum(len(_tar_header(m)) + m.size + len(_padding(m.size)) for m in members) + 2 * tarfile.BLOCKSIZE
+
+
+def _iter_file(member):
+    # Exactly member.size bytes, as promised by the header: a file that
+    # shrank meanwhile is padded with zeros, one that grew is cut short
+    remaining = member.size
+    with open(member.path, "rb") as f:
+        while remaining:
+            block = f.read(min(config.ARCHIVE_READ_SIZE, remaining))
+            if not block:
+                logger.warning("Archive: %s shrank while being sent; padding %s bytes", member.path, remaining)
+                yield b"\0" * remaining
+                return
+            remaining -= len(block)
+            yield block
+
+
+def iter_tar(members, compress=False):
+    """Yield a tar of `members` (gzipped as a whole with `compress`)."""
+    gzip = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 31) if compress else None
+    for chunk in _iter_tar(members):
+        if gzip is None:
+            yield chunk
+        else:
+            chunk = gzip.compress(chunk)
+            if chunk:
+                yield chunk
+    if gzip is not None:
+        yield gzip.flush()
+
+
+def _iter_tar(members):
+    for member in members:
+        yield _tar_header(member)
+        yield from _iter_file(member)
+        padding = _padding(member.size)
+        if padding:
+            yield padding
+    yield b"\0" * (2 * tarfile.BLOCKSIZE)
+
+
+class _Sink:
+    """Write-only stream that collects what zipfile writes until it is drained."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Yield what was written since the last drain (nothing if that is nothing)."""
+        if self._parts:
+            data = b"".join(self._parts)
+            self._parts.clear()
+            yield data
+
+
+def should_deflate(name):
+    return not compression.is_precompressed(name)
+
+
+def iter_zip(members, compress=False):
+    """Yield a zip of `members`, deflating the entries worth it if `compress`.
+
+    The sink isn't seekable, so zipfile writes each entry's sizes and CRC in a
+    data descriptor after its data, and Zip64 records where needed.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+        for member in members:
+            info = zipfile.ZipInfo(member.name, time.localtime(max(member.mtime, 315532800))[:6])
+            info.file_size = member.size
+            info.external_attr = 0o644 << 16
+            if compress and should_deflate(member.name):
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, "w", force_zip64=member.size >= zipfile.ZIP64_LIMIT) as entry:
+                for block in _iter_file(member):
+                    entry.write(block)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def stream(members, fmt="tar", compress=False):
+    """(content type, Content-Length or None, chunk iterator) for an archive of `members`."""
+    if fmt == "zip":
+        return CONTENT_TYPES["zip"], None, iter_zip(members, compress)
+    if compress:
+        return CONTENT_TYPES["tar.gz"], None, iter_tar(members, compress=True)
+    return CONTENT_TYPES["tar"], tar_size(members), iter_tar(members)
+
+
+def file_extension(fmt, compress):
+    if fmt == "zip":
+        return ".zip"
+    return ".tar.gz" if compress else ".tar"
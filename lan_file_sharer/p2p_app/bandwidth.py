@@ -0,0 +1,324 @@
+# p2p_app/bandwidth.py
+# Bandwidth scheduling for file bodies, one Scheduler per direction:
+#   upload_scheduler   - bytes we serve to peers (/p2p/download_file, data server)
+#   download_scheduler - bytes we fetch from peers (downloads, swarm, proxy)
+#
+# A transfer is first admitted: each peer may run BANDWIDTH_PER_PEER_TRANSFERS
+# at once and the rest wait in that peer's queue. Small files (up to
+# BANDWIDTH_SMALL_FILE_SIZE) go ahead of queued large ones and may use
+# BANDWIDTH_PRIORITY_SLOTS extra slots, so they never wait behind a peer's
+# bulk transfers.
+#
+# Each slice of a body then takes its size in tokens from the direction's
+# token bucket, if that direction has a rate limit. When transfers are waiting
+# for tokens, the peer served the fewest bytes goes next (start-time fair
+# queuing), so every active peer gets an equal share of the cap however many
+# connections it opens. Small files still go first.
+import itertools
+import math
+import threading
+import time
+from . import config
+from . import metrics
+
+SMALL, LARGE = 0, 1  # Priority classes; lower goes first
+
+
+class TokenBucket:
+    """`rate` bytes per second, saving up at most `burst` bytes. A rate of 0 means no limit.
+
+    A take may overdraw the bucket; the next one then waits until the debt is
+    paid back, so slices larger than the burst still get through.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self):
+        """Seconds until the next take may go ahead (call refill() first)."""
+        if not self.rate or self.tokens > 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def take(self, count):
+        if self.rate:
+            self.tokens -= count
+
+
+class RateMeter:
+    """Byte rate averaged over roughly the last `window` seconds (exponential decay)."""
+
+    def __init__(self, window):
+        self.window = window
+        self._value = 0.0
+        self._updated = time.monotonic()
+
+    def _decay(self, now):
+        self._value *= math.exp(-(now - self._updated) / self.window)
+        self._updated = now
+
+    def add(self, count, now):
+        self._decay(now)
+        self._value += count
+
+    def rate(self, now):
+        self._decay(now)
+        return self._value / self.window
+
+
+class _PeerState:
+    def __init__(self):
+        self.active = 0
+        self.waiting = []  # (priority, seq) tickets of transfers waiting for a slot
+        self.served = 0  # Fair-queuing tag: bytes granted, relative to other active peers
+        self.bytes = 0
+        self.meter = RateMeter(config.BANDWIDTH_RATE_WINDOW)
+        self.last_active = time.monotonic()
+
+
+class Transfer:
+    """A transfer holding one of its peer's slots. close() (or leaving a `with` block) frees it."""
+
+    def __init__(self, scheduler, peer, size, priority):
+        self.scheduler = scheduler
+        self.peer = peer
+        self.size = size
+        self.priority = priority
+        self.closed = False
+
+    def throttle(self, count):
+        """Wait until `count` more bytes may move, and account for them."""
+        self.scheduler._throttle(self, count)
+
+    def close(self):
+        self.scheduler._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ThrottledBody:
+    """Response body that takes tokens for each chunk and frees its transfer on close().
+
+    WSGI servers call close() even when a body is never iterated, which a
+    generator's finally clause would miss.
+    """
+
+    def __init__(self, transfer, chunks, cost=len):
+        self._transfer = transfer
+        self._chunks = iter(chunks)
+        self._cost = cost  # bytes a chunk counts for
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = next(self._chunks)
+        self._transfer.throttle(self._cost(chunk))
+        return chunk
+
+    def close(self):
+        try:
+            close = getattr(self._chunks, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._transfer.close()
+
+
+class Scheduler:
+    """Admission and rate limiting for one direction of traffic."""
+
+    def __init__(self, name, rate, per_peer_limit, queue_limit=None):
+        self.name = name
+        self.per_peer_limit = per_peer_limit
+        self.queue_limit = queue_limit  # Waiting transfers per peer before new ones are refused
+        self._bucket = TokenBucket(rate, self._burst(rate))
+        self._cond = threading.Condition()
+        self._peers = {}
+        self._token_waiters = []  # (priority, seq, peer state) of transfers waiting for tokens
+        self._seq = itertools.count()
+        self._meter = RateMeter(config.BANDWIDTH_RATE_WINDOW)
+        self._bytes = 0
+        self._transfers = 0
+        self._refused = 0
+
+    @staticmethod
+    def _burst(rate):
+        return max(int(rate * config.BANDWIDTH_BURST), config.BANDWIDTH_SLICE_SIZE)
+
+    @property
+    def limit(self):
+        return self._bucket.rate
+
+    def set_limit(self, rate):
+        """Change the rate cap (bytes per second, 0 = unlimited) for running transfers too."""
+        with self._cond:
+            self._bucket.refill(time.monotonic())
+            self._bucket.rate = rate
+            self._bucket.burst = self._burst(rate)
+            self._bucket.tokens = min(self._bucket.tokens, self._bucket.burst)
+            self._cond.notify_all()
+
+    def _slots(self, priority):
+        return self.per_peer_limit + (config.BANDWIDTH_PRIORITY_SLOTS if priority == SMALL else 0)
+
+    def _prune(self, now):
+        idle = [peer for peer, state in self._peers.items()
+                if not state.active and not state.waiting
+                and now - state.last_active > config.BANDWIDTH_RATE_WINDOW * 6]
+        for peer in idle:
+            del self._peers[peer]
+
+    def admit(self, peer, size=None, timeout=None, stop_event=None):
+        """Wait for one of `peer`'s transfer slots.
+
+        `size` (bytes, if known) picks the priority class. Returns a Transfer,
+        or None if the peer's queue is full, `timeout` seconds pass or
+        `stop_event` is set first.
+        """
+        priority = SMALL if size is not None and size <= config.BANDWIDTH_SMALL_FILE_SIZE else LARGE
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._prune(time.monotonic())
+            state = self._peers.get(peer)
+            if state is None:
+                state = self._peers[peer] = _PeerState()
+            if self.queue_limit is not None and len(state.waiting) >= self.queue_limit:
+                self._refused += 1
+                return None
+            ticket = (priority, next(self._seq))
+            state.waiting.append(ticket)
+            try:
+                while min(state.waiting) != ticket or state.active >= self._slots(priority):
+                    wait = None if deadline is None else deadline - time.monotonic()
+                    if (wait is not None and wait <= 0) or (stop_event is not None and stop_event.is_set()):
+                        self._refused += 1
+                        return None
+                    if stop_event is not None:
+                        wait = 0.5 if wait is None else min(wait, 0.5)
+                    self._cond.wait(wait)
+            finally:
+                state.waiting.remove(ticket)
+                self._cond.notify_all()  # Someone else may be first in line now
+
+            if not state.active:
+                # A peer coming back starts level with the least-served active
+                # peer: idle time doesn't earn credit, past traffic isn't held against it
+                active = [other.served for other in self._peers.values() if other.active]
+                state.served = min(active) if active else 0
+            state.active += 1
+            state.last_active = time.monotonic()
+            self._transfers += 1
+            return Transfer(self, peer, size, priority)
+
+    def _release(self, transfer):
+        with self._cond:
+            if transfer.closed:
+                return
+            transfer.closed = True
+            state = self._peers[transfer.peer]
+            state.active -= 1
+            state.last_active = time.monotonic()
+            self._cond.notify_all()
+
+    def _throttle(self, transfer, count):
+        with self._cond:
+            state = self._peers[transfer.peer]
+            if self._bucket.rate:
+                waiter = (transfer.priority, next(self._seq), state)
+                self._token_waiters.append(waiter)
+                try:
+                    while True:
+                        self._bucket.refill(time.monotonic())
+                        head = min(self._token_waiters, key=lambda w: (w[0], w[2].served, w[1]))
+                        if head is waiter:
+                            delay = self._bucket.wait_time()
+                            if not delay:
+                                break
+                        else:
+                            delay = None  # Woken when the head takes its tokens
+                        self._cond.wait(delay)
+                finally:
+                    self._token_waiters.remove(waiter)
+                    self._cond.notify_all()
+                self._bucket.take(count)
+            now = time.monotonic()
+            state.served += count
+            state.bytes += count
+            state.meter.add(count, now)
+            state.last_active = now
+            self._bytes += count
+            self._meter.add(count, now)
+        bytes_total.inc(self.name, transfer.peer, amount=count)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._cond:
+            self._prune(now)
+            peers = {
+                peer: {
+                    "active": state.active,
+                    "queued": len(state.waiting),
+                    "bytes": state.bytes,
+                    "rate": round(state.meter.rate(now)),
+                }
+                for peer, state in self._peers.items()
+            }
+            return {
+                "limit": self._bucket.rate,
+                "rate": round(self._meter.rate(now)),
+                "bytes": self._bytes,
+                "active": sum(peer["active"] for peer in peers.values()),
+                "queued": sum(peer["queued"] for peer in peers.values()),
+                "transfers": self._transfers,
+                "refused": self._refused,
+                "peers": peers,
+            }
+
+
+upload_scheduler = Scheduler(
+    "upload", config.UPLOAD_RATE_LIMIT, config.BANDWIDTH_PER_PEER_TRANSFERS,
+    queue_limit=config.BANDWIDTH_PER_PEER_QUEUE,  # Queued uploads hold server workers
+)
+download_scheduler = Scheduler("download", config.DOWNLOAD_RATE_LIMIT, config.BANDWIDTH_PER_PEER_TRANSFERS)
+
+
+def _transfer_counts():
+    counts = {}
+    for scheduler in (upload_scheduler, download_scheduler):
+        stats = scheduler.stats()
+        counts[(scheduler.name, "active")] = stats["active"]
+        counts[(scheduler.name, "queued")] = stats["queued"]
+    return counts
+
+
+bytes_total = metrics.counter(
+    "transfer_bytes_total", "File body bytes sent (upload) or received (download), by peer.", ("direction", "peer"))
+metrics.gauge("transfers", "Transfers running or waiting for a slot.", ("direction", "state"), collect=_transfer_counts)
+metrics.counter(
+    "transfers_refused_total", "Uploads refused because the peer's queue was full.", ("direction",),
+    collect=lambda: {scheduler.name: scheduler.stats()["refused"] for scheduler in (upload_scheduler, download_scheduler)})
+
+
+def get_stats():
+    return {"upload": upload_scheduler.stats(), "download": download_scheduler.stats()}
+
+
+def set_limits(upload=None, download=None):
+    """Change the global caps (bytes per second, 0 = unlimited); None leaves one as it is."""
+    if upload is not None:
+        upload_scheduler.set_limit(upload)
+    if download is not None:
+        download_scheduler.set_limit(download)
@@ -0,0 +1,149 @@
+# p2p_app/blobstore.py
+# Content-addressed store for uploaded files. An upload is written straight
+# into a temporary file inside the store and hashed as the bytes arrive; once
+# complete it is renamed to <BLOB_DIR>/<first two hex digits>/<sha256>, or
+# dropped if that blob is already there. Each share of a blob holds one
+# reference, and the blob is deleted when the last one is released.
+#
+# References are kept in memory. At startup the shares restored from the share
+# index acquire() theirs again, then sweep() removes blobs nothing has claimed
+# and uploads that never finished.
+import logging
+import os
+import threading
+import uuid
+from . import config
+from . import hashing
+
+logger = logging.getLogger(__name__)
+
+_refs = {}  # content hash -> references held
+_lock = threading.Lock()
+
+
+def blob_path(content_hash):
+    return os.path.join(config.BLOB_DIR, content_hash[:2], content_hash)
+
+
+def blob_hash(path):
+    """Content hash of the blob stored at `path`, or None if `path` is not a blob."""
+    name = os.path.basename(path)
+    if len(name) == 64 and os.path.abspath(path) == blob_path(name):
+        return name
+    return None
+
+
+def new_temp_path():
+    """Somewhere to assemble an upload before commit_file() moves it into the store."""
+    os.makedirs(config.BLOB_TEMP_DIR, exist_ok=True)
+    return os.path.join(config.BLOB_TEMP_DIR, f"{uuid.uuid4().hex}.part")
+
+
+def commit_file(temp_path, entry):
+    """Move a finished upload hashed to `entry` into the store and take a reference.
+
+    If the blob is stored already the upload is deleted instead. Returns the
+    blob's path.
+    """
+    path = blob_path(entry["sha256"])
+    with _lock:
+        if os.path.exists(path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        # Sharing the blob then finds its hash without reading it again
+        hashing.store(os.stat(path), entry)
+        _refs[entry["sha256"]] = _refs.get(entry["sha256"], 0) + 1
+    return path
+
+
+class BlobWriter:
+    """Writable stream that stores what it is fed as a blob.
+
+    commit() files the data under its content hash and takes a reference to
+    the blob; close() without commit() throws the data away.
+    """
+
+    def __init__(self):
+        self._temp_path = new_temp_path()
+        self._file = open(self._temp_path, "w+b")
+        self._hasher = hashing.StreamHasher()
+        self.content_hash = None
+        self.path = None
+
+    def write(self, data):
+        self._file.write(data)
+        self._hasher.update(data)
+        return len(data)
+
+    # Werkzeug rewinds the stream once the upload is parsed, and FileStorage
+    # may read it back
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def commit(self):
+        """Move the data into the store and take a reference. Returns the blob's path."""
+        if self.path is not None:
+            return self.path
+        self._file.close()
+        entry = self._hasher.finish()
+        self.path = commit_file(self._temp_path, entry)
+        self.content_hash = entry["sha256"]
+        return self.path
+
+    def close(self):
+        if self.path is not None or self._file.closed:
+            return
+        self._file.close()
+        try:
+            os.remove(self._temp_path)
+        except FileNotFoundError:
+            pass
+
+
+def acquire(content_hash):
+    """Take a reference to a stored blob (a share restored at startup)."""
+    with _lock:
+        _refs[content_hash] = _refs.get(content_hash, 0) + 1
+
+
+def release(content_hash):
+    """Drop one reference to a blob, deleting it with the last one."""
+    with _lock:
+        count = _refs.get(content_hash, 0) - 1
+        if count > 0:
+            _refs[content_hash] = count
+            return
+        _refs.pop(content_hash, None)
+        path = blob_path(content_hash)
+        try:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))  # Only succeeds once the directory is empty
+        except OSError:
+            pass
+
+
+def sweep():
+    """Delete unfinished uploads and blobs nothing references. Returns the bytes freed."""
+    freed = 0
+    with _lock:
+        if not os.path.isdir(config.BLOB_DIR):
+            return 0
+        for root, _dirs, files in os.walk(config.BLOB_DIR):
+            for name in files:
+                path = os.path.join(root, name)
+                if root != config.BLOB_TEMP_DIR and _refs.get(blob_hash(path)):
+                    continue
+                try:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning("Could not remove unused upload %s: %s", path, e)
+    return freed
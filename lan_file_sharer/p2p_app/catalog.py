@@ -0,0 +1,314 @@
+# p2p_app/catalog.py
+# Network-wide file catalog: every known peer's listing, fetched concurrently,
+# cached with a TTL and refreshed in the background while someone is browsing.
+import heapq
+import logging
+import threading
+import time
+import urllib.parse
+from . import config
+from . import discovery
+from . import file_handler
+from . import peer_client
+
+logger = logging.getLogger(__name__)
+
+# Cached listings of other peers
+# Key: (address, port), Value: dict {files, version, fetched_at, error}
+# `version` is the peer's catalog version the listing matches (None for peers
+# that don't version their listing), so refreshes only ask for changes.
+peer_listings = {}
+_catalog_lock = threading.Lock()
+_refresh_lock = threading.Lock()  # Only one refresh runs at a time
+_last_requested = 0.0
+_refresher_started = False
+
+
+def _known_peers():
+    return {(peer.address, peer.port): peer for peer in list(discovery.discovered_peers.values())}
+
+
+def _is_file_list(files):
+    return isinstance(files, list) and all(isinstance(meta, dict) and isinstance(meta.get("id"), str) for meta in files)
+
+
+def _apply_listing(entry, result):
+    """Update a cached listing from a /p2p/list_files reply. Returns False if malformed."""
+    if result is None:
+        return True  # 304: nothing changed since entry["version"]
+    if isinstance(result, list):
+        if not _is_file_list(result):
+            return False
+        entry.update({"files": result, "version": None})  # Peer without versioned listings
+        return True
+    if not isinstance(result, dict) or "version" not in result:
+        return False
+    if result.get("full") or "next" in result:
+        files = result.get("files", [])
+        if not _is_file_list(files):
+            return False
+    else:
+        added = result.get("added", [])
+        removed = result.get("removed", [])
+        if not _is_file_list(added) or not isinstance(removed, list) \
+                or not all(isinstance(file_id, str) for file_id in removed):
+            return False
+        changed = {meta["id"] for meta in added} | set(removed)
+        files = [meta for meta in entry["files"] if meta.get("id") not in changed]
+        files.extend(added)
+    entry.update({"files": files, "version": result["version"]})
+    return True
+
+
+def refresh(targets=None):
+    """Fetch /p2p/list_files from `targets` (default: every discovered peer) at once.
+
+    Peers we already hold a versioned listing for are asked only for what
+    changed since (and answer 304 if nothing did). The others send their
+    listing in pages of LISTING_PAGE_SIZE, fetched from all of them at once.
+    A listing is tagged with the version of its first page, so anything that
+    changed while the later pages were read comes in with the next refresh.
+    """
+    peers = _known_peers()
+    targets = list(peers) if targets is None else list(targets)
+    with _refresh_lock:
+        with _catalog_lock:
+            versions = {key: peer_listings[key]["version"] for key in targets
+                        if key in peer_listings and peer_listings[key]["version"] is not None}
+
+        def listing_path(target):
+            if target in versions:
+                return f"/p2p/list_files?since={versions[target]}"
+            return f"/p2p/list_files?limit={config.LISTING_PAGE_SIZE}"
+
+        def listing_headers(target):
+            if target in versions:
+                return {"If-None-Match": file_handler.catalog_etag(versions[target])}
+            return None
+
+        results = peer_client.fan_out_json(targets, listing_path, config.CATALOG_PEER_TIMEOUT, listing_headers)
+        _fetch_remaining_pages(results)
+        now = time.time()
+        with _catalog_lock:
+            for target, (result, error) in results.items():
+                entry = peer_listings.setdefault(target, {"files": [], "version": None, "fetched_at": 0.0, "error": None})
+                if error is None and _apply_listing(entry, result):
+                    entry.update({"fetched_at": now, "error": None})
+                else:
+                    # Keep serving the last good listing, but say it is stale
+                    entry["error"] = repr(error) if error is not None else "Unexpected listing format"
+            for gone in [key for key in peer_listings if key not in peers]:
+                del peer_listings[gone]
+
+
+def _fetch_remaining_pages(results):
+    """Follow `next` in the paged listings among `results`, merging the pages into the first."""
+    paging = {target: result for target, (result, error) in results.items()
+              if error is None and isinstance(result, dict) and result.get("next")}
+    while paging:
+        cursors = {target: result["next"] for target, result in paging.items()}
+        pages = peer_client.fan_out_json(
+            list(paging),
+            lambda target: f"/p2p/list_files?after={urllib.parse.quote(cursors[target])}&limit={config.LISTING_PAGE_SIZE}",
+            config.CATALOG_PEER_TIMEOUT)
+        for target, (page, error) in pages.items():
+            result = paging.pop(target)
+            if error is not None or not isinstance(page, dict) or not isinstance(page.get("files"), list):
+                results[target] = (None, error or ValueError("Unexpected listing page"))
+                continue
+            result["files"].extend(page["files"])
+            result["next"] = page.get("next")
+            if result["next"]:
+                paging[target] = result
+
+
+def _stale_targets(max_age):
+    """Peers whose listing needs fetching.
+
+    A peer that announces its catalog version in discovery beacons is only
+    refetched once that version differs from the listing we hold; others
+    (and peers whose last fetch failed) fall back to `max_age`.
+    """
+    now = time.time()
+    stale = []
+    with _catalog_lock:
+        for key, peer in _known_peers().items():
+            entry = peer_listings.get(key)
+            if entry is None:
+                stale.append(key)
+            elif peer.catalog_version is not None and entry["version"] is not None and entry["error"] is None:
+                if peer.catalog_version != entry["version"]:
+                    stale.append(key)
+            elif now - entry["fetched_at"] > max_age:
+                stale.append(key)
+    return stale
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(config.CATALOG_REFRESH_INTERVAL)
+        if time.time() - _last_requested > config.CATALOG_IDLE_STOP:
+            continue  # Nobody is browsing; don't poll the network
+        stale = _stale_targets(config.CATALOG_REFRESH_INTERVAL)
+        if stale:
+            try:
+                refresh(stale)
+            except Exception as e:  # Keep the refresher alive whatever a peer sends
+                logger.warning("Error refreshing network catalog: %s", e)
+
+
+def _ensure_refresher():
+    global _refresher_started
+    with _catalog_lock:
+        if _refresher_started:
+            return
+        _refresher_started = True
+    threading.Thread(target=_refresh_loop, name="catalog-refresh", daemon=True).start()
+
+
+def merge_listings():
+    """Group every cached listing by content hash (or by peer and ID while unhashed)."""
+    peers = _known_peers()
+    groups = {}
+    peer_summaries = []
+    with _catalog_lock:
+        listings = {key: dict(entry) for key, entry in peer_listings.items()}
+    for (address, port), entry in listings.items():
+        peer = peers.get((address, port))
+        username = peer.username if peer else None
+        peer_summaries.append({
+            "address": address,
+            "port": port,
+            "username": username,
+            "file_count": len(entry["files"]),
+            "version": entry["version"],
+            "fetched_at": entry["fetched_at"],
+            "error": entry["error"],
+        })
+        for meta in entry["files"]:
+            _add_source(groups, address, port, username, meta)
+    files = sorted(groups.values(), key=lambda g: ((g["name"] or "").lower(), g["hash"] or ""))
+    for group in files:
+        _summarize(group)
+    return {"generated_at": time.time(), "peers": peer_summaries, "files": files}
+
+
+def _add_source(groups, address, port, username, meta):
+    """File `meta` of a peer's listing into `groups` (by content hash, or by peer and ID while unhashed)."""
+    key = meta.get("hash") or f"{address}:{port}/{meta.get('id')}"
+    group = groups.get(key)
+    if group is None:
+        group = groups[key] = {
+            "hash": meta.get("hash"),
+            "name": meta.get("name"),
+            "size": meta.get("size"),
+            "sources": [],
+        }
+    group["sources"].append({
+        "address": address,
+        "port": port,
+        "username": username,
+        "id": meta.get("id"),
+        "name": meta.get("name"),
+        "has_password": bool(meta.get("has_password")),
+    })
+    return group
+
+
+def _summarize(group):
+    group["source_count"] = len(group["sources"])
+    # A file is open if at least one source shares it without a password
+    group["has_password"] = all(src["has_password"] for src in group["sources"])
+    return group
+
+
+def _search_rank(group):
+    # Best score first; among equals, files more peers hold (faster to fetch)
+    return (-group["score"], -len(group["sources"]), (group["name"] or "").lower())
+
+
+def iter_search(query, limit):
+    """Run a filename search on every discovered peer at once, yielding the merged results as they come in.
+
+    Each update is {query, results, answered, failed, total, truncated,
+    done}: the best `limit` files so far, grouped by content hash like the
+    catalog and ranked by the best score any peer gave them. Updates come at
+    most every SEARCH_UPDATE_INTERVAL; the last one has done=True. A peer
+    without /p2p/search, or that doesn't answer within SEARCH_PEER_TIMEOUT,
+    counts as failed.
+    """
+    peers = _known_peers()
+    path = f"/p2p/search?q={urllib.parse.quote(query)}&limit={limit}"
+    groups = {}
+    progress = {"answered": 0, "failed": 0, "truncated": False}
+    last_update = 0.0
+
+    def update(done):
+        best = heapq.nsmallest(limit, groups.values(), key=_search_rank)
+        results = [_summarize(dict(group)) for group in best]
+        return dict(progress, query=query, results=results, total=len(peers), done=done)
+
+    for (address, port), reply, error in peer_client.iter_fan_out_json(peers, path, config.SEARCH_PEER_TIMEOUT):
+        if error is not None or not isinstance(reply, dict) or not isinstance(reply.get("results"), list):
+            progress["failed"] += 1
+            continue
+        progress["answered"] += 1
+        progress["truncated"] = progress["truncated"] or bool(reply.get("truncated"))
+        username = peers[(address, port)].username
+        for meta in reply["results"]:
+            if not isinstance(meta, dict):
+                continue
+            group = _add_source(groups, address, port, username, meta)
+            score = meta.get("score") if isinstance(meta.get("score"), (int, float)) else 0
+            group["score"] = max(group.get("score", score), score)
+        if time.monotonic() - last_update >= config.SEARCH_UPDATE_INTERVAL:
+            last_update = time.monotonic()
+            yield update(False)
+    yield update(True)
+
+
+def find_holders(content_hash):
+    """[(address, port, file_meta)] of the discovered peers whose listing has `content_hash`.
+
+    Answered from the cached listings; only peers never fetched, or that
+    announced a new catalog version, are asked first (and then only for
+    what changed), so a lookup costs next to nothing on a steady network.
+    Peers whose last fetch failed are left out.
+    """
+    outdated = _stale_targets(float("inf"))
+    if outdated:
+        refresh(outdated)
+    peers = _known_peers()
+    holders = []
+    with _catalog_lock:
+        for key, entry in peer_listings.items():
+            if key not in peers or entry["error"] is not None:
+                continue
+            for meta in entry["files"]:
+                if isinstance(meta, dict) and meta.get("hash") == content_hash:
+                    holders.append((*key, meta))
+                    break
+    return holders
+
+
+def get_catalog(force_refresh=False):
+    """Merged catalog of all peers.
+
+    Peers never fetched, or that announced a new catalog version (all of
+    them, with force_refresh), are queried before answering; unversioned
+    listings past their TTL are served from cache while a background
+    refresh is kicked off.
+    """
+    global _last_requested
+    _last_requested = time.time()
+    _ensure_refresher()
+
+    outdated = _stale_targets(float("inf"))
+    if force_refresh:
+        refresh()
+    elif outdated:
+        refresh(outdated)
+    stale = _stale_targets(config.CATALOG_TTL)
+    if stale and not force_refresh and not _refresh_lock.locked():
+        threading.Thread(target=refresh, args=(stale,), daemon=True).start()
+    return merge_listings()
@@ -1,20 +1,95 @@
 # p2p_app/comms.py
-# For now, this file can be minimal.
-# We'll define message structures or classes here if they become complex.
-
-# Example:
-# class Message:
-#     def __init__(self, type, payload):
-#         self.type = type
-#         self.payload = payload
-
-#     def to_json(self):
-#         import json
-#         return json.dumps(self.__dict__)
-
-#     @staticmethod
-#     def from_json(json_str):
-#         import json
-#         data = json.loads(json_str)
-#         return Message(data['type'], data['payload'])
-pass
+# Wire formats for messages that don't go over HTTP: the discovery beacon.
+#
+# Beacons are a fixed binary header followed by the UTF-8 username:
+#
+#   magic "LFS" | format version (B) | server port (H) | data port (H, 0 = none)
+#   | beacon interval in deciseconds (H) | catalog version (Q, 0 = unknown)
+#   | IPv4 address (4s, 0.0.0.0 = use the sender address) | username length (B)
+#   | username | node ID (16s, since version 2)
+#
+# The node ID is random per run and the same in every copy of a beacon, so a
+# node that beacons on several interfaces is still recognised as one peer.
+# Later format versions may only append fields after the username, so every
+# reader can decode the part it knows. The JSON beacons sent by older builds
+# are still accepted.
+import json
+import socket
+import struct
+
+BEACON_MAGIC = b"LFS"
+BEACON_VERSION = 2
+_BEACON_HEADER = struct.Struct("!3sBHHHQ4sB")
+NODE_ID_BYTES = 16
+MAX_USERNAME_BYTES = 255
+
+
+class MalformedBeacon(ValueError):
+    pass
+
+
+def encode_beacon(username, port, ip=None, data_port=None, catalog_version=None, interval=None, node_id=None):
+    # Cut on a character boundary so the name still decodes
+    name = username.encode("utf-8")[:MAX_USERNAME_BYTES].decode("utf-8", errors="ignore").encode("utf-8")
+    try:
+        packed_ip = socket.inet_aton(ip) if ip else b"\0\0\0\0"
+    except OSError:
+        packed_ip = b"\0\0\0\0"
+    header = _BEACON_HEADER.pack(
+        BEACON_MAGIC, BEACON_VERSION, port, data_port or 0,
+        min(int((interval or 0) * 10), 0xFFFF), catalog_version or 0,
+        packed_ip, len(name),
+    )
+    return header + name + (bytes.fromhex(node_id) if node_id else bytes(NODE_ID_BYTES))
+
+
+def decode_beacon(data, sender_address):
+    """Decode a beacon into {type, username, port, ip, data_port, catalog_version, interval, node_id}.
+
+    Raises MalformedBeacon for anything that is not a beacon we understand.
+    """
+    if data[:1] == b"{":
+        return _decode_json_beacon(data, sender_address)
+    if len(data) < _BEACON_HEADER.size or data[:3] != BEACON_MAGIC:
+        raise MalformedBeacon("Not a discovery beacon")
+    magic, version, port, data_port, interval, catalog_version, packed_ip, name_length = \
+        _BEACON_HEADER.unpack_from(data)
+    name = data[_BEACON_HEADER.size:_BEACON_HEADER.size + name_length]
+    if version < 1 or len(name) != name_length or not port:
+        raise MalformedBeacon("Truncated or invalid beacon")
+    ip = socket.inet_ntoa(packed_ip)
+    node_id = None
+    if version >= 2:
+        packed_id = data[_BEACON_HEADER.size + name_length:_BEACON_HEADER.size + name_length + NODE_ID_BYTES]
+        if len(packed_id) != NODE_ID_BYTES:
+            raise MalformedBeacon("Truncated or invalid beacon")
+        node_id = packed_id.hex() if any(packed_id) else None
+    return {
+        "type": "discovery",
+        "username": name.decode("utf-8", errors="replace"),
+        "port": port,
+        "ip": sender_address if ip == "0.0.0.0" else ip,
+        "data_port": data_port or None,
+        "catalog_version": catalog_version or None,
+        "interval": interval / 10 if interval else None,
+        "node_id": node_id,
+    }
+
+
+def _decode_json_beacon(data, sender_address):
+    try:
+        message = json.loads(data.decode("utf-8"))
+    except ValueError:
+        raise MalformedBeacon("Invalid JSON beacon")
+    if not isinstance(message, dict) or message.get("type") != "discovery":
+        raise MalformedBeacon("Not a discovery beacon")
+    return {
+        "type": "discovery",
+        "username": message.get("username"),
+        "port": message.get("port"),
+        "ip": message.get("ip") or sender_address,
+        "data_port": message.get("data_port"),
+        "catalog_version": message.get("catalog_version"),
+        "interval": None,
+        "node_id": None,
+    }
@@ -0,0 +1,149 @@
+# p2p_app/compression.py
+# On-the-wire compression of file bodies sent to peers, negotiated through
+# Accept-Encoding: zstd when both sides have the zstandard module, gzip
+# otherwise.
+#
+# Whether a file is worth it is decided once per content (by ETag): types that
+# are compressed already are skipped by name, anything else by compressing a
+# few samples spread over the file at a fast level. Logs, CSVs and source
+# dumps shrink several times over; photos and videos go out as they are.
+#
+# Every chunk is compressed and flushed on its own, so the receiver decodes
+# and writes each one as it arrives. Ranges work as before: Range,
+# Content-Range and the ETag count the file's own bytes, and the encoding only
+# covers what travels on the wire. The compressed length isn't known up front,
+# so those replies carry the decoded length in X-Uncompressed-Length instead
+# of a Content-Length.
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from . import config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codings this node can produce and decode, most preferred first
+ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+ACCEPT_ENCODING = ", ".join(ENCODINGS)  # sent with requests to peers
+UNCOMPRESSED_LENGTH = "X-Uncompressed-Length"
+
+# Compressing these again costs CPU and saves nothing
+COMPRESSED_SUFFIXES = {
+    ".7z", ".aac", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jpeg", ".jpg",
+    ".m4a", ".m4v", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".opus", ".png", ".pptx", ".rar",
+    ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst",
+}
+
+_VERDICT_CACHE_SIZE = 4096
+_verdicts = OrderedDict()  # ETag -> worth compressing (bool)
+_verdicts_lock = threading.Lock()
+
+
+def is_precompressed(name):
+    return os.path.splitext(name)[1].lower() in COMPRESSED_SUFFIXES
+
+
+def choose_encoding(accept_encoding):
+    """The coding to use for a request's Accept-Encoding header, or None for identity."""
+    if not config.COMPRESSION_ENABLED or not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            weights[coding] = q
+    best = None
+    for coding in ENCODINGS:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (coding, q)
+    return best[0] if best else None
+
+
+def _sample_ratio(path, size):
+    # Compressed size over original size of a few samples spread over the file
+    sample_size = config.COMPRESSION_SAMPLE_SIZE
+    count = max(1, min(config.COMPRESSION_SAMPLES, size // sample_size))
+    step = (size - sample_size) // max(count - 1, 1) if size > sample_size else 0
+    original = compressed = 0
+    with open(path, "rb") as f:
+        for i in range(count):
+            f.seek(i * step)
+            sample = f.read(sample_size)
+            original += len(sample)
+            compressed += len(zlib.compress(sample, 1))
+    return compressed / original if original else 1.0
+
+
+def worth_compressing(path, name, key=None):
+    """Whether the file at `path` shrinks enough to be compressed; remembered per `key` (its ETag)."""
+    if is_precompressed(name):
+        return False
+    if key is not None:
+        with _verdicts_lock:
+            verdict = _verdicts.get(key)
+            if verdict is not None:
+                _verdicts.move_to_end(key)
+                return verdict
+    try:
+        verdict = _sample_ratio(path, os.path.getsize(path)) < config.COMPRESSION_MAX_RATIO
+    except OSError:
+        return False
+    if key is not None:
+        with _verdicts_lock:
+            _verdicts[key] = verdict
+            while len(_verdicts) > _VERDICT_CACHE_SIZE:
+                _verdicts.popitem(last=False)
+    return verdict
+
+
+def negotiate(path, name, headers, accept_encoding):
+    """Pick the coding for a planned file body and adjust its `headers` to match.
+
+    `headers` are those of transfer.plan_file_segments(). Returns the coding,
+    or None when the body goes out as it is (headers then only gain Vary).
+    """
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None:
+        return None
+    headers["Vary"] = "Accept-Encoding"
+    if headers["Content-Type"].startswith("multipart/") \
+            or int(headers["Content-Length"]) < config.COMPRESSION_MIN_SIZE \
+            or not worth_compressing(path, name, headers.get("ETag")):
+        return None
+    headers["Content-Encoding"] = encoding
+    headers[UNCOMPRESSED_LENGTH] = headers.pop("Content-Length")
+    return encoding
+
+
+def _compressor(encoding):
+    # (compress, flush) for one stream; flush() ends a chunk the receiver can decode
+    if encoding == "zstd":
+        stream = zstandard.ZstdCompressor(level=config.COMPRESSION_ZSTD_LEVEL).compressobj()
+        return stream.compress, lambda: stream.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), stream.flush
+    stream = zlib.compressobj(config.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip wrapper
+    return stream.compress, lambda: stream.flush(zlib.Z_SYNC_FLUSH), stream.flush
+
+
+def iter_compressed(chunks, encoding):
+    """Yield `chunks` encoded with `encoding`, each flushed so it decodes on arrival."""
+    compress, flush, finish = _compressor(encoding)
+    for chunk in chunks:
+        data = compress(chunk) + flush()
+        if data:
+            yield data
+    data = finish()
+    if data:
+        yield data
@@ -1,12 +1,163 @@
 # p2p_app/config.py
+import os
 import socket
 
 MULTICAST_ADDRESS = "239.255.255.250"  # Example multicast address
 MULTICAST_PORT = 19000  # Port for multicast discovery
 SERVER_PORT = 19001  # Default port for the P2P server
-BUFFER_SIZE = 1024
-BROADCAST_INTERVAL = 5  # seconds
-PEER_TIMEOUT = 30  # seconds
+DATA_PORT_OFFSET = 100  # The sendfile data server listens near SERVER_PORT + this
+BUFFER_SIZE = 2048  # largest discovery datagram we read (a beacon is under 300 bytes)
+BROADCAST_INTERVAL = 5  # seconds; shortest interval between beacons
+MAX_BROADCAST_INTERVAL = 60  # seconds; longest, however large the LAN
+BEACON_TARGET_RATE = 50  # beacons per second across the whole LAN; intervals stretch to stay near it
+BEACON_JITTER = 0.5  # each interval is randomised by up to +/- this fraction
+MIN_ANNOUNCE_INTERVAL = 1  # seconds; an early beacon after a file list change waits at least this long
+PEER_TIMEOUT = 30  # seconds; minimum time a peer stays listed without a beacon
+BEACON_MISSES_BEFORE_TIMEOUT = 3  # beacons a peer may miss (at its announced interval) before it is dropped
+DISCOVERY_RECEIVE_BUFFER = 1024 * 1024  # socket receive buffer for beacons, bytes
+MULTICAST_TTL = int(os.environ.get("LFS_MULTICAST_TTL", 1))  # >1 only where routers forward multicast
+# Interface addresses to beacon on, comma-separated; empty means every IPv4 interface
+MULTICAST_INTERFACES = [ip.strip() for ip in os.environ.get("LFS_MULTICAST_INTERFACES", "").split(",") if ip.strip()]
+
+# Peer exchange (PEX): peers swap known-peer tables over HTTP, reaching
+# subnets multicast doesn't. Seeds are "host:port" of any node's main server.
+PEX_SEEDS = [seed.strip() for seed in os.environ.get("LFS_SEEDS", "").split(",") if seed.strip()]
+PEX_INTERVAL = 30  # seconds between gossip rounds (jittered)
+PEX_FANOUT = 3  # peers contacted per round
+PEX_MAX_PEERS_PER_REPLY = 64  # peers sent per exchange (a random sample beyond that)
+PEX_MAX_AGE = 180  # seconds; entries not heard from first-hand for longer are not passed on
+PEX_TIMEOUT = 3  # seconds per exchange
+
+# HTTP serving. "pooled" runs the app on bounded worker pools (serving.py);
+# "dev" is Flask's development server, one thread per connection.
+SERVER_BACKEND = os.environ.get("LFS_SERVER_BACKEND", "pooled")
+SERVER_POOL_SIZES = {"control": 16, "bulk": 8, "stream": 16}  # worker threads per traffic class
+SERVER_POOL_BACKLOG = 4  # requests queued per worker before new ones get 503
+SERVER_MAX_CONNECTIONS = 512  # open connections, idle keep-alive ones included
+SERVER_KEEPALIVE_TIMEOUT = 60  # seconds an idle keep-alive connection is kept open
+SERVER_SOCKET_TIMEOUT = 30  # seconds a read or write may stall within a request
+SERVER_SHUTDOWN_TIMEOUT = 10  # seconds in-flight requests get to finish on shutdown
+SERVER_MAX_DRAIN = 64 * 1024  # unread request body bytes skipped to keep a connection alive
+DATA_SERVER_MAX_CONNECTIONS = 64  # open connections to the data server (one thread each)
+
+# Bandwidth scheduling (bandwidth.py). Caps are bytes per second, 0 = unlimited.
+UPLOAD_RATE_LIMIT = int(os.environ.get("LFS_UPLOAD_LIMIT", 0))  # file bodies served to peers
+DOWNLOAD_RATE_LIMIT = int(os.environ.get("LFS_DOWNLOAD_LIMIT", 0))  # file bodies fetched from peers
+BANDWIDTH_BURST = 0.25  # seconds of traffic a capped direction may save up
+BANDWIDTH_SLICE_SIZE = 256 * 1024  # bytes sent per sendfile call when throttling
+BANDWIDTH_PER_PEER_TRANSFERS = 2  # transfers one peer may run at once, per direction
+BANDWIDTH_PRIORITY_SLOTS = 2  # extra per-peer transfers only small files may use
+BANDWIDTH_SMALL_FILE_SIZE = 1024 * 1024  # transfers up to this size get priority
+BANDWIDTH_PER_PEER_QUEUE = 4  # uploads a peer may have waiting for a slot; more get 503
+BANDWIDTH_QUEUE_TIMEOUT = 30  # seconds an upload or proxied download waits for a slot
+PEER_BUSY_RETRIES = 5  # times a download waits out a peer's 503 before failing
+PEER_BUSY_MAX_WAIT = 30  # seconds at most waited for one Retry-After
+BANDWIDTH_RATE_WINDOW = 5  # seconds averaged in the live throughput figures
+
+# Where files fetched from peers are written (partial files keep a .part suffix)
+DOWNLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'downloads'))
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # bytes read from a peer per write to disk
+
+# Delta downloads (delta.py): an older copy in DOWNLOAD_DIR with the same name
+# is used as the basis, so only the changed parts of a new version travel
+DELTA_ENABLED = os.environ.get("LFS_DELTA", "1") != "0"
+DELTA_MIN_BLOCK_SIZE = 2 * 1024
+DELTA_MAX_BLOCK_SIZE = 128 * 1024
+DELTA_MAX_BLOCKS = 1 << 20  # block size doubles past this many blocks (bounds the signature upload)
+DELTA_ROLL_BUDGET = 8 * 1024 * 1024  # bytes the sender scans byte by byte before only trying aligned blocks
+DELTA_READ_SIZE = 4 * 1024 * 1024  # sender's read window
+DELTA_LITERAL_CHUNK = 256 * 1024  # literal data is sent in pieces of at most this
+MAX_CONCURRENT_DOWNLOADS = 3  # download jobs running at once; the rest wait in the queue
+
+# Files uploaded through the UI, stored once per content hash (blobstore.py)
+UPLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'uploads'))
+BLOB_DIR = os.path.join(UPLOAD_DIR, 'blobs')
+BLOB_TEMP_DIR = os.path.join(BLOB_DIR, 'tmp')  # uploads still arriving
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # chunk size suggested to chunked-upload clients
+UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024  # largest chunk one PUT may carry
+UPLOAD_MAX_SESSIONS = 64  # unfinished chunked uploads at once
+UPLOAD_SESSION_TIMEOUT = 24 * 3600  # seconds an upload may go without chunks before it is dropped
+
+# Local state that should survive restarts (hash cache, indexes, ...)
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'data'))
+HASH_CACHE_PATH = os.path.join(DATA_DIR, 'hash_cache.json')
+HASH_WORKERS = 2  # Background threads hashing newly shared files
+HASH_READ_SIZE = 1024 * 1024  # bytes per read while hashing
+MANIFEST_DIR = os.path.join(DATA_DIR, 'manifests')  # chunk hash lists, one per content hash
+MANIFEST_CHUNK_SIZE = 4 * 1024 * 1024  # bytes covered by one chunk hash
+CHUNK_VERIFY_RETRIES = 3  # times a download re-fetches a chunk that failed verification
+
+# Files fetched from peers through the download proxy are kept here, by content
+# hash, and served from disk next time (content_cache.py). Least recently used
+# files are evicted beyond CACHE_MAX_BYTES; 0 turns the cache off.
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+CACHE_MAX_BYTES = int(os.environ.get("LFS_CACHE_SIZE", 2 * 1024 ** 3))
+CACHE_ADVERTISE = os.environ.get("LFS_CACHE_ADVERTISE", "1") != "0"  # list cached files to peers as mirrors
+
+# What this node shares (share_index.py): single files and whole directories
+SHARE_INDEX_PATH = os.path.join(DATA_DIR, 'shares.db')
+SHARE_RESCAN_INTERVAL = int(os.environ.get("LFS_RESCAN_INTERVAL", 600))  # seconds between directory rescans; 0 = only on request
+SHARE_EVENT_INTERVAL = 0.5  # seconds; UI updates for a share being scanned or hashed are batched this long
+LISTING_PAGE_SIZE = 5000  # files per /p2p/list_files page
+
+# Many files in one streamed tar/zip (archive.py, /p2p/archive)
+ARCHIVE_MAX_FILES = 100000  # files one archive request may ask for
+ARCHIVE_READ_SIZE = 1024 * 1024  # bytes per read while streaming members
+
+# File bodies sent to peers are compressed on the wire when the peer accepts it
+# and the content is worth it (compression.py)
+COMPRESSION_ENABLED = os.environ.get("LFS_COMPRESSION", "1") != "0"
+COMPRESSION_MIN_SIZE = 32 * 1024  # smaller bodies are sent as they are
+COMPRESSION_CHUNK_SIZE = 256 * 1024  # bytes compressed and flushed at a time
+COMPRESSION_SAMPLES = 4  # samples taken across a file to judge it
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MAX_RATIO = 0.9  # samples must shrink below this fraction for the file to be compressed
+COMPRESSION_GZIP_LEVEL = 1
+COMPRESSION_ZSTD_LEVEL = 3
+
+# Connections to other peers
+PEER_POOL_MAXSIZE = 8  # keep-alive connections kept per peer
+PEER_POOL_MAX_PEERS = 256  # peers with a pooled session; the least recently used is closed
+FANOUT_MAX_CONCURRENCY = 64  # concurrent requests of one asyncio fan-out
+FANOUT_IDLE_PER_PEER = 2  # idle keep-alive connections the asyncio client keeps per peer
+PROXY_MIN_BUFFER = 64 * 1024  # adaptive read size bounds when relaying a download
+PROXY_MAX_BUFFER = 1024 * 1024
+
+# UI event stream (/api/events)
+EVENT_QUEUE_SIZE = 256  # events buffered per open tab before it is told to resync
+EVENT_KEEPALIVE_INTERVAL = 15  # seconds between keep-alive comments on an idle stream
+# Each open stream holds one of the SERVER_POOL_SIZES["stream"] workers, so one
+# client (a browser with many tabs, a stuck script) must not take them all
+EVENT_STREAMS_PER_CLIENT = 4
+DOWNLOAD_PROGRESS_INTERVAL = 1  # seconds between progress events for running downloads
+
+# Aggregated network catalog (/api/catalog)
+CATALOG_TTL = 15  # seconds a peer's cached listing counts as fresh
+CATALOG_PEER_TIMEOUT = 3  # seconds each peer gets to answer a refresh
+CATALOG_REFRESH_INTERVAL = 10  # seconds between background refreshes
+CATALOG_IDLE_STOP = 120  # background refresh pauses after this long without catalog requests
+CATALOG_CHANGE_LOG_SIZE = 1024  # share/unshare events kept for /p2p/list_files?since=
+
+# Filename search (search_index.py, /p2p/search and the /api/search fan-out)
+SEARCH_DEFAULT_LIMIT = 50  # results asked of each peer and shown
+SEARCH_MAX_LIMIT = 500
+SEARCH_MAX_CANDIDATES = 5000  # matches one node ranks per query; a broader query gets a partial answer
+SEARCH_PEER_TIMEOUT = 2  # seconds each peer gets to answer
+SEARCH_UPDATE_INTERVAL = 0.1  # seconds; merged results are pushed to the UI at most this often
+
+# Multi-source ("swarm") downloads
+SWARM_CHUNK_SIZE = MANIFEST_CHUNK_SIZE  # used when no manifest is available; otherwise the manifest's chunk size
+SWARM_CONNECTIONS_PER_PEER = 2  # parallel chunk requests to one peer
+SWARM_MAX_PEERS = 32  # upper bound on sources used for one download
+SWARM_MAX_PEER_FAILURES = 3  # a peer failing this many chunks is dropped
+SWARM_MAX_CHUNK_ATTEMPTS = 8  # a chunk failing this many times fails the download
+
+# Logging (logs.py). A message repeating more than LOG_RATE_LIMIT times within
+# LOG_RATE_WINDOW seconds is dropped until the window ends, then summarised.
+LOG_LEVEL = os.environ.get("LFS_LOG_LEVEL", "INFO").upper()
+LOG_RATE_LIMIT = 20
+LOG_RATE_WINDOW = 60  # seconds
 
 def find_available_port(start_port=SERVER_PORT, max_attempts=100):
     """Find an available port starting from start_port."""
@@ -0,0 +1,257 @@
+# p2p_app/content_cache.py
+# Disk cache of file content fetched from peers, keyed by content hash.
+#
+# The download proxy writes a body into the cache while relaying it to the
+# browser; once the whole file has arrived and hashes to the ID it was asked
+# for, it is kept as <CACHE_DIR>/<first two hex digits>/<sha256>. The next
+# request for that content is served from disk without asking the peer.
+#
+# Only files fetched without a password are cached, so the cache never hands
+# out something its sharer protected. With CACHE_ADVERTISE, cached files are
+# also listed to other peers as mirrors (see file_handler.add_mirror), which
+# spreads popular files across the LAN and takes load off their sharer.
+#
+# The total is capped at CACHE_MAX_BYTES, evicting the least recently used
+# files. The index (name, size, last use) is a JSON file next to the blobs.
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from . import config
+from . import file_handler
+from . import hashing
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "index.json"
+SAVE_DELAY = 5.0  # seconds; batches index writes while files are being read
+
+# content hash -> {name, size, merkle_root, last_used}
+_entries = {}
+_lock = threading.Lock()
+_save_timer = None
+
+lookups_total = metrics.counter("cache_lookups_total", "Content cache lookups by proxied downloads.", ("result",))
+metrics.gauge("cache_bytes", "Bytes of peer files held in the content cache.", collect=lambda: {(): total_size()})
+
+
+def enabled():
+    return config.CACHE_MAX_BYTES > 0
+
+
+def _path(content_hash):
+    return os.path.join(config.CACHE_DIR, content_hash[:2], content_hash)
+
+
+def _temp_dir():
+    return os.path.join(config.CACHE_DIR, "tmp")
+
+
+def _index_path():
+    return os.path.join(config.CACHE_DIR, INDEX_NAME)
+
+
+def _save_index():
+    global _save_timer
+    with _lock:
+        _save_timer = None
+        snapshot = {content_hash: dict(entry) for content_hash, entry in _entries.items()}
+    tmp_path = _index_path() + ".tmp"
+    try:
+        os.makedirs(config.CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, _index_path())
+    except OSError as e:
+        logger.error("Error saving the content cache index: %s", e)
+
+
+def _schedule_save():
+    # Caller must hold _lock
+    global _save_timer
+    if _save_timer is None:
+        _save_timer = threading.Timer(SAVE_DELAY, _save_index)
+        _save_timer.daemon = True
+        _save_timer.start()
+
+
+def flush():
+    """Write pending index updates now (e.g. on shutdown)."""
+    with _lock:
+        if _save_timer is not None:
+            _save_timer.cancel()
+    if enabled():
+        _save_index()
+
+
+def load():
+    """Read the index at startup, dropping files it doesn't know and entries without a file.
+
+    Cached files are advertised as mirrors again, so call this after the
+    shares have been restored.
+    """
+    if not enabled():
+        return
+    try:
+        with open(_index_path(), "r") as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        stored = {}
+    with _lock:
+        _entries.clear()
+        for content_hash, entry in stored.items():
+            if os.path.isfile(_path(content_hash)):
+                _entries[content_hash] = entry
+    # Unfinished writes and files the index lost track of
+    for root, _dirs, files in os.walk(config.CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            if root == config.CACHE_DIR or name in _entries:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    _evict(0)
+    if config.CACHE_ADVERTISE:
+        for content_hash, entry in list(_entries.items()):
+            _advertise(content_hash, entry)
+    if _entries:
+        logger.info("Content cache: %s files, %s bytes", len(_entries), total_size())
+
+
+def _advertise(content_hash, entry):
+    if config.CACHE_ADVERTISE:
+        file_handler.add_mirror(_path(content_hash), content_hash, entry["merkle_root"], entry["name"])
+
+
+def total_size():
+    with _lock:
+        return sum(entry["size"] for entry in _entries.values())
+
+
+def lookup(content_hash):
+    """(path, name) of a cached file, marking it as just used; None if it isn't cached."""
+    with _lock:
+        entry = _entries.get(content_hash)
+        if entry is None:
+            lookups_total.inc("miss")
+            return None
+        entry["last_used"] = time.time()
+        _schedule_save()
+    path = _path(content_hash)
+    if not os.path.isfile(path):
+        _drop(content_hash)
+        lookups_total.inc("miss")
+        return None
+    lookups_total.inc("hit")
+    return path, entry["name"]
+
+
+def touch(content_hash):
+    """Count a read of a cached file (e.g. served to a peer as a mirror) for LRU order."""
+    with _lock:
+        entry = _entries.get(content_hash)
+        if entry is not None:
+            entry["last_used"] = time.time()
+            _schedule_save()
+
+
+def _drop(content_hash):
+    with _lock:
+        entry = _entries.pop(content_hash, None)
+        _schedule_save()
+    if entry is None:
+        return
+    file_handler.remove_mirror(content_hash)
+    path = _path(content_hash)
+    try:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))  # Only succeeds once the directory is empty
+    except OSError:
+        pass
+
+
+def _evict(incoming):
+    """Drop least recently used files until `incoming` more bytes fit under the cap."""
+    with _lock:
+        by_age = sorted(_entries.items(), key=lambda item: item[1]["last_used"])
+        excess = sum(entry["size"] for _hash, entry in by_age) + incoming - config.CACHE_MAX_BYTES
+    for content_hash, entry in by_age:
+        if excess <= 0:
+            break
+        logger.debug("Content cache: evicting %s (%s bytes)", entry['name'], entry['size'])
+        _drop(content_hash)
+        excess -= entry["size"]
+
+
+def writer(content_hash, name, size):
+    """A CacheWriter for a full body of `size` bytes expected to hash to `content_hash`.
+
+    None if the cache is off, already has the file or the file can never fit.
+    """
+    if not enabled() or size is None or size > config.CACHE_MAX_BYTES:
+        return None
+    with _lock:
+        if content_hash in _entries:
+            return None
+    return CacheWriter(content_hash, name, size)
+
+
+class CacheWriter:
+    """Copies a body into the cache as it streams past; commit() keeps it if it is complete and intact."""
+
+    def __init__(self, content_hash, name, size):
+        self.content_hash = content_hash
+        self.name = name
+        self.size = size
+        os.makedirs(_temp_dir(), exist_ok=True)
+        self._temp_path = os.path.join(_temp_dir(), f"{uuid.uuid4().hex}.part")
+        self._file = open(self._temp_path, "wb")
+        self._hasher = hashing.StreamHasher()
+        self.failed = False
+
+    def write(self, data):
+        if self.failed:
+            return
+        try:
+            self._file.write(data)
+        except OSError as e:
+            # A full disk must not break the download it is riding along with
+            logger.warning("Content cache: not caching %s: %s", self.name, e)
+            self.failed = True
+            return
+        self._hasher.update(data)
+
+    def commit(self):
+        """Keep the file if it has every byte and the expected hash. Returns True if cached."""
+        self._file.close()
+        if self.failed or self._hasher.size != self.size:
+            self.discard()
+            return False
+        entry = self._hasher.finish()
+        if entry["sha256"] != self.content_hash:
+            logger.warning("Content cache: %s did not hash to its ID; not cached", self.name)
+            self.discard()
+            return False
+        _evict(self.size)
+        path = _path(self.content_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self._temp_path, path)
+        cached = {"name": self.name, "size": self.size, "merkle_root": entry["merkle_root"], "last_used": time.time()}
+        with _lock:
+            _entries[self.content_hash] = cached
+            _schedule_save()
+        _advertise(self.content_hash, cached)
+        return True
+
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self._temp_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,253 @@
+# p2p_app/data_server.py
+# Dedicated data path for file bodies. It speaks just enough HTTP/1.1 to serve
+# /p2p/download_file on its own port and hands file spans to the kernel with
+# sendfile, so bytes go from page cache to the socket without passing through
+# Python. Everything else (control API, UI, listings) stays on Flask.
+import json
+import logging
+import re
+import socket
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import bandwidth
+from . import compression
+from . import config
+from . import content_cache
+from . import discovery
+from . import file_handler
+from . import metrics
+from . import serving
+from . import transfer
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_PATH_RE = re.compile(r"^/p2p/download_file/([^/]+)$")
+MAX_REQUEST_BODY = 64 * 1024  # The body only carries the password
+
+data_server = None
+
+
+class DataRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so swarm workers reuse connections
+    server_version = "P2PData/1.0"
+    timeout = config.SERVER_SOCKET_TIMEOUT  # Also ends idle keep-alive connections, freeing their thread
+
+    def log_message(self, format, *args):
+        pass  # One line per request would cost more than the transfer bookkeeping
+
+    _started = None  # When the current request line arrived
+
+    def parse_request(self):
+        self._started = time.perf_counter()
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        path = urllib.parse.urlsplit(getattr(self, "path", "")).path
+        endpoint = "data_download_file" if DOWNLOAD_PATH_RE.match(path) else "unmatched"
+        metrics.http_requests_total.inc(endpoint, getattr(self, "command", None) or "-", code)
+        if self._started is not None:
+            metrics.http_request_seconds.observe(time.perf_counter() - self._started, endpoint)
+            self._started = None
+
+    def _send_head(self, status, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _send_json(self, payload, status, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        headers = dict(headers or {})
+        headers.update({"Content-Type": "application/json", "Content-Length": str(len(body))})
+        self._send_head(status, headers)
+        self.wfile.write(body)
+
+    def _read_password(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_REQUEST_BODY:
+            self.close_connection = True
+            self._send_json({"error": "Invalid request body"}, 413)
+            return None
+        raw = self.rfile.read(length) if length else b""
+        try:
+            data = json.loads(raw) if raw else {}
+        except ValueError:
+            data = {}
+        password = data.get("password", "") if isinstance(data, dict) else ""
+        return password if isinstance(password, str) else ""
+
+    def do_POST(self):
+        match = DOWNLOAD_PATH_RE.match(urllib.parse.urlsplit(self.path).path)
+        if not match:
+            self.close_connection = True
+            self._send_json({"error": "Not found"}, 404)
+            return
+        file_id = urllib.parse.unquote(match.group(1))
+
+        password_attempt = self._read_password()
+        if password_attempt is None:
+            return
+        filepath, error, error_status = file_handler.authorize_download(file_id, password_attempt)
+        if error:
+            self._send_json({"error": error}, error_status)
+            return
+        content_cache.touch(file_handler.resolve_file_id(file_id)) # Served as a mirror: keep it cached
+
+        try:
+            status, headers, segments = file_handler.plan_download(
+                file_id, filepath, self.headers.get("Range"), self.headers.get("If-Range"),
+                self.headers.get("Accept-Encoding"))
+        except transfer.RangeNotSatisfiable as e:
+            headers = dict(e.headers)
+            headers["Content-Range"] = f"bytes */{e.size}"
+            headers["Content-Length"] = "0"
+            self._send_head(416, headers)
+            return
+        except OSError as e:
+            logger.warning("Error sending file %s: %s", filepath, e)
+            self._send_json({"error": "Could not send file"}, 500)
+            return
+
+        encoding = headers.get("Content-Encoding")
+        length = int(headers[compression.UNCOMPRESSED_LENGTH] if encoding else headers["Content-Length"])
+        slot = bandwidth.upload_scheduler.admit(self.client_address[0], length, timeout=config.BANDWIDTH_QUEUE_TIMEOUT)
+        if slot is None:
+            self._send_json({"error": "Too many transfers from your address"}, 503, {"Retry-After": "5"})
+            return
+
+        if encoding:
+            self._send_compressed(slot, filepath, status, headers, segments, encoding)
+            return
+        try:
+            with slot, open(filepath, "rb") as f:
+                self._send_head(status, headers)
+                for segment in segments:
+                    if isinstance(segment, bytes):
+                        slot.throttle(len(segment))
+                        self.wfile.write(segment)
+                        continue
+                    offset, count = segment
+                    # Slices, so the scheduler can interleave this with other transfers
+                    while count > 0:
+                        size = min(count, config.BANDWIDTH_SLICE_SIZE)
+                        slot.throttle(size)
+                        sent = self.connection.sendfile(f, offset, size)
+                        if sent != size:
+                            # File shrank underneath us; the client sees a short body
+                            self.close_connection = True
+                            return
+                        offset += size
+                        count -= size
+        except (ConnectionError, TimeoutError):
+            self.close_connection = True
+        except OSError as e:
+            logger.warning("Error sending file %s: %s", filepath, e)
+            self.close_connection = True
+
+    def _send_compressed(self, slot, filepath, status, headers, segments, encoding):
+        # Compressed bytes have to pass through Python, so no sendfile here;
+        # the body goes out chunked since its length isn't known up front
+        headers["Transfer-Encoding"] = "chunked"
+        chunks = compression.iter_compressed(
+            transfer.iter_segments(filepath, segments, config.COMPRESSION_CHUNK_SIZE), encoding)
+        try:
+            with slot:
+                self._send_head(status, headers)
+                for chunk in chunks:
+                    slot.throttle(len(chunk))
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.write(b"0\r\n\r\n")
+        except (ConnectionError, TimeoutError):
+            self.close_connection = True
+        except OSError as e:
+            logger.warning("Error sending file %s: %s", filepath, e)
+            self.close_connection = True
+
+
+class DataServer(ThreadingHTTPServer):
+    """One thread per connection, up to DATA_SERVER_MAX_CONNECTIONS; beyond that, 503.
+
+    Like the pooled main server it drains on shutdown: no new connections,
+    and transfers in flight get a grace period before they are cut off.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, max_connections=None):
+        super().__init__(server_address, handler_class)
+        self.max_connections = max_connections or config.DATA_SERVER_MAX_CONNECTIONS
+        self._connections = set()  # Sockets with a handler thread
+        self._lock = threading.Lock()
+        self._closing = False
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            refused = self._closing or len(self._connections) >= self.max_connections
+            if not refused:
+                self._connections.add(request)
+        if refused:
+            try:
+                request.settimeout(1)
+                request.sendall(serving.BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except Exception:  # No thread started, so nothing else will release the slot
+            with self._lock:
+                self._connections.discard(request)
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._lock:
+                self._connections.discard(request)
+
+    def drain(self, timeout):
+        """Refuse new connections and give the open ones `timeout` seconds to finish."""
+        with self._lock:
+            self._closing = True
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._connections:
+                    return
+            time.sleep(0.1)
+        with self._lock:
+            remaining = list(self._connections)
+        for request in remaining:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def start_data_server(port, host="0.0.0.0"):
+    """Start the sendfile data server in a background thread and advertise its port."""
+    global data_server
+    data_server = DataServer((host, port), DataRequestHandler)
+    discovery.my_data_port = data_server.server_address[1]
+    thread = threading.Thread(target=data_server.serve_forever, daemon=True)
+    thread.start()
+    logger.info("Data transfer server listening on %s:%s", host, discovery.my_data_port)
+    return data_server
+
+
+def stop_data_server(timeout=config.SERVER_SHUTDOWN_TIMEOUT):
+    """Stop accepting, let transfers in flight finish (up to `timeout` seconds), then close."""
+    global data_server
+    server, data_server = data_server, None
+    if server is not None:
+        server.drain(timeout)
+        server.shutdown()
+        server.server_close()
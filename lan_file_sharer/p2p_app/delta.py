@@ -0,0 +1,283 @@
+# p2p_app/delta.py
+# rsync-style delta transfer: fetch a new version of a file by sending only
+# what differs from an old copy the downloader already has.
+#
+#   1. The receiver splits its old copy (the "basis") into fixed-size blocks
+#      and sends each block's weak (Adler-32) and strong (BLAKE2b) checksum.
+#   2. The serving peer slides a window over its file. Wherever the window's
+#      rolling weak checksum, then its strong one, matches a basis block it
+#      sends a copy instruction; bytes between matches go as literal data.
+#   3. The receiver rebuilds the file from its basis and the literals and
+#      checks the result against the file's content hash.
+#
+# Sliding byte by byte happens in Python, so it is bounded: once
+# DELTA_ROLL_BUDGET bytes have been scanned without a match the sender only
+# tries block-aligned matches (at C speed) for the rest of the file. Small
+# edits resynchronise within a block and never come near the budget.
+#
+# Wire format of the reply, a sequence of operations:
+#   b"C" + >QI (first basis block, block count)   copy blocks from the basis
+#   b"L" + >I (length) + bytes                     literal data
+#   b"E" + >Q (size of the rebuilt file)           end
+import base64
+import hashlib
+import math
+import struct
+import zlib
+from . import config
+
+_ADLER_MOD = 65521
+MAX_BLOCK_SIZE = 64 * 1024 * 1024  # Largest block size a sender accepts
+_SIGNATURE = struct.Struct(">II16s")  # weak checksum, block length, strong checksum
+_COPY = struct.Struct(">QI")
+_LITERAL = struct.Struct(">I")
+_END = struct.Struct(">Q")
+
+
+class DeltaError(Exception):
+    """A delta reply that can't be applied; the caller falls back to a full transfer."""
+    pass
+
+
+def block_size_for(size):
+    """Block size for a basis of `size` bytes: about its square root, like rsync."""
+    block = 1 << max(0, round(math.log2(math.sqrt(max(size, 1)))))
+    block = max(config.DELTA_MIN_BLOCK_SIZE, min(block, config.DELTA_MAX_BLOCK_SIZE))
+    while size // block > config.DELTA_MAX_BLOCKS and block < MAX_BLOCK_SIZE:
+        block *= 2
+    return block
+
+
+def _strong(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def signatures(path, block_size):
+    """Checksums of every block of the basis at `path`, packed for the request (base64 text)."""
+    packed = bytearray()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            packed += _SIGNATURE.pack(zlib.adler32(block), len(block), _strong(block))
+    return base64.b64encode(bytes(packed)).decode("ascii")
+
+
+def parse_signatures(encoded, block_size):
+    """{weak: [(block index, strong)]} for full blocks, and {(length, weak): (index, strong)} for a short last block."""
+    if isinstance(block_size, bool) or not isinstance(block_size, int) \
+            or not config.DELTA_MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+        raise DeltaError("block_size is out of range")
+    try:
+        packed = base64.b64decode(encoded, validate=True)
+    except (ValueError, TypeError):
+        raise DeltaError("Signatures are not valid base64")
+    if len(packed) % _SIGNATURE.size:
+        raise DeltaError("Truncated signature list")
+    table, tails = {}, {}
+    for index, (weak, length, strong) in enumerate(_SIGNATURE.iter_unpack(packed)):
+        if length == block_size:
+            table.setdefault(weak, []).append((index, strong))
+        elif 0 < length < block_size:
+            tails[(length, weak)] = (index, strong)
+        else:
+            raise DeltaError("Signature block length out of range")
+    return table, tails
+
+
+class _Ops:
+    """Accumulates copy runs and literal bytes, emitting wire operations."""
+
+    def __init__(self):
+        self.copy = None  # [first block, count] of the run being extended
+        self.literal = bytearray()
+        self.literal_bytes = 0
+
+    def add_copy(self, index):
+        out = self.flush_literal()
+        if self.copy and self.copy[0] + self.copy[1] == index:
+            self.copy[1] += 1
+        else:
+            out += self.flush_copy()
+            self.copy = [index, 1]
+        return out
+
+    def flush_copy(self):
+        if not self.copy:
+            return b""
+        out = b"C" + _COPY.pack(*self.copy)
+        self.copy = None
+        return out
+
+    def flush_literal(self):
+        if not self.literal:
+            return b""
+        out = b"L" + _LITERAL.pack(len(self.literal)) + bytes(self.literal)
+        self.literal_bytes += len(self.literal)
+        self.literal.clear()
+        return out
+
+    def add_literal_byte(self, value):
+        if self.copy:
+            return self.add_literal(bytes((value,)))
+        self.literal.append(value)
+        if len(self.literal) >= config.DELTA_LITERAL_CHUNK:
+            return self.flush_literal()
+        return b""
+
+    def add_literal(self, data):
+        out = self.flush_copy()
+        self.literal += data
+        if len(self.literal) >= config.DELTA_LITERAL_CHUNK:
+            out += self.flush_literal()
+        return out
+
+
+def _match(table, buf, pos, block_size, weak, prefer):
+    candidates = table.get(weak)
+    if not candidates:
+        return None
+    strong = _strong(buf[pos:pos + block_size])  # Only sliced for a weak hit
+    found = None
+    for index, candidate in candidates:
+        if candidate == strong:
+            if index == prefer:
+                return index  # Continues the current copy run
+            if found is None:
+                found = index
+    return found
+
+
+def iter_delta(path, block_size, table, tails):
+    """Yield the delta of the file at `path` against a basis described by parse_signatures()."""
+    ops = _Ops()
+    window = max(config.DELTA_READ_SIZE, 2 * block_size)
+    roll_budget = config.DELTA_ROLL_BUDGET
+    total = 0
+    with open(path, "rb") as f:
+        buf = f.read(window)
+        eof = len(buf) < window
+        pos = 0
+        a = b = None  # Adler-32 halves of buf[pos:pos + block_size] while rolling
+        while True:
+            if len(buf) - pos <= block_size and not eof:
+                more = f.read(window)
+                eof = len(more) < window
+                buf = buf[pos:] + more
+                pos = 0
+            if len(buf) - pos < block_size:
+                break
+            if a is None:
+                weak = zlib.adler32(buf[pos:pos + block_size])
+                a, b = weak & 0xffff, weak >> 16
+            else:
+                weak = (b << 16) | a
+            prefer = ops.copy[0] + ops.copy[1] if ops.copy else None
+            index = _match(table, buf, pos, block_size, weak, prefer)
+            if index is not None:
+                out = ops.add_copy(index)
+                pos += block_size
+                total += block_size
+                a = None
+            elif roll_budget > 0:
+                # Slide one byte: drop buf[pos], take in buf[pos + block_size]
+                out_byte = buf[pos]
+                out = ops.add_literal_byte(out_byte)
+                pos += 1
+                total += 1
+                roll_budget -= 1
+                if pos + block_size <= len(buf):
+                    in_byte = buf[pos + block_size - 1]
+                    a = (a - out_byte + in_byte) % _ADLER_MOD
+                    b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+                else:
+                    a = None
+            else:
+                # Out of budget: only aligned matches from here on
+                out = ops.add_literal(buf[pos:pos + block_size])
+                pos += block_size
+                total += block_size
+                a = None
+            if out:
+                yield out
+        tail = buf[pos:]
+        if tail:
+            found = tails.get((len(tail), zlib.adler32(tail)))
+            if found and found[1] == _strong(tail):
+                out = ops.add_copy(found[0])
+            else:
+                out = ops.add_literal(tail)
+            total += len(tail)
+            if out:
+                yield out
+    out = ops.flush_copy() + ops.flush_literal()
+    yield out + b"E" + _END.pack(total)
+
+
+class _Reader:
+    """Exact-length reads over an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = bytearray()
+
+    def read(self, count):
+        while len(self._buf) < count:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                raise DeltaError("Delta stream ended early")
+            self._buf += chunk
+        data = bytes(self._buf[:count])
+        del self._buf[:count]
+        return data
+
+
+def apply_delta(chunks, basis_path, out, block_size, on_literal=None, on_progress=None):
+    """Rebuild a file into the writable binary file `out` from delta `chunks` and the basis.
+
+    `on_literal(n)` is called for literal bytes as they arrive (to throttle
+    them), `on_progress(n)` for every n bytes written. Returns
+    (size, sha256 hex, literal bytes, copied bytes).
+    """
+    reader = _Reader(chunks)
+    digest = hashlib.sha256()
+    size = literal_bytes = copied_bytes = 0
+    with open(basis_path, "rb") as basis:
+        while True:
+            op = reader.read(1)
+            if op == b"C":
+                first, count = _COPY.unpack(reader.read(_COPY.size))
+                basis.seek(first * block_size)
+                remaining = count * block_size
+                while remaining:
+                    data = basis.read(min(remaining, config.DOWNLOAD_CHUNK_SIZE))
+                    if not data:
+                        break  # The short last block
+                    out.write(data)
+                    digest.update(data)
+                    remaining -= len(data)
+                    size += len(data)
+                    copied_bytes += len(data)
+                    if on_progress:
+                        on_progress(len(data))
+                if remaining and remaining >= block_size:
+                    raise DeltaError("Copy instruction runs past the end of the basis")
+            elif op == b"L":
+                (length,) = _LITERAL.unpack(reader.read(_LITERAL.size))
+                if on_literal:
+                    on_literal(length)
+                data = reader.read(length)
+                out.write(data)
+                digest.update(data)
+                size += length
+                literal_bytes += length
+                if on_progress:
+                    on_progress(length)
+            elif op == b"E":
+                (expected,) = _END.unpack(reader.read(_END.size))
+                if expected != size:
+                    raise DeltaError(f"Rebuilt {size} bytes, expected {expected}")
+                return size, digest.hexdigest(), literal_bytes, copied_bytes
+            else:
+                raise DeltaError(f"Unknown delta operation {op!r}")
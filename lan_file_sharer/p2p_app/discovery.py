@@ -1,16 +1,134 @@
 # p2p_app/discovery.py
+import heapq
+import logging
+import random
 import socket
 import struct
 import threading
 import time
-import json
+import uuid
+from . import comms
 from . import config
+from . import events
+from . import file_handler
+from . import metrics
 from .peer import Peer
 
-discovered_peers = {} # Dictionary to store discovered peers { (ip, port): Peer_object }
+logger = logging.getLogger(__name__)
+
+class PeerTable:
+    """Discovered peers keyed by (ip, port), safe to use from any thread.
+
+    Reads return snapshots, so callers can iterate while beacons keep
+    arriving. Expiry deadlines live in a heap: a sweep only touches peers
+    that are due instead of scanning the whole table. Superseded deadlines
+    are left in the heap and skipped when they come up. Peers that announce
+    a node ID can also be looked up by it.
+    """
+
+    def __init__(self):
+        self._peers = {}
+        self._deadlines = {}
+        self._heap = [] # (deadline, key)
+        self._nodes = {} # node ID -> key
+        self._lock = threading.Lock()
+
+    def update(self, peer, ttl=config.PEER_TIMEOUT):
+        """Insert or refresh a peer for `ttl` seconds. Returns the entry it replaced, if any."""
+        key = (peer.address, peer.port)
+        deadline = time.time() + ttl
+        with self._lock:
+            previous = self._peers.get(key)
+            self._peers[key] = peer
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, key))
+            if previous is not None and previous.node_id != peer.node_id:
+                self._forget_node(previous, key)
+            if peer.node_id:
+                self._nodes[peer.node_id] = key
+        return previous
+
+    def _forget_node(self, peer, key):
+        # Caller holds _lock
+        if peer.node_id and self._nodes.get(peer.node_id) == key:
+            del self._nodes[peer.node_id]
+
+    def key_for_node(self, node_id):
+        """The (ip, port) under which the node with `node_id` is listed, or None."""
+        with self._lock:
+            return self._nodes.get(node_id)
+
+    def expire(self, now=None):
+        """Remove and return every peer whose deadline has passed."""
+        now = time.time() if now is None else now
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, key = heapq.heappop(self._heap)
+                if self._deadlines.get(key) == deadline:
+                    del self._deadlines[key]
+                    peer = self._peers.pop(key)
+                    self._forget_node(peer, key)
+                    expired.append(peer)
+        return expired
+
+    def next_deadline(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._peers.get(key, default)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self._deadlines.pop(key, None)
+            peer = self._peers.pop(key, None)
+            if peer is None:
+                return default
+            self._forget_node(peer, key)
+            return peer
+
+    def values(self):
+        with self._lock:
+            return list(self._peers.values())
+
+    def items(self):
+        with self._lock:
+            return list(self._peers.items())
+
+    def __setitem__(self, key, peer):
+        self.update(peer)
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._peers[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._peers
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._peers))
+
+
+discovered_peers = PeerTable() # Discovered peers { (ip, port): Peer_object }
 my_username = "DefaultUser" # Will be updated by user input
 my_server_port = config.SERVER_PORT # Port our P2P server runs on
 my_ip = None # Will store our actual IP address
+my_data_port = None # Port of our sendfile data server, once it is running
+my_node_id = uuid.uuid4().hex # Sent in every beacon, so our copies on each interface count as one peer
+multicast_interfaces = [] # IPv4 addresses of the interfaces we beacon and listen on
+_announce_now = threading.Event() # Set when our file listing changes, to beacon early
+# Counters instead of a print per packet; at a few hundred peers printing dominated CPU
+beacon_stats = {"sent": 0, "received": 0, "malformed": 0}
+metrics.counter("discovery_beacons_total", "Discovery beacons sent, received and rejected as malformed.", ("kind",),
+                collect=lambda: dict(beacon_stats))
+metrics.gauge("peers", "Peers in the peer table.", collect=lambda: {(): len(discovered_peers)})
 
 def get_local_ip():
     """Get the actual IP address of this machine."""
@@ -24,117 +142,219 @@ def get_local_ip():
     except Exception:
         return "127.0.0.1"  # Fallback to localhost
 
+def local_ipv4_addresses():
+    """IPv4 addresses of this machine's interfaces, loopback excluded."""
+    addresses = set()
+    try:
+        import fcntl # Unix only
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for _, name in socket.if_nameindex():
+                try:
+                    request = struct.pack('256s', name[:15].encode())
+                    addresses.add(socket.inet_ntoa(fcntl.ioctl(probe.fileno(), 0x8915, request)[20:24])) # SIOCGIFADDR
+                except OSError:
+                    continue # Interface without an IPv4 address
+        finally:
+            probe.close()
+    except (ImportError, OSError, AttributeError):
+        pass
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            addresses.add(info[4][0])
+    except OSError:
+        pass
+    if my_ip:
+        addresses.add(my_ip)
+    return sorted(a for a in addresses if not a.startswith("127."))
+
 def set_identity(username, server_port):
     global my_username, my_server_port, my_ip
     my_username = username
     my_server_port = server_port
     my_ip = get_local_ip()
 
-def send_discovery_message(sock):
-    message = {
-        "username": my_username,
-        "port": my_server_port,
-        "type": "discovery",
-        "ip": my_ip  # Include our actual IP
-    }
-    message_bytes = json.dumps(message).encode('utf-8')
-    try:
-        # Send to the standard multicast port that all instances listen on
-        sock.sendto(message_bytes, (config.MULTICAST_ADDRESS, config.MULTICAST_PORT))
-        print(f"Sent discovery message: {message}")
-    except Exception as e:
-        print(f"Error sending discovery message: {e}")
+def beacon_interval(peer_count):
+    """Seconds between our beacons (before jitter), given how many peers we know.
 
-def listen_for_discovery_messages(sock):
-    while True:
+    Grows with the peer count so the whole LAN sends about
+    BEACON_TARGET_RATE beacons per second, within
+    [BROADCAST_INTERVAL, MAX_BROADCAST_INTERVAL].
+    """
+    interval = (peer_count + 1) / config.BEACON_TARGET_RATE
+    return min(max(interval, config.BROADCAST_INTERVAL), config.MAX_BROADCAST_INTERVAL)
+
+def jittered(interval):
+    # Randomised so nodes started together don't beacon in lockstep
+    return interval * random.uniform(1 - config.BEACON_JITTER, 1 + config.BEACON_JITTER)
+
+def peer_ttl(advertised_interval):
+    """How long a peer stays listed without a beacon, given the interval it announced."""
+    if not advertised_interval:
+        return config.PEER_TIMEOUT
+    return max(config.PEER_TIMEOUT, advertised_interval * (1 + config.BEACON_JITTER) * config.BEACON_MISSES_BEFORE_TIMEOUT)
+
+def send_discovery_message(sock, interval=None):
+    """Beacon on every multicast interface, each copy carrying that interface's address."""
+    interval = interval or beacon_interval(len(discovered_peers))
+    for interface_ip in multicast_interfaces or [None]:
+        message_bytes = comms.encode_beacon(
+            my_username, my_server_port, ip=interface_ip or my_ip, data_port=my_data_port,
+            # Peers refetch our file list only when this changes
+            catalog_version=file_handler.get_catalog_version(),
+            interval=interval,
+            node_id=my_node_id,
+        )
         try:
-            data, addr = sock.recvfrom(config.BUFFER_SIZE)
-            message_str = data.decode('utf-8')
-            message = json.loads(message_str)
-            print(f"Received message: {message} from {addr}")
+            if interface_ip:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface_ip))
+            # Send to the standard multicast port that all instances listen on
+            sock.sendto(message_bytes, (config.MULTICAST_ADDRESS, config.MULTICAST_PORT))
+            beacon_stats["sent"] += 1
+        except Exception as e:
+            logger.warning("Error sending discovery message on %s: %s", interface_ip or "default interface", e)
 
-            if message.get("type") == "discovery":
-                # Use the IP from the message if available, otherwise from addr
-                peer_ip = message.get("ip", addr[0])
-                peer_port = message.get("port")
-                peer_username = message.get("username")
+def record_peer(peer, ttl):
+    """Add or refresh a peer, however we heard of it, and tell the UI what changed.
 
-                if not peer_ip or not peer_port or not peer_username:
-                    print(f"Incomplete discovery message from {addr}: {message}")
-                    continue
+    A node reachable on several addresses is listed once: while it is listed
+    under one address, hearing of it on another changes nothing. If that
+    address goes quiet, the entry expires and the next beacon lists it anew.
+    """
+    if peer.node_id:
+        key = discovered_peers.key_for_node(peer.node_id)
+        if key is not None and key != (peer.address, peer.port):
+            return discovered_peers.get(key)
+    previous = discovered_peers.update(peer, ttl)
+    if previous is None or previous.username != peer.username:
+        logger.info("Discovered new peer: %s at %s:%s (via %s)", peer.username, peer.address, peer.port, peer.via)
+        events.publish("peer-joined", peer.to_dict())
+    elif previous.catalog_version != peer.catalog_version:
+        events.publish("peer-catalog-changed", peer.to_dict())
+    return previous
 
-                # Avoid discovering self by checking both IP and port
-                if (peer_ip == my_ip or peer_ip == "127.0.0.1") and peer_port == my_server_port and peer_username == my_username:
-                    print(f"Ignoring self-discovery message from {peer_ip}:{peer_port}")
-                    continue
+def is_self(address, port, username, node_id=None):
+    if node_id:
+        return node_id == my_node_id
+    return (address == my_ip or address in multicast_interfaces or address == "127.0.0.1") \
+        and port == my_server_port and username == my_username
+
+def handle_beacon(data, addr):
+    """Record the peer announced by one received datagram. Returns the Peer, or None."""
+    beacon_stats["received"] += 1
+    try:
+        message = comms.decode_beacon(data, addr[0])
+    except comms.MalformedBeacon:
+        beacon_stats["malformed"] += 1
+        return None
 
-                peer_key = (peer_ip, peer_port)
-                if peer_key not in discovered_peers or discovered_peers[peer_key].username != peer_username:
-                    print(f"Discovered new peer: {peer_username} at {peer_ip}:{peer_port}")
+    peer_ip = message["ip"]
+    peer_port = message["port"]
+    peer_username = message["username"]
+    if not peer_ip or not peer_port or not peer_username:
+        beacon_stats["malformed"] += 1
+        return None
 
-                discovered_peers[peer_key] = Peer(peer_ip, peer_port, peer_username)
+    # Avoid discovering self by checking both IP and port
+    if is_self(peer_ip, peer_port, peer_username, message["node_id"]):
+        return None
 
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON from {addr}: {data.decode('utf-8', errors='ignore')}")
+    peer = Peer(peer_ip, peer_port, peer_username, message["data_port"], message["catalog_version"],
+                node_id=message["node_id"])
+    record_peer(peer, peer_ttl(message["interval"]))
+    return peer
+
+def listen_for_discovery_messages(sock):
+    while True:
+        try:
+            data, addr = sock.recvfrom(config.BUFFER_SIZE)
+            handle_beacon(data, addr)
         except socket.timeout:
             continue # Expected if no messages
         except Exception as e:
-            print(f"Error listening for discovery messages: {e}")
+            logger.warning("Error listening for discovery messages: %s", e)
             time.sleep(1) # Avoid rapid spamming of errors
 
+def expire_peers():
+    for peer in discovered_peers.expire():
+        logger.info("Peer timed out: %s", peer.username)
+        events.publish("peer-left", peer.to_dict())
+
 def start_discovery(username="P2PUser", server_port_to_advertise=config.SERVER_PORT):
     set_identity(username, server_port_to_advertise)
 
     # Create UDP socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        # Room for a burst of beacons from a large LAN while the listener is busy
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.DISCOVERY_RECEIVE_BUFFER)
+    except OSError:
+        pass
 
     # Bind to the standard multicast port
     sock.bind(('', config.MULTICAST_PORT))
 
-    # Tell the operating system to add the socket to the multicast group
-    # on all interfaces.
+    # Join the multicast group on every interface, not just the default one,
+    # so multi-homed machines see (and are seen by) peers on each subnet.
     group = socket.inet_aton(config.MULTICAST_ADDRESS)
-    mreq = struct.pack('4sL', group, socket.INADDR_ANY)
-    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    multicast_interfaces[:] = config.MULTICAST_INTERFACES or local_ipv4_addresses()
+    joined = []
+    for interface_ip in multicast_interfaces:
+        try:
+            mreq = struct.pack('4s4s', group, socket.inet_aton(interface_ip))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            joined.append(interface_ip)
+        except OSError as e:
+            logger.warning("Could not join multicast group on %s: %s", interface_ip, e)
+    multicast_interfaces[:] = joined
+    if not joined:
+        mreq = struct.pack('4sL', group, socket.INADDR_ANY)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, config.MULTICAST_TTL)
     sock.settimeout(1.0) # Timeout for recvfrom
 
-    print(f"Starting P2P discovery. My Info: {my_username} on port {my_server_port}. Listening on {config.MULTICAST_ADDRESS}:{config.MULTICAST_PORT}")
-    print(f"My IP address: {my_ip}")
+    logger.info("Starting P2P discovery. My Info: %s on port %s. Listening on %s:%s", my_username, my_server_port, config.MULTICAST_ADDRESS, config.MULTICAST_PORT)
+    logger.info("My IP address: %s; multicast on %s", my_ip, ", ".join(multicast_interfaces) or "default interface")
 
     # Start listener thread
     listener_thread = threading.Thread(target=listen_for_discovery_messages, args=(sock,), daemon=True)
     listener_thread.start()
 
-    # Periodically send discovery messages
+    # Periodically send discovery messages, and soon after our file list changes
+    file_handler.add_catalog_listener(lambda version: _announce_now.set())
+
     def broadcast_loop():
+        time.sleep(random.uniform(0, config.MIN_ANNOUNCE_INTERVAL)) # Spread out nodes started together
         while True:
-            send_discovery_message(sock)
-            time.sleep(config.BROADCAST_INTERVAL)
+            _announce_now.clear()
+            interval = beacon_interval(len(discovered_peers))
+            send_discovery_message(sock, interval)
+            time.sleep(config.MIN_ANNOUNCE_INTERVAL) # A burst of changes still sends one beacon
+            _announce_now.wait(max(jittered(interval) - config.MIN_ANNOUNCE_INTERVAL, 0))
 
     broadcast_thread = threading.Thread(target=broadcast_loop, args=(), daemon=True)
     broadcast_thread.start()
 
-    # Periodically clean up old peers
+    # Drop peers whose beacons stopped; only peers that are due get looked at
     def cleanup_loop():
         while True:
-            current_time = time.time()
-            peers_to_remove = [
-                key for key, peer_obj in discovered_peers.items()
-                if current_time - peer_obj.last_seen > config.PEER_TIMEOUT
-            ]
-            for key in peers_to_remove:
-                print(f"Peer timed out: {discovered_peers[key].username}")
-                del discovered_peers[key]
-            time.sleep(config.PEER_TIMEOUT / 2) # Check more frequently than timeout
+            expire_peers()
+            next_deadline = discovered_peers.next_deadline()
+            wait = next_deadline - time.time() if next_deadline else config.PEER_TIMEOUT
+            time.sleep(min(max(wait, 0.1), 1.0))
 
     cleanup_thread = threading.Thread(target=cleanup_loop, args=(), daemon=True)
     cleanup_thread.start()
 
-    print("Discovery sender, listener, and cleanup threads started.")
+    logger.debug("Discovery sender, listener, and cleanup threads started.")
     # Note: This function will return, threads run in background.
     # In a real app, you'd have a way to stop these threads gracefully.
 
+def get_peer_data_port(peer_address, peer_port):
+    peer = discovered_peers.get((peer_address, peer_port))
+    return peer.data_port if peer else None
+
 def get_discovered_peers():
     # Return a list of peer dicts for API use
     return [peer.to_dict() for peer in discovered_peers.values()]
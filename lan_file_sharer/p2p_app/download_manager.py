@@ -0,0 +1,314 @@
+# p2p_app/download_manager.py
+# Download jobs: a priority queue drained by a bounded pool of worker threads
+# that write files from peers straight into config.DOWNLOAD_DIR.
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+import requests
+from . import config
+from . import delta
+from . import downloads
+from . import events
+from . import swarm
+
+logger = logging.getLogger(__name__)
+
+# Key: job id, Value: DownloadJob
+download_jobs = {}
+_queue = []  # heap of (-priority, sequence, job_id)
+_sequence = itertools.count()
+_queue_cond = threading.Condition()
+_workers = []
+_progress_thread = None
+
+ACTIVE_STATES = ("queued", "running")
+
+
+class DownloadJob:
+    """One file to fetch, either from a single peer or from every peer holding it."""
+
+    def __init__(self, file_id, peer_address=None, peer_port=None, name=None, password="",
+                 priority=0, use_swarm=False):
+        self.id = uuid.uuid4().hex
+        self.file_id = file_id
+        self.peer_address = peer_address
+        self.peer_port = peer_port
+        self.name = name
+        self.password = password
+        self.priority = priority
+        self.use_swarm = use_swarm
+
+        self.status = "queued"
+        self.error = None
+        self.path = None
+        self.progress = {"bytes_done": 0, "size": None, "resumed_from": 0}
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self._stop_event = threading.Event()
+        self._stop_reason = None  # "paused" or "cancelled"
+        self._swarm = None
+
+    @property
+    def bytes_done(self):
+        if self._swarm is not None:
+            return self._swarm.bytes_done
+        return self.progress.get("bytes_done", 0)
+
+    @property
+    def size(self):
+        if self._swarm is not None:
+            return self._swarm.size
+        return self.progress.get("size")
+
+    def stop(self, reason):
+        self._stop_reason = reason
+        self._stop_event.set()
+        if self._swarm is not None:
+            self._swarm.cancel()
+
+    def to_dict(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0
+        transferred = self.bytes_done - self.progress.get("resumed_from", 0)
+        data = {
+            "id": self.id,
+            "file_id": self.file_id,
+            "peer": f"{self.peer_address}:{self.peer_port}" if self.peer_address else None,
+            "name": self.name,
+            "priority": self.priority,
+            "swarm": self.use_swarm,
+            "status": self.status,
+            "error": self.error,
+            "path": self.path,
+            "bytes_done": self.bytes_done,
+            "size": self.size,
+            "speed": transferred / elapsed if elapsed > 0 else 0.0,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self._swarm is not None:
+            data["sources"] = self._swarm.to_dict()["sources"]
+        return data
+
+
+def _publish(job):
+    events.publish("download-progress", job.to_dict())
+
+
+def _progress_loop():
+    # Byte counts change constantly, so running jobs are reported on a timer
+    # rather than on every chunk; status changes are published as they happen.
+    while True:
+        time.sleep(config.DOWNLOAD_PROGRESS_INTERVAL)
+        if not events.has_subscribers():
+            continue
+        with _queue_cond:
+            running = [job for job in download_jobs.values() if job.status == "running"]
+        for job in running:
+            _publish(job)
+
+
+def _ensure_workers():
+    # Caller holds _queue_cond
+    global _progress_thread
+    while len(_workers) < config.MAX_CONCURRENT_DOWNLOADS:
+        worker = threading.Thread(target=_worker_loop, name=f"download-worker-{len(_workers)}", daemon=True)
+        _workers.append(worker)
+        worker.start()
+    if _progress_thread is None:
+        _progress_thread = threading.Thread(target=_progress_loop, name="download-progress", daemon=True)
+        _progress_thread.start()
+
+
+def _enqueue(job):
+    # Caller holds _queue_cond
+    job.status = "queued"
+    heapq.heappush(_queue, (-job.priority, next(_sequence), job.id))
+    _ensure_workers()
+    _queue_cond.notify()
+
+
+def _worker_loop():
+    while True:
+        with _queue_cond:
+            while not _queue:
+                _queue_cond.wait()
+            _, _, job_id = heapq.heappop(_queue)
+            job = download_jobs.get(job_id)
+            if job is None or job.status != "queued":
+                continue  # Paused or cancelled while waiting
+            job.status = "running"
+            job._stop_event.clear()
+            job._stop_reason = None
+            job.started_at = job.started_at or time.time()
+        _publish(job)
+        _run_job(job)
+
+
+def _run_single_source(job):
+    basis = downloads.find_basis(job.name) if config.DELTA_ENABLED else None
+    if basis and not os.path.exists(downloads.partial_path(job.file_id)):
+        # An older version is here already: fetch only what changed
+        try:
+            job.path = downloads.delta_download(
+                job.peer_address, job.peer_port, job.file_id, basis, job.password, job.name,
+                progress=job.progress, stop_event=job._stop_event,
+            )
+            return
+        except (delta.DeltaError, requests.exceptions.RequestException) as e:
+            logger.info("Delta download of %s failed (%s); downloading the whole file", job.name, e)
+            job.progress.update({"bytes_done": 0, "resumed_from": 0})
+    job.path = downloads.resume_download(
+        job.peer_address, job.peer_port, job.file_id, job.password, job.name,
+        progress=job.progress, stop_event=job._stop_event,
+    )
+
+
+def _run_swarm(job):
+    swarm_download = swarm.prepare_swarm_download(job.file_id, job.password, job.name)
+    if swarm_download is None:
+        if not job.peer_address:
+            raise downloads.DownloadError("No discovered peer is sharing this file")
+        # Nobody else has it (or it has no content hash yet): plain download
+        job._swarm = None
+        _run_single_source(job)
+        return
+    job._swarm = swarm_download
+    job.name = swarm_download.name
+    if job._stop_event.is_set():
+        swarm_download.cancel()
+    swarm_download.run()
+    if swarm_download.status == "cancelled":
+        raise downloads.DownloadStopped()
+    if swarm_download.status != "completed":
+        raise downloads.DownloadError(swarm_download.error or "Swarm download failed")
+    job.path = swarm_download.path
+
+
+def _run_job(job):
+    try:
+        if job.use_swarm:
+            _run_swarm(job)
+        else:
+            _run_single_source(job)
+        status, error = "completed", None
+    except downloads.DownloadStopped:
+        status, error = job._stop_reason or "paused", None
+    except (requests.exceptions.RequestException, downloads.DownloadError, OSError) as e:
+        logger.warning("Download job %s (%s) failed: %s", job.id, job.name or job.file_id, e)
+        status, error = "failed", str(e)
+    except Exception as e:  # A bug must fail the job, not kill the worker with the job stuck "running"
+        logger.exception("Download job %s (%s) crashed", job.id, job.name or job.file_id)
+        status, error = "failed", f"Internal error: {e}"
+    job.name = job.name or job.progress.get("name")
+
+    with _queue_cond:
+        job.status = status
+        job.error = error
+        if status in ("completed", "failed", "cancelled"):
+            job.finished_at = time.time()
+    if status == "cancelled":
+        _discard_partial(job)
+    _publish(job)
+    logger.info("Download job %s (%s) %s", job.id, job.name or job.file_id, status)
+
+
+def _discard_partial(job):
+    try:
+        if job._swarm is not None:
+            job._swarm.discard_partial()
+        downloads.discard_partial(job.file_id)
+    except OSError as e:
+        logger.warning("Could not remove partial download for job %s: %s", job.id, e)
+
+
+# --- Public API ---
+
+def add_job(file_id, peer_address=None, peer_port=None, name=None, password="", priority=0, use_swarm=False):
+    """Queue a download, or return the unfinished job for the same file.
+
+    Jobs for one file share its partial data, so a second one would race the
+    first for it, and cancelling either would delete it under the other. An
+    existing paused or failed job is queued again. Returns (job, created).
+    """
+    with _queue_cond:
+        job = next((job for job in download_jobs.values()
+                    if job.file_id == file_id and job.status in (*ACTIVE_STATES, "paused", "failed")), None)
+        created = job is None
+        if created:
+            job = DownloadJob(file_id, peer_address, peer_port, name, password, priority, use_swarm)
+            download_jobs[job.id] = job
+            _enqueue(job)
+        elif job.status not in ACTIVE_STATES:
+            job.error = None
+            job.finished_at = None
+            _enqueue(job)
+    _publish(job)
+    return job, created
+
+
+def get_job(job_id):
+    return download_jobs.get(job_id)
+
+
+def list_jobs():
+    with _queue_cond:
+        jobs = sorted(download_jobs.values(), key=lambda j: j.created_at)
+    return [job.to_dict() for job in jobs]
+
+
+def pause_job(job_id):
+    """Stop a queued or running job, keeping partial data. Returns the job or None."""
+    with _queue_cond:
+        job = download_jobs.get(job_id)
+        if job is None or job.status not in ACTIVE_STATES:
+            return None
+        if job.status == "queued":
+            job.status = "paused"
+        else:
+            job.stop("paused")
+            return job  # Published by the worker once it has stopped
+    _publish(job)
+    return job
+
+
+def resume_job(job_id):
+    with _queue_cond:
+        job = download_jobs.get(job_id)
+        if job is None or job.status not in ("paused", "failed"):
+            return None
+        job.error = None
+        job.finished_at = None
+        _enqueue(job)
+    _publish(job)
+    return job
+
+
+def cancel_job(job_id):
+    """Cancel an unfinished job and delete its partial data; forget a finished one."""
+    with _queue_cond:
+        job = download_jobs.get(job_id)
+        if job is None:
+            return None
+        if job.status == "running":
+            job.stop("cancelled")
+            return job
+        if job.status in ("queued", "paused", "failed"):
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            discard = True
+        else:
+            del download_jobs[job_id]
+            discard = False
+    if discard:
+        _discard_partial(job)
+        _publish(job)
+    else:
+        events.publish("download-removed", {"id": job_id})
+    return job
@@ -0,0 +1,322 @@
+# p2p_app/downloads.py
+# Resumable downloads from peers straight into the local download directory.
+import json
+import logging
+import os
+import time
+import requests
+from werkzeug.http import parse_options_header
+from werkzeug.utils import secure_filename
+from . import bandwidth
+from . import config
+from . import delta
+from . import discovery
+from . import file_handler
+from . import manifest
+from . import peer_client
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadStopped(Exception):
+    """Raised inside a transfer when its stop event is set (pause/cancel)."""
+    pass
+
+
+def _part_paths(file_id):
+    # Partial data is keyed by file ID, not by name, so a retry finds it again
+    # even before the peer has told us what the file is called.
+    part_path = os.path.join(config.DOWNLOAD_DIR, f"{secure_filename(file_id)}.part")
+    return part_path, part_path + ".json"
+
+
+def partial_path(file_id):
+    """Where an interrupted resume_download() of `file_id` keeps its data."""
+    return _part_paths(file_id)[0]
+
+
+def _load_part_state(state_path):
+    try:
+        with open(state_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_part_state(state_path, state):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def filename_from_response(response, fallback):
+    _, options = parse_options_header(response.headers.get("Content-Disposition", ""))
+    name = secure_filename(options.get("filename", "") or "")
+    return name or fallback
+
+
+def unique_destination(filename):
+    dest = os.path.join(config.DOWNLOAD_DIR, filename)
+    base, ext = os.path.splitext(dest)
+    counter = 1
+    while os.path.exists(dest):
+        dest = f"{base} ({counter}){ext}"
+        counter += 1
+    return dest
+
+
+def parse_content_range(value):
+    # "bytes START-END/SIZE" -> (start, end, size); size may be None for "*"
+    try:
+        unit, _, rest = value.partition(" ")
+        span, _, total = rest.partition("/")
+        start, _, end = span.partition("-")
+        return int(start), int(end), (None if total == "*" else int(total))
+    except (AttributeError, ValueError):
+        return None
+
+
+def peer_download_url(peer_address, peer_port, file_id):
+    """URL for fetching a file body, preferring the peer's sendfile data server."""
+    data_port = discovery.get_peer_data_port(peer_address, peer_port)
+    return f"http://{peer_address}:{data_port or peer_port}/p2p/download_file/{file_id}"
+
+
+def fetch_manifest(peer_address, peer_port, file_id, expected_root=None, timeout=5):
+    """Fetch and sanity-check a peer's chunk manifest. Returns None if unavailable."""
+    try:
+        session = peer_client.get_session(peer_address, peer_port)
+        response = session.get(f"http://{peer_address}:{peer_port}/p2p/manifest/{file_id}", timeout=timeout)
+        if response.status_code != 200:
+            return None
+        file_manifest = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+    if not manifest.is_consistent(file_manifest):
+        logger.warning("Ignoring inconsistent manifest for %s from %s:%s", file_id, peer_address, peer_port)
+        return None
+    if expected_root and file_manifest["merkle_root"] != expected_root:
+        return None
+    return file_manifest
+
+
+def _read_chunk_prefix(part_path, file_manifest, offset):
+    # Bytes already on disk for the chunk the transfer resumes in, so that
+    # chunk can still be verified once its remainder arrives.
+    chunk_start = offset - offset % file_manifest["chunk_size"]
+    with open(part_path, "rb") as f:
+        f.seek(chunk_start)
+        return f.read(offset - chunk_start)
+
+
+def resume_download(peer_address, peer_port, file_id, password="", filename=None, progress=None,
+                    stop_event=None):
+    """Download `file_id` from a peer into DOWNLOAD_DIR, continuing a partial copy.
+
+    A previous attempt leaves `<file_id>.part` plus a small JSON sidecar holding
+    the peer's ETag. The next attempt asks only for the missing bytes with
+    `Range`/`If-Range`; if the file changed on the peer it gets a full 200 and
+    starts over. Returns the path of the completed file.
+
+    If the peer publishes a chunk manifest, every chunk is checked as it
+    arrives; a corrupted chunk is cut off the partial file and fetched again.
+
+    Setting `stop_event` makes the transfer raise DownloadStopped at the next
+    chunk, leaving the partial file in place for a later call to continue.
+
+    The transfer waits for one of the peer's download slots first and is
+    rate limited by bandwidth.download_scheduler. A peer answering 503 is
+    asked again after its Retry-After, up to PEER_BUSY_RETRIES times.
+    """
+    for attempt in range(config.PEER_BUSY_RETRIES + 1):
+        slot = bandwidth.download_scheduler.admit(peer_address, stop_event=stop_event)
+        if slot is None:
+            raise DownloadStopped()
+        try:
+            with slot:
+                return _resume_download(peer_address, peer_port, file_id, password, filename, progress, stop_event, slot)
+        except peer_client.PeerBusy as e:
+            if attempt == config.PEER_BUSY_RETRIES:
+                raise DownloadError(f"Peer is still busy after {attempt + 1} attempts; try again later")
+            logger.info("%s:%s is busy; retrying %s in %ss", peer_address, peer_port, file_id, e.retry_after)
+            if stop_event is None:
+                time.sleep(e.retry_after)
+            elif stop_event.wait(e.retry_after):
+                raise DownloadStopped()
+
+
+def _resume_download(peer_address, peer_port, file_id, password, filename, progress, stop_event, slot, _attempt=0):
+    os.makedirs(config.DOWNLOAD_DIR, exist_ok=True)
+    part_path, state_path = _part_paths(file_id)
+    progress = progress if progress is not None else {}
+
+    state = _load_part_state(state_path)
+    offset = 0
+    headers = {}
+    if state and state.get("etag") and os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = state["etag"]
+
+    file_manifest = fetch_manifest(peer_address, peer_port, file_id)
+
+    target_url = peer_download_url(peer_address, peer_port, file_id)
+    response = peer_client.get_session(peer_address, peer_port).post(
+        target_url, json={"password": password}, headers=headers, stream=True, timeout=(5, 300))
+    with response:
+        if response.status_code == 416 and state and offset > 0:
+            _, _, total = parse_content_range(response.headers.get("Content-Range", "")) or (None, None, None)
+            if total is not None and total == offset and response.headers.get("ETag") == state.get("etag"):
+                # Everything arrived last time; only the rename was missing.
+                name = filename or state.get("name") or file_id
+                return _finish(part_path, state_path, name, progress)
+            # Stale partial file: drop it and fetch from scratch.
+            os.remove(part_path)
+            os.remove(state_path)
+            return _resume_download(peer_address, peer_port, file_id, password, filename, progress, stop_event, slot, _attempt)
+
+        peer_client.raise_if_busy(response)
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("error")
+            except ValueError:
+                message = None
+            raise DownloadError(message or f"Peer returned HTTP {response.status_code}")
+
+        name = filename or filename_from_response(response, file_id)
+        etag = response.headers.get("ETag")
+        if response.status_code == 206:
+            content_range = parse_content_range(response.headers.get("Content-Range", ""))
+            if not content_range or content_range[0] != offset:
+                raise DownloadError("Peer answered with an unexpected byte range")
+            total_size = content_range[2]
+            mode = "ab"
+        else:
+            offset = 0
+            total_size = peer_client.body_length(response)
+            mode = "wb"
+
+        _save_part_state(state_path, {
+            "etag": etag,
+            "name": name,
+            "size": total_size,
+            "peer": f"{peer_address}:{peer_port}",
+        })
+        progress.update({"name": name, "size": total_size, "resumed_from": offset, "bytes_done": offset})
+
+        verifier = None
+        if file_manifest and file_manifest["size"] == total_size:
+            prefix = _read_chunk_prefix(part_path, file_manifest, offset) if offset else b""
+            verifier = manifest.ChunkVerifier(file_manifest, offset, prefix)
+
+        wire = peer_client.WireMeter(response)  # Compressed bodies count as received, not as decoded
+        with open(part_path, mode) as f:
+            try:
+                for chunk in peer_client.iter_body(response, config.DOWNLOAD_CHUNK_SIZE):
+                    if stop_event is not None and stop_event.is_set():
+                        raise DownloadStopped()
+                    if chunk:
+                        slot.throttle(wire.advance())
+                        if verifier:
+                            verifier.feed(chunk)
+                        f.write(chunk)
+                        progress["bytes_done"] += len(chunk)
+            except manifest.ChunkMismatch as e:
+                # Keep every verified chunk; only the bad one is requested again.
+                f.truncate(e.chunk_start)
+                progress["bytes_done"] = e.chunk_start
+                if _attempt + 1 >= config.CHUNK_VERIFY_RETRIES:
+                    raise DownloadError(f"{e}; giving up after {_attempt + 1} attempts")
+                logger.warning("%s while downloading %s; re-fetching from offset %s", e, file_id, e.chunk_start)
+                retry = True
+            else:
+                retry = False
+        if retry:
+            return _resume_download(peer_address, peer_port, file_id, password, filename, progress, stop_event, slot, _attempt + 1)
+
+    if total_size is not None and os.path.getsize(part_path) != total_size:
+        raise DownloadError("Connection closed before the whole file arrived; retry to resume")
+    return _finish(part_path, state_path, name, progress)
+
+
+def find_basis(name):
+    """An older copy of `name` in DOWNLOAD_DIR to delta against, or None."""
+    if not name:
+        return None
+    path = os.path.join(config.DOWNLOAD_DIR, secure_filename(name))
+    if os.path.isfile(path) and os.path.getsize(path) > 0:
+        return path
+    return None
+
+
+def delta_download(peer_address, peer_port, file_id, basis_path, password="", filename=None, progress=None,
+                   stop_event=None):
+    """Download `file_id` as a delta against the old copy at `basis_path` (see delta.py).
+
+    Only literal data crosses the network; the rest is copied from the basis.
+    The result must hash to `file_id`. Raises delta.DeltaError when the peer
+    can't send a delta (or its delta doesn't rebuild the file), so the
+    caller can fall back to resume_download(). Returns the completed file's path.
+    """
+    slot = bandwidth.download_scheduler.admit(peer_address, stop_event=stop_event)
+    if slot is None:
+        raise DownloadStopped()
+    os.makedirs(config.DOWNLOAD_DIR, exist_ok=True)
+    progress = progress if progress is not None else {}
+    part_path = os.path.join(config.DOWNLOAD_DIR, f"{secure_filename(file_id)}.delta.part")
+    block_size = delta.block_size_for(os.path.getsize(basis_path))
+    payload = {"password": password, "block_size": block_size, "signatures": delta.signatures(basis_path, block_size)}
+    with slot:
+        response = peer_client.get_session(peer_address, peer_port).post(
+            f"http://{peer_address}:{peer_port}/p2p/delta/{file_id}", json=payload, stream=True, timeout=(5, 300))
+        with response:
+            if response.status_code != 200 or "X-Delta-Size" not in response.headers:
+                raise delta.DeltaError(f"Peer did not send a delta (HTTP {response.status_code})")
+            name = filename or filename_from_response(response, file_id)
+            size = int(response.headers["X-Delta-Size"])
+            progress.update({"name": name, "size": size, "resumed_from": 0, "bytes_done": 0,
+                             "delta_basis": os.path.basename(basis_path)})
+
+            def on_literal(count):
+                if stop_event is not None and stop_event.is_set():
+                    raise DownloadStopped()
+                slot.throttle(count)
+
+            def on_progress(count):
+                progress["bytes_done"] += count
+
+            try:
+                with open(part_path, "wb") as f:
+                    _size, sha256, literal_bytes, copied_bytes = delta.apply_delta(
+                        response.iter_content(chunk_size=config.DOWNLOAD_CHUNK_SIZE), basis_path, f, block_size,
+                        on_literal, on_progress)
+                if not file_id.startswith(file_handler.PENDING_ID_PREFIX) and sha256 != file_id:
+                    raise delta.DeltaError("Rebuilt file does not match its content hash")
+            except BaseException:
+                os.remove(part_path)
+                raise
+    progress.update({"delta_literal_bytes": literal_bytes, "delta_copied_bytes": copied_bytes})
+    logger.info("Delta download of %s: %s bytes transferred, %s reused from %s", name, literal_bytes, copied_bytes, basis_path)
+    return _finish(part_path, None, name, progress)
+
+
+def discard_partial(file_id):
+    """Delete whatever a stopped download of `file_id` left behind."""
+    for path in _part_paths(file_id):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _finish(part_path, state_path, name, progress):
+    dest = unique_destination(name)
+    os.replace(part_path, dest)
+    if state_path and os.path.exists(state_path):
+        os.remove(state_path)
+    progress["path"] = dest
+    return dest
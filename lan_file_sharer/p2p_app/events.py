@@ -0,0 +1,72 @@
+# p2p_app/events.py
+# In-process event bus behind the /api/events stream. Modules publish state
+# changes as they happen; every open UI tab holds one subscription, and one
+# client address may hold at most EVENT_STREAMS_PER_CLIENT of them.
+import json
+import threading
+from collections import deque
+from . import config
+
+_subscribers = set()
+_subscribers_lock = threading.Lock()
+
+
+class Subscription:
+    """Events for one listener, buffered up to config.EVENT_QUEUE_SIZE.
+
+    A listener that falls that far behind is marked `overflowed` instead of
+    holding up publishers; it should reload its state and carry on.
+    """
+
+    def __init__(self, client=None):
+        self.client = client
+        self._events = deque()
+        self._cond = threading.Condition()
+        self.overflowed = False
+
+    def _put(self, event):
+        with self._cond:
+            if len(self._events) >= config.EVENT_QUEUE_SIZE:
+                self._events.clear()
+                self.overflowed = True
+            else:
+                self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout):
+        """Next (type, data) pair, or None if nothing arrived within `timeout`."""
+        with self._cond:
+            if not self._events:
+                self._cond.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+    def close(self):
+        with _subscribers_lock:
+            _subscribers.discard(self)
+
+
+def subscribe(client=None):
+    """A new Subscription, or None if `client` already holds EVENT_STREAMS_PER_CLIENT of them."""
+    subscription = Subscription(client)
+    with _subscribers_lock:
+        if client is not None and sum(s.client == client for s in _subscribers) >= config.EVENT_STREAMS_PER_CLIENT:
+            return None
+        _subscribers.add(subscription)
+    return subscription
+
+
+def has_subscribers():
+    return bool(_subscribers)
+
+
+def publish(event_type, data):
+    """Hand an event to every subscriber. Never blocks on slow listeners."""
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    for subscription in subscribers:
+        subscription._put((event_type, data))
+
+
+def format_sse(event_type, data):
+    """One Server-Sent Events message."""
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
@@ -1,73 +1,626 @@
 # p2p_app/file_handler.py
+import logging
 import os
+import bisect
 import hashlib
 import json
+import threading
+import time
+from collections import deque
+from . import blobstore
+from . import compression
+from . import config
+from . import events
+from . import hashing
+from . import manifest
+from . import search_index
+from . import share_index
+from . import transfer
+
+logger = logging.getLogger(__name__)
 
 # This will store metadata about shared files
-# Key: file_id (e.g., a hash of the path or a UUID)
-# Value: dict {name, path, size, password_hash (optional), id}
+# Key: file_id (SHA-256 of the file content; a provisional "pending-" ID until hashed)
+# Value: dict {id, name, path, size, password_hash (optional), hash, merkle_root, stat_key, share_id}
+# The same content shared under several paths is listed once; the share
+# index (share_index.py) keeps every path.
 shared_files_metadata = {}
+# Path of each listed file -> its file ID
+_path_ids = {}
+# What the user shared (single files and directories), by share ID, as
+# recorded in the share index plus {scanning}
+shares = {}
+# Provisional IDs handed out before hashing finished, mapped to the content ID
+file_id_aliases = {}
+# Hashing completes on worker threads, so every access to the dicts above goes through this lock
+_metadata_lock = threading.RLock()
+
+PENDING_ID_PREFIX = "pending-"
+SCAN_BATCH_SIZE = 1000 # Files indexed per database transaction during a scan
+
+# Catalog version: bumped on every change to what peers see in /p2p/list_files.
+# It starts from the clock so a restarted peer never hands out a version an
+# old client has already seen.
+catalog_version = int(time.time() * 1000)
+# Recent changes, oldest first: (version, file_id, remote entry or None if removed)
+_catalog_changes = deque(maxlen=config.CATALOG_CHANGE_LOG_SIZE)
+# Serialised full listing, reused until the version changes: (version, bytes)
+_listing_cache = (None, b"")
+# File IDs in listing order, for paged listings: (version, sorted IDs)
+_sorted_ids_cache = (None, [])
+# Shares with a UI update scheduled
+_pending_share_events = set()
+_pending_share_events_lock = threading.Lock()
+# Called with the new version after every change (while holding _metadata_lock, so keep them quick)
+_catalog_listeners = []
+# Names of the listed files, for /p2p/search; updated with every listing change
+_search_index = search_index.TrigramIndex()
+
+def generate_file_id(content_hash):
+    # Files are identified by what they contain, so the same bytes get the same
+    # ID on every peer no matter where they live on disk.
+    return content_hash
+
+def provisional_file_id(filepath):
+    path_hash = hashlib.sha256(os.path.abspath(filepath).encode()).hexdigest()
+    return f"{PENDING_ID_PREFIX}{path_hash[:32]}"
+
+def resolve_file_id(file_id):
+    with _metadata_lock:
+        return file_id_aliases.get(file_id, file_id)
+
+def get_file_metadata(file_id):
+    with _metadata_lock:
+        return shared_files_metadata.get(file_id_aliases.get(file_id, file_id))
+
+def _hash_password(password):
+    if not password:
+        return None
+    # In a real app, use a strong hashing algorithm like bcrypt or scrypt
+    return hashlib.sha256(password.encode()).hexdigest()
+
+def add_shared_file(filepath, password=None, name=None):
+    """Share a file. Returns at once; the content hash is filled in by a worker.
 
-def generate_file_id(filepath):
-    # Simple ID generator based on path hash for now
-    return hashlib.md5(filepath.encode()).hexdigest()
+    `name` is what peers see, by default the file's own name. Sharing a blob
+    from the upload store hands this share the caller's reference to it.
 
-def add_shared_file(filepath, password=None):
+    If the file has been hashed before (same device, inode, size and mtime)
+    the cached hash is used and the returned ID is already the final one.
+    Otherwise a provisional ID is returned, which keeps resolving to the
+    entry after it is re-keyed under its content ID.
+    """
     if not os.path.exists(filepath):
-        print(f"Error: File not found - {filepath}")
+        logger.warning("File not found - %s", filepath)
         return None, "File not found"
     if not os.path.isfile(filepath):
-        # For now, only single files. Folder sharing will be an enhancement.
-        print(f"Error: Path is not a file - {filepath}")
-        return None, "Path is not a file"
+        logger.warning("Path is not a file - %s", filepath)
+        return None, "Path is not a file (use add_shared_directory for folders)"
 
-    file_id = generate_file_id(filepath)
-    filename = os.path.basename(filepath)
-    filesize = os.path.getsize(filepath)
+    filepath = os.path.abspath(filepath)
+    filename = name or os.path.basename(filepath)
+    st = os.stat(filepath)
+    password_hash = _hash_password(password)
 
-    password_hash = None
-    if password:
-        # In a real app, use a strong hashing algorithm like bcrypt or scrypt
-        password_hash = hashlib.sha256(password.encode()).hexdigest()
+    share_id = _new_share(filepath, "file", filename, password_hash)
+    share_index.put_files([share_index.file_row(filepath, share_id, filename, st)])
+    file_id = _share_path(filepath, st, share_id, filename, password_hash)
+    _share_changed(share_id)
+    return file_id, "File added successfully"
+
+def add_shared_directory(dirpath, password=None, name=None):
+    """Share every file under a directory. Returns (share, message); share is None on error.
+
+    The directory is walked in the background; files appear in the listing
+    as the walk finds them and are hashed like single shared files.
+    """
+    if not os.path.isdir(dirpath):
+        logger.warning("Not a directory - %s", dirpath)
+        return None, "Directory not found"
+    dirpath = os.path.abspath(dirpath)
+    share_name = name or os.path.basename(dirpath.rstrip(os.sep)) or dirpath
+    share_id = _new_share(dirpath, "dir", share_name, _hash_password(password))
+    rescan_share(share_id)
+    return get_share(share_id), "Directory added; its files are being indexed"
+
+def _new_share(path, kind, name, password_hash):
+    # Sharing the same path again replaces the earlier share
+    for share in list(shares.values()):
+        if share["path"] == path:
+            remove_share(share["id"])
+    share_id = share_index.add_share(path, kind, name, password_hash)
+    with _metadata_lock:
+        shares[share_id] = {
+            "id": share_id, "path": path, "kind": kind, "name": name,
+            "password_hash": password_hash, "added_at": time.time(), "scanned_at": None,
+            "scanning": False,
+        }
+    return share_id
+
+def _share_path(filepath, st, share_id, name, password_hash, known=None):
+    """Put one indexed file into the listing. Returns its file ID.
 
-    shared_files_metadata[file_id] = {
+    `known` is a hash the share index already holds for this exact stat;
+    otherwise the hash cache is asked and, on a miss, the file is queued for
+    hashing.
+    """
+    cached = known or hashing.lookup(st)
+    if cached:
+        file_id = generate_file_id(cached["sha256"])
+    else:
+        file_id = provisional_file_id(filepath)
+
+    meta = {
         "id": file_id,
-        "name": filename,
+        "name": name,
         "path": filepath, # Store full path for local access
-        "size": filesize,
-        "password_hash": password_hash
+        "size": st.st_size,
+        "password_hash": password_hash,
+        "hash": cached["sha256"] if cached else None,
+        "merkle_root": cached["merkle_root"] if cached else None,
+        "stat_key": hashing.stat_key(st) if cached else None,
+        "share_id": share_id,
     }
-    print(f"Sharing file: {filename} (ID: {file_id})")
-    return file_id, "File added successfully"
+    with _metadata_lock:
+        replaced = shared_files_metadata.get(file_id)
+        if replaced is not None:
+            # The same content under another path: one listing entry serves
+            # both, and the other path stays indexed in case this one goes
+            _path_ids.pop(replaced["path"], None)
+        shared_files_metadata[file_id] = meta
+        _path_ids[filepath] = file_id
+        _record_change(file_id, meta)
+    if cached and not known:
+        share_index.set_hash(filepath, st, cached["sha256"], cached["merkle_root"])
+    elif not cached:
+        hashing.hash_file_async(filepath, lambda st, entry, error: _on_hash_complete(file_id, filepath, st, entry, error))
+    return file_id
+
+def _on_hash_complete(provisional_id, filepath, st, entry, error):
+    with _metadata_lock:
+        meta = shared_files_metadata.get(provisional_id)
+        if not meta or meta["path"] != filepath:
+            return # Unshared (or replaced) while it was being hashed
+        if error:
+            logger.warning("Error hashing %s: %s", filepath, error)
+            return
+        content_id = generate_file_id(entry["sha256"])
+        del shared_files_metadata[provisional_id]
+        _record_change(provisional_id, None)
+        meta.update({
+            "id": content_id,
+            "size": st.st_size,
+            "hash": entry["sha256"],
+            "merkle_root": entry["merkle_root"],
+            "stat_key": hashing.stat_key(st),
+        })
+        replaced = shared_files_metadata.get(content_id)
+        if replaced is not None:
+            _path_ids.pop(replaced["path"], None)
+        shared_files_metadata[content_id] = meta
+        _path_ids[filepath] = content_id
+        file_id_aliases[provisional_id] = content_id
+        _record_change(content_id, meta)
+    share_index.set_hash(filepath, st, entry["sha256"], entry["merkle_root"])
+    _share_changed(meta["share_id"])
+
+def _forget_paths(paths):
+    """Take files out of the listing (the caller updates the index).
+
+    Where another indexed path holds the same content, it takes over the
+    listing entry.
+    """
+    orphaned_hashes = set()
+    with _metadata_lock:
+        for path in paths:
+            file_id = _path_ids.pop(path, None)
+            if file_id is None:
+                continue
+            meta = shared_files_metadata.pop(file_id)
+            _record_change(file_id, None)
+            for alias in [a for a, target in file_id_aliases.items() if target == file_id]:
+                del file_id_aliases[alias]
+            if meta["hash"]:
+                orphaned_hashes.add(meta["hash"])
+    for content_hash in orphaned_hashes:
+        _reinstate(content_hash, paths)
+
+def _reinstate(content_hash, excluded_paths):
+    excluded = set(excluded_paths)
+    for row in share_index.find_by_hash(content_hash):
+        share = shares.get(row["share_id"])
+        if share is None or row["path"] in excluded or not os.path.exists(row["path"]):
+            continue
+        _share_path(row["path"], _IndexedStat.from_row(row), share["id"], row["name"], share["password_hash"],
+                    known=_known_hash(row))
+        return
 
 def remove_shared_file(file_id):
-    if file_id in shared_files_metadata:
-        print(f"Stopped sharing file: {shared_files_metadata[file_id]['name']}")
-        del shared_files_metadata[file_id]
-        return True
-    return False
+    """Stop sharing one file. For a file shared on its own this removes the whole share.
 
-def get_shared_files_metadata_for_remote():
-    # Return a list of metadata suitable for sending to remote peers
+    A file removed from a shared directory comes back at the next rescan if
+    it is still there.
+    """
+    meta = get_file_metadata(file_id)
+    if meta is None:
+        return False
+    share = shares.get(meta["share_id"])
+    if share is not None and share["kind"] == "file":
+        return remove_share(share["id"])
+    logger.info("Stopped sharing file: %s", meta['name'])
+    share_index.remove_files([meta["path"]])
+    _forget_paths([meta["path"]])
+    _release_blob(meta["path"])
+    if meta["share_id"] is not None:
+        _share_changed(meta["share_id"])
+    return True
+
+def remove_share(share_id):
+    """Stop sharing a file or directory share and everything in it."""
+    with _metadata_lock:
+        share = shares.pop(share_id, None)
+    if share is None:
+        return False
+    logger.info("Stopped sharing %s: %s", "directory" if share['kind'] == 'dir' else "file", share['name'])
+    paths = [row["path"] for row in share_index.iter_files(share_id)]
+    share_index.remove_share(share_id)
+    _forget_paths(paths)
+    for path in paths:
+        _release_blob(path)
+    events.publish("share-removed", {"id": share_id})
+    return True
+
+def _release_blob(path):
+    # Uploaded files live in the blob store; the space is freed with the last share
+    content_hash = blobstore.blob_hash(path)
+    if content_hash:
+        blobstore.release(content_hash)
+
+# --- Mirrors: peer content held in the local cache (content_cache.py) ---
+
+def add_mirror(path, content_hash, merkle_root, name):
+    """List a cached copy of someone else's file to peers. A file we share ourselves takes precedence."""
+    file_id = generate_file_id(content_hash)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    with _metadata_lock:
+        if file_id in shared_files_metadata:
+            return
+        meta = {
+            "id": file_id,
+            "name": name,
+            "path": path,
+            "size": st.st_size,
+            "password_hash": None, # Only unprotected files are cached
+            "hash": content_hash,
+            "merkle_root": merkle_root,
+            "stat_key": hashing.stat_key(st),
+            "share_id": None,
+            "mirror": True,
+        }
+        shared_files_metadata[file_id] = meta
+        _path_ids[path] = file_id
+        _record_change(file_id, meta)
+
+def remove_mirror(content_hash):
+    with _metadata_lock:
+        meta = shared_files_metadata.get(generate_file_id(content_hash))
+        if meta is None or not meta.get("mirror"):
+            return
+    _forget_paths([meta["path"]])
+
+# --- Directory scans ---
+
+def rescan_share(share_id):
+    """Walk a directory share again in the background, picking up only what changed.
+
+    Returns False if the share doesn't exist, isn't a directory or is being
+    scanned already.
+    """
+    with _metadata_lock:
+        share = shares.get(share_id)
+        if share is None or share["kind"] != "dir" or share["scanning"]:
+            return False
+        share["scanning"] = True
+    _share_changed(share_id)
+    threading.Thread(target=_scan_share, args=(share,), name=f"scan-{share_id}", daemon=True).start()
+    return True
+
+def _scan_share(share):
+    started = time.monotonic()
+    try:
+        changed, removed = share_index.scan_changes(share["id"], share["path"])
+        if removed:
+            share_index.remove_files(removed)
+            _forget_paths(removed)
+        for start in range(0, len(changed), SCAN_BATCH_SIZE):
+            if share["id"] not in shares:
+                return # Unshared mid-scan
+            batch = changed[start:start + SCAN_BATCH_SIZE]
+            # Modified files drop their old listing entry (and hash) first
+            _forget_paths([path for path, _st in batch])
+            rows = []
+            for path, st in batch:
+                rel_path = os.path.relpath(path, share["path"]).replace(os.sep, "/")
+                rows.append(share_index.file_row(path, share["id"], f"{share['name']}/{rel_path}", st))
+            share_index.put_files(rows)
+            for row, (path, st) in zip(rows, batch):
+                _share_path(path, st, share["id"], row["name"], share["password_hash"])
+            _share_changed(share["id"])
+        share_index.mark_scanned(share["id"])
+        share["scanned_at"] = time.time()
+        logger.info("Scanned %s in %.1fs: %s new or changed, %s removed",
+                    share['path'], time.monotonic() - started, len(changed), len(removed))
+    except Exception as e: # Report it; the share stays as last indexed
+        logger.error("Error scanning %s: %s", share['path'], e)
+    finally:
+        share["scanning"] = False
+        _share_changed(share["id"])
+
+def start_rescanner():
+    """Rescan directory shares every SHARE_RESCAN_INTERVAL seconds (0 turns this off)."""
+    if not config.SHARE_RESCAN_INTERVAL:
+        return
+    def rescan_loop():
+        while True:
+            time.sleep(config.SHARE_RESCAN_INTERVAL)
+            for share_id in list(shares):
+                rescan_share(share_id)
+    threading.Thread(target=rescan_loop, name="share-rescan", daemon=True).start()
+
+# --- Startup ---
+
+class _IndexedStat:
+    """The stat fields an index row keeps, enough for hashing.stat_key()."""
+    def __init__(self, st_size, st_mtime_ns, st_ino, st_dev):
+        self.st_size = st_size
+        self.st_mtime_ns = st_mtime_ns
+        self.st_ino = st_ino
+        self.st_dev = st_dev
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row["size"], row["mtime_ns"], row["ino"], row["dev"])
+
+def _known_hash(row):
+    # An index row's hash counts once its manifest is there too (same rule as hashing.lookup)
+    if not row["sha256"] or not os.path.exists(manifest.manifest_path(row["sha256"])):
+        return None
+    return {"sha256": row["sha256"], "merkle_root": row["merkle_root"]}
+
+def load_shares():
+    """Restore the shares recorded in the index, without walking any directory.
+
+    Files that were hashed keep their content IDs; the rest are queued for
+    hashing again. Directory shares catch up on changes at their next
+    rescan, but single shared files are never rescanned, so those are
+    stat'ed here and taken as new if they changed while the node was down.
+    Uploaded blobs get their references back, so call this before
+    blobstore.sweep().
+    """
+    for share in share_index.list_shares():
+        share["scanning"] = False
+        with _metadata_lock:
+            shares[share["id"]] = share
+    count = 0
+    for row in share_index.iter_files():
+        share = shares.get(row["share_id"])
+        if share is None:
+            continue
+        content_hash = blobstore.blob_hash(row["path"])
+        if content_hash:
+            blobstore.acquire(content_hash)
+        st, known = _IndexedStat.from_row(row), _known_hash(row)
+        if share["kind"] == "file":
+            try:
+                current = os.stat(row["path"])
+            except OSError as e:
+                logger.warning("Shared file %s is unavailable: %s", row["path"], e)
+                continue
+            if (current.st_size, current.st_mtime_ns, current.st_ino) != (row["size"], row["mtime_ns"], row["ino"]):
+                # Changed since it was indexed: the stored hash is for the old contents
+                share_index.put_files([share_index.file_row(row["path"], share["id"], row["name"], current)])
+                st, known = current, None
+        _share_path(row["path"], st, share["id"], row["name"], share["password_hash"], known=known)
+        count += 1
+    if shares:
+        logger.info("Restored %s shares (%s files) from the share index", len(shares), count)
+
+# --- Share summaries for the local UI ---
+
+def get_share(share_id):
+    share = shares.get(share_id)
+    if share is None:
+        return None
+    stats = share_index.share_stats(share_id)
+    return {
+        "id": share["id"],
+        "kind": share["kind"],
+        "name": share["name"],
+        "path": share["path"],
+        "has_password": bool(share["password_hash"]),
+        "added_at": share["added_at"],
+        "scanned_at": share["scanned_at"],
+        "scanning": share["scanning"],
+        "file_count": stats["file_count"],
+        "hashed_count": stats["hashed_count"],
+        "size": stats["size"],
+        # The listing entry of a single-file share (None while it is not listed)
+        "file_id": _path_ids.get(share["path"]) if share["kind"] == "file" else None,
+    }
+
+def list_shares():
+    return [share for share in map(get_share, list(shares)) if share is not None]
+
+def _share_changed(share_id):
+    # A directory scan or hash run changes thousands of files a second, so
+    # UI updates are sent per share, at most every SHARE_EVENT_INTERVAL
+    with _pending_share_events_lock:
+        if share_id in _pending_share_events:
+            return
+        _pending_share_events.add(share_id)
+    timer = threading.Timer(config.SHARE_EVENT_INTERVAL, _publish_share, args=(share_id,))
+    timer.daemon = True
+    timer.start()
+
+def _publish_share(share_id):
+    with _pending_share_events_lock:
+        _pending_share_events.discard(share_id)
+    share = get_share(share_id)
+    if share is not None:
+        events.publish("share-updated", share)
+
+def _remote_entry(meta):
+    # Metadata suitable for sending to remote peers
     # (omitting local full path for security/privacy)
-    files_for_remote = []
-    for file_id, meta in shared_files_metadata.items():
-        files_for_remote.append({
-            "id": meta["id"],
-            "name": meta["name"],
-            "size": meta["size"],
-            "has_password": bool(meta["password_hash"]) # Don't send the hash itself
-        })
-    return files_for_remote
+    return {
+        "id": meta["id"],
+        "name": meta["name"],
+        "size": meta["size"],
+        "hash": meta["hash"], # None while the file is still being hashed
+        "merkle_root": meta["merkle_root"],
+        "has_password": bool(meta["password_hash"]), # Don't send the hash itself
+        "mirror": bool(meta.get("mirror")), # A cached copy of another peer's file
+    }
+
+def _record_change(file_id, meta):
+    # Caller holds _metadata_lock
+    global catalog_version
+    catalog_version += 1
+    entry = _remote_entry(meta) if meta else None
+    _catalog_changes.append((catalog_version, file_id, entry))
+    if meta:
+        _search_index.add(file_id, meta["name"])
+    else:
+        _search_index.remove(file_id)
+    for listener in _catalog_listeners:
+        listener(catalog_version)
+
+def add_catalog_listener(callback):
+    _catalog_listeners.append(callback)
+
+def get_shared_files_metadata_for_remote():
+    with _metadata_lock:
+        return [_remote_entry(meta) for meta in shared_files_metadata.values()]
+
+def catalog_etag(version):
+    return f'"{version}"'
+
+def get_catalog_version():
+    with _metadata_lock:
+        return catalog_version
+
+def get_serialized_listing():
+    """(version, JSON bytes) of the full remote listing, serialised once per version."""
+    global _listing_cache
+    with _metadata_lock:
+        if _listing_cache[0] != catalog_version:
+            body = json.dumps(get_shared_files_metadata_for_remote()).encode("utf-8")
+            _listing_cache = (catalog_version, body)
+        return _listing_cache
+
+def get_listing_page(after=None, limit=None):
+    """One page of the remote listing, in file ID order.
+
+    Returns {version, files, next}; `next` is the `after` to ask for the
+    following page, or None after the last one. Peers page through a large
+    catalog instead of fetching it as one document, and the ID order means
+    a change between pages can't shift entries into a page already read.
+    """
+    global _sorted_ids_cache
+    limit = max(1, min(limit or config.LISTING_PAGE_SIZE, config.LISTING_PAGE_SIZE))
+    with _metadata_lock:
+        if _sorted_ids_cache[0] != catalog_version:
+            _sorted_ids_cache = (catalog_version, sorted(shared_files_metadata))
+        ids = _sorted_ids_cache[1]
+        start = bisect.bisect_right(ids, after) if after else 0
+        page = ids[start:start + limit]
+        return {
+            "version": catalog_version,
+            "files": [_remote_entry(shared_files_metadata[file_id]) for file_id in page],
+            "next": page[-1] if start + limit < len(ids) else None,
+        }
+
+def get_catalog_changes(since):
+    """What changed in the remote listing after version `since`.
+
+    Returns {version, since, full: False, added, removed} with the net effect
+    of the changes, or {version, full: True, files} with the whole listing
+    when `since` is older than the change log (or not a version of ours).
+    """
+    with _metadata_lock:
+        oldest_known = _catalog_changes[0][0] - 1 if _catalog_changes else catalog_version
+        if since > catalog_version or since < oldest_known:
+            return {"version": catalog_version, "full": True, "files": get_shared_files_metadata_for_remote()}
+        latest = {}
+        for version, file_id, entry in _catalog_changes:
+            if version > since:
+                latest[file_id] = entry
+        return {
+            "version": catalog_version,
+            "since": since,
+            "full": False,
+            "added": [entry for entry in latest.values() if entry is not None],
+            "removed": [file_id for file_id, entry in latest.items() if entry is None],
+        }
+
+def search_files(query, limit):
+    """Listed files whose names match `query`, best first (see search_index.py).
+
+    Returns {version, results, truncated}: the remote entries of up to
+    `limit` files, each with its "score".
+    """
+    hits, truncated = _search_index.search(query, limit, config.SEARCH_MAX_CANDIDATES)
+    with _metadata_lock:
+        results = []
+        for score, file_id, _name in hits:
+            meta = shared_files_metadata.get(file_id)
+            if meta is not None:  # Unless removed since the search
+                entry = _remote_entry(meta)
+                entry["score"] = score
+                results.append(entry)
+        return {"version": catalog_version, "results": results, "truncated": truncated}
+
+def files_in_folder(folder):
+    """IDs of the listed files under `folder`, as peers see names ("Music/Live/a.mp3" is under "Music")."""
+    prefix = folder.strip("/") + "/"
+    with _metadata_lock:
+        return sorted((meta["name"], file_id) for file_id, meta in shared_files_metadata.items()
+                      if meta["name"].startswith(prefix))
 
 def get_file_path_and_password_hash(file_id):
-    meta = shared_files_metadata.get(file_id)
+    meta = get_file_metadata(file_id)
     if meta:
         return meta["path"], meta["password_hash"]
     return None, None
 
+def get_file_name(file_id):
+    meta = get_file_metadata(file_id)
+    return meta["name"] if meta else None
+
+def get_content_etag(file_id):
+    """ETag derived from the content hash, or None if the file changed since hashing."""
+    meta = get_file_metadata(file_id)
+    if not meta or not meta["hash"]:
+        return None
+    try:
+        if hashing.stat_key(os.stat(meta["path"])) != meta["stat_key"]:
+            return None
+    except OSError:
+        return None
+    return f'"sha256-{meta["hash"]}"'
+
+def get_file_manifest(file_id):
+    """Chunk hash manifest of a shared file, or None if it is not hashed yet."""
+    meta = get_file_metadata(file_id)
+    if not meta or not meta["hash"]:
+        return None
+    return manifest.load_manifest(meta["hash"])
+
 def verify_password(file_id, password_attempt):
-    meta = shared_files_metadata.get(file_id)
+    meta = get_file_metadata(file_id)
     if not meta:
         return False # File not found
     if not meta["password_hash"]:
@@ -76,6 +629,38 @@ def verify_password(file_id, password_attempt):
     attempted_hash = hashlib.sha256(password_attempt.encode()).hexdigest()
     return attempted_hash == meta["password_hash"]
 
+def authorize_download(file_id, password_attempt):
+    """Checks shared by every path that serves a file to a peer.
+
+    Returns (filepath, None, None) if the file may be sent, otherwise
+    (None, error_message, http_status).
+    """
+    filepath, password_hash = get_file_path_and_password_hash(file_id)
+    if not filepath:
+        return None, "File not found or not shared", 404
+    if not os.path.exists(filepath): # Double check file still exists
+        remove_shared_file(file_id) # Clean up metadata if file is gone
+        return None, "File no longer available on server", 410 # Gone
+    if password_hash and not verify_password(file_id, password_attempt):
+        return None, "Incorrect password", 403
+    return filepath, None, None
+
+def plan_download(file_id, filepath, range_header=None, if_range=None, accept_encoding=None):
+    """Status, headers and body segments for sending a shared file (see transfer.plan_file_segments).
+
+    With `accept_encoding`, the body may be compressed: headers then carry
+    Content-Encoding (see compression.negotiate).
+    """
+    name = get_file_name(file_id) or os.path.basename(filepath)
+    status, headers, segments = transfer.plan_file_segments(
+        filepath, range_header, if_range,
+        transfer.guess_content_type(name),
+        etag=get_content_etag(file_id),
+    )
+    headers["Content-Disposition"] = transfer.content_disposition(name)
+    compression.negotiate(filepath, name, headers, accept_encoding)
+    return status, headers, segments
+
 # Example usage (for testing this module directly)
 if __name__ == '__main__':
     # Create dummy files for testing
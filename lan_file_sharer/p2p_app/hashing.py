@@ -0,0 +1,184 @@
+# p2p_app/hashing.py
+# Background SHA-256 hashing of shared files with a persistent on-disk cache.
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import config
+from . import manifest
+
+logger = logging.getLogger(__name__)
+
+# Cache of content hashes that survives restarts.
+# Key: "dev:inode:size:mtime_ns", Value: dict {sha256, merkle_root, chunk_size}
+# The chunk hash list itself lives in the manifest store (see manifest.py).
+_hash_cache = None
+_cache_lock = threading.Lock()
+_save_timer = None
+SAVE_DELAY = 2.0  # seconds; batches cache writes while many files are being hashed
+
+_executor = ThreadPoolExecutor(max_workers=config.HASH_WORKERS, thread_name_prefix="hasher")
+
+
+class FileChangedError(Exception):
+    pass
+
+
+def stat_key(stat_result):
+    """Cache key identifying one version of one file on this machine."""
+    return f"{stat_result.st_dev}:{stat_result.st_ino}:{stat_result.st_size}:{stat_result.st_mtime_ns}"
+
+
+def _load_cache():
+    global _hash_cache
+    if _hash_cache is None:
+        try:
+            with open(config.HASH_CACHE_PATH, "r") as f:
+                _hash_cache = json.load(f)
+        except (OSError, ValueError):
+            _hash_cache = {}
+    return _hash_cache
+
+
+def _save_cache():
+    global _save_timer
+    with _cache_lock:
+        _save_timer = None
+        snapshot = dict(_load_cache())
+    os.makedirs(os.path.dirname(config.HASH_CACHE_PATH), exist_ok=True)
+    tmp_path = config.HASH_CACHE_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, config.HASH_CACHE_PATH)
+    except OSError as e:
+        logger.error("Error saving hash cache: %s", e)
+
+
+def _schedule_save():
+    # Caller must hold _cache_lock
+    global _save_timer
+    if _save_timer is None:
+        _save_timer = threading.Timer(SAVE_DELAY, _save_cache)
+        _save_timer.daemon = True
+        _save_timer.start()
+
+
+def lookup(stat_result):
+    """Return the cached entry for this exact file version, or None.
+
+    Entries written before manifests existed, or whose manifest was lost or
+    used another chunk size, count as misses so the file gets hashed again.
+    """
+    with _cache_lock:
+        entry = _load_cache().get(stat_key(stat_result))
+    if not entry or entry.get("chunk_size") != config.MANIFEST_CHUNK_SIZE:
+        return None
+    if not os.path.exists(manifest.manifest_path(entry["sha256"])):
+        return None
+    return entry
+
+
+def store(stat_result, entry):
+    with _cache_lock:
+        _load_cache()[stat_key(stat_result)] = entry
+        _schedule_save()
+
+
+def flush():
+    """Write pending cache updates now (e.g. on shutdown)."""
+    with _cache_lock:
+        if _save_timer is not None:
+            _save_timer.cancel()
+    _save_cache()
+
+
+class StreamHasher:
+    """SHA-256 and manifest chunk hashes of a byte stream, fed as it arrives."""
+
+    def __init__(self):
+        self.chunk_size = config.MANIFEST_CHUNK_SIZE
+        self.size = 0
+        self.chunk_hashes = []
+        self._digest = hashlib.sha256()
+        self._chunk_digest = hashlib.sha256()
+        self._chunk_len = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        self._digest.update(view)
+        self.size += len(view)
+        while view:
+            take = min(len(view), self.chunk_size - self._chunk_len)
+            self._chunk_digest.update(view[:take])
+            self._chunk_len += take
+            view = view[take:]
+            if self._chunk_len == self.chunk_size:
+                self._end_chunk()
+
+    def _end_chunk(self):
+        self.chunk_hashes.append(self._chunk_digest.hexdigest())
+        self._chunk_digest = hashlib.sha256()
+        self._chunk_len = 0
+
+    def finish(self):
+        """Save the chunk manifest and return the hash cache entry for the stream."""
+        if self._chunk_len:
+            self._end_chunk()
+        content_hash = self._digest.hexdigest()
+        file_manifest = manifest.build_manifest(content_hash, self.size, self.chunk_size, self.chunk_hashes)
+        manifest.save_manifest(file_manifest)
+        return {
+            "sha256": content_hash,
+            "merkle_root": file_manifest["merkle_root"],
+            "chunk_size": self.chunk_size,
+        }
+
+
+def compute_file_hash(filepath):
+    """Stream the file once, computing its SHA-256 and per-chunk hashes.
+
+    Saves the chunk manifest and returns (stat_result, entry).
+    """
+    st = os.stat(filepath)
+    hasher = StreamHasher()
+    with open(filepath, "rb") as f:
+        while True:
+            block = f.read(config.HASH_READ_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+    after = os.stat(filepath)
+    if stat_key(after) != stat_key(st):
+        raise FileChangedError(f"File changed while it was being hashed: {filepath}")
+    return st, hasher.finish()
+
+
+def _hash_job(filepath, attempts=3):
+    for attempt in range(attempts):
+        try:
+            st, entry = compute_file_hash(filepath)
+        except FileChangedError:
+            if attempt == attempts - 1:
+                raise
+            continue
+        store(st, entry)
+        return st, entry
+
+
+def hash_file_async(filepath, callback):
+    """Hash `filepath` in the worker pool and call callback(stat_result, entry, error).
+
+    Check lookup() first; this always reads the whole file.
+    """
+    def run():
+        try:
+            st, entry = _hash_job(filepath)
+        except Exception as e:  # Reported to the caller, the pool must keep running
+            callback(None, None, e)
+            return
+        callback(st, entry, None)
+
+    return _executor.submit(run)
@@ -0,0 +1,71 @@
+# p2p_app/logs.py
+# Logging setup for the node: one leveled stream on stderr, with a rate limit
+# so a flood of the same message (a peer refusing every connection, a burst
+# of malformed beacons) costs a few lines instead of one per event.
+#
+# Records are limited per logger and message template (the unformatted msg),
+# so "Peer %s timed out" counts as one message whatever the peer. When a
+# template's window ends, its next record notes how many were dropped.
+import logging
+import threading
+import time
+from . import config, metrics
+
+FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+_MAX_TRACKED = 1024  # message templates remembered at once
+
+suppressed_total = metrics.counter(
+    "log_messages_suppressed_total", "Log records dropped by the rate limit.", ("logger",))
+
+
+class RateLimitFilter(logging.Filter):
+    """Pass at most `limit` records per (logger, template) every `window` seconds."""
+
+    def __init__(self, limit=config.LOG_RATE_LIMIT, window=config.LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._counts = {}  # (logger, template) -> [window start, passed, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.limit <= 0:
+            return True
+        key = (record.name, record.msg if isinstance(record.msg, str) else type(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            state = self._counts.get(key)
+            if state is None or now - state[0] >= self.window:
+                dropped = state[2] if state else 0
+                if len(self._counts) >= _MAX_TRACKED and state is None:
+                    self._expire(now)
+                self._counts[key] = [now, 1, 0]
+            elif state[1] < self.limit:
+                state[1] += 1
+                return True
+            else:
+                state[2] += 1
+                suppressed_total.inc(record.name)
+                return False
+        if dropped:
+            record.msg = f"{record.getMessage()} ({dropped} more like this suppressed)"
+            record.args = None
+        return True
+
+    def _expire(self, now):
+        for key in [key for key, state in self._counts.items() if now - state[0] >= self.window]:
+            del self._counts[key]
+        if len(self._counts) >= _MAX_TRACKED:
+            self._counts.clear()
+
+
+def setup(level=None):
+    """Send the node's logs to stderr at `level` (default config.LOG_LEVEL), rate limited."""
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(FORMAT))
+    handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level or config.LOG_LEVEL)
+    # One line per HTTP request is the access log; keep it for debugging only
+    logging.getLogger("werkzeug").setLevel(logging.DEBUG if root.level <= logging.DEBUG else logging.WARNING)
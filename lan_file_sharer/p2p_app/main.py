@@ -1,4 +1,5 @@
 # p2p_app/main.py
+import logging
 import time
 import threading # For running server in a separate thread
 import os # For example shared file
@@ -6,20 +7,49 @@ from . import discovery
 from . import server
 from . import config
 from . import file_handler # For potential initial setup or testing
+from . import hashing
+from . import data_server
+from . import pex
+from . import blobstore
+from . import content_cache
+from . import logs
+
+logger = logging.getLogger(__name__)
 
 def main():
-    print("Starting P2P File Sharing Application...")
+    logs.setup()
+    logger.info("Starting P2P File Sharing Application...")
 
     my_username = input("Enter your username: ")
     
     # Find an available port for this instance
     try:
         p2p_server_port = config.find_available_port()
-        print(f"Using port {p2p_server_port} for this instance")
+        logger.info("Using port %s for this instance", p2p_server_port)
     except RuntimeError as e:
-        print(f"Error: {e}")
+        logger.error("Error: %s", e)
         return
 
+    # Shares from the last run come back from the share index (uploaded
+    # files among them reclaim their blobs). Directories aren't walked before
+    # we can start; the periodic rescan picks up what changed meanwhile
+    file_handler.load_shares()
+    file_handler.start_rescanner()
+    # Files cached from peers are offered to the LAN again as mirrors
+    content_cache.load()
+    # Uploads are only reachable while shared
+    freed = blobstore.sweep()
+    if freed:
+        logger.info("Removed %s bytes of uploads no longer shared", freed)
+
+    # Bulk file bodies are served by a separate sendfile-based server so
+    # transfers don't compete with the Flask control API.
+    try:
+        data_port = config.find_available_port(p2p_server_port + config.DATA_PORT_OFFSET)
+        data_server.start_data_server(data_port)
+    except (RuntimeError, OSError) as e:
+        logger.warning("Data transfer server not started (%s); peers will download through the main server.", e)
+
     # Set identity in discovery module first, so broadcasts are correct from the start
     # This also sets discovery.my_server_port which server.py will use via discovery module
     discovery.set_identity(username=my_username, server_port=p2p_server_port)
@@ -27,6 +57,8 @@ def main():
     # Start discovery services (threads for listening and broadcasting)
     # discovery.start_discovery will use the username and port set by set_identity
     discovery.start_discovery(username=my_username, server_port_to_advertise=p2p_server_port)
+    # Peers on other subnets are found by asking the ones we know (and any configured seeds)
+    pex.start_gossip()
 
     # Example: Share a dummy file at startup for testing
     # You'd normally do this via the frontend API
@@ -39,9 +71,9 @@ def main():
     # print(f"Added example shared file: {dummy_file_path}")
 
 
-    print(f"P2P Server will run on port {p2p_server_port}.")
-    print(f"Discovery active for user '{my_username}' advertising port {p2p_server_port}.")
-    print(f"To access the web UI (once developed), open a browser to http://127.0.0.1:{p2p_server_port} or your LAN IP.")
+    logger.info("P2P Server will run on port %s.", p2p_server_port)
+    logger.info("Discovery active for user '%s' advertising port %s.", my_username, p2p_server_port)
+    logger.info("To access the web UI (once developed), open a browser to http://127.0.0.1:%s or your LAN IP.", p2p_server_port)
 
     # Run the Flask server.
     # server.run_server now uses app.run(..., threaded=True),
@@ -51,7 +83,9 @@ def main():
     server.run_server(port=p2p_server_port, debug=False) # debug=False is better for this stage
 
     # This line will be reached when server stops (e.g. Ctrl+C)
-    print("Application shutting down.")
+    logger.info("Application shutting down.")
+    hashing.flush() # Don't lose hashes computed in the last few seconds
+    content_cache.flush()
 
     # Clean up example shared file if it was created
     # if os.path.exists(dummy_file_path):
@@ -0,0 +1,129 @@
+# p2p_app/manifest.py
+# Chunk hash lists with a Merkle root, used to verify transfers chunk by chunk.
+import hashlib
+import json
+import os
+from . import config
+
+# Leaves and inner nodes are hashed with different prefixes so an inner node
+# can never be passed off as a chunk hash.
+_NODE_PREFIX = b"\x01"
+
+
+class ChunkMismatch(Exception):
+    """A chunk's data does not hash to the value in the manifest."""
+    def __init__(self, index, chunk_start):
+        super().__init__(f"Chunk {index} (offset {chunk_start}) failed verification")
+        self.index = index
+        self.chunk_start = chunk_start
+
+
+def merkle_root(chunk_hashes):
+    """Merkle root (hex) over a list of hex chunk hashes. Odd nodes are carried up."""
+    if not chunk_hashes:
+        return hashlib.sha256(b"").hexdigest()
+    level = [bytes.fromhex(h) for h in chunk_hashes]
+    while len(level) > 1:
+        next_level = []
+        for i in range(0, len(level) - 1, 2):
+            next_level.append(hashlib.sha256(_NODE_PREFIX + level[i] + level[i + 1]).digest())
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+
+def build_manifest(content_hash, size, chunk_size, chunk_hashes):
+    return {
+        "hash": content_hash,
+        "size": size,
+        "chunk_size": chunk_size,
+        "chunks": chunk_hashes,
+        "merkle_root": merkle_root(chunk_hashes),
+    }
+
+
+def is_consistent(manifest):
+    """Check a manifest received from a peer is internally sound."""
+    try:
+        size, chunk_size, chunks = manifest["size"], manifest["chunk_size"], manifest["chunks"]
+        expected_chunks = (size + chunk_size - 1) // chunk_size if chunk_size > 0 else -1
+        return len(chunks) == expected_chunks and merkle_root(chunks) == manifest["merkle_root"]
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def manifest_path(content_hash):
+    return os.path.join(config.MANIFEST_DIR, f"{content_hash}.json")
+
+
+def save_manifest(manifest):
+    os.makedirs(config.MANIFEST_DIR, exist_ok=True)
+    path = manifest_path(manifest["hash"])
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(content_hash):
+    try:
+        with open(manifest_path(content_hash), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class ChunkVerifier:
+    """Verifies a byte stream that starts at `offset` of a file against its manifest.
+
+    Feed the data as it arrives; ChunkMismatch is raised as soon as a complete
+    chunk hashes wrong. `prefix` holds bytes already on hand for the chunk
+    containing `offset` (from the chunk start up to `offset`), so a resumed
+    transfer can still check the chunk it restarted in. Without it, that first
+    partial chunk is passed through unchecked.
+    """
+
+    def __init__(self, manifest, offset=0, prefix=b""):
+        self.chunk_size = manifest["chunk_size"]
+        self.size = manifest["size"]
+        self.chunks = manifest["chunks"]
+        self.position = offset
+        self.verified_chunks = 0
+        self._start_chunk(offset // self.chunk_size if self.chunk_size else 0)
+        if offset != self._chunk_start:
+            if len(prefix) == offset - self._chunk_start:
+                self._hasher.update(prefix)
+            else:
+                self._hasher = None  # Cannot check this chunk, only the following ones
+
+    def _start_chunk(self, index):
+        self._index = index
+        self._chunk_start = index * self.chunk_size
+        self._chunk_end = min(self._chunk_start + self.chunk_size, self.size)
+        self._hasher = hashlib.sha256()
+
+    def _close_chunk(self):
+        if self._hasher is not None:
+            if self._hasher.hexdigest() != self.chunks[self._index]:
+                raise ChunkMismatch(self._index, self._chunk_start)
+            self.verified_chunks += 1
+        self._start_chunk(self._index + 1)
+
+    def feed(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self._chunk_end - self.position)
+            if take <= 0:
+                raise ValueError("More data than the manifest describes")
+            if self._hasher is not None:
+                self._hasher.update(view[:take])
+            self.position += take
+            view = view[take:]
+            if self.position == self._chunk_end:
+                self._close_chunk()
+
+    @property
+    def verified_offset(self):
+        """Start of the chunk currently being received; earlier chunks are complete."""
+        return self._chunk_start
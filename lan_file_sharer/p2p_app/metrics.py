@@ -0,0 +1,159 @@
+# p2p_app/metrics.py
+# Counters, gauges and histograms for the hot paths, served in the Prometheus
+# text format at /metrics.
+#
+# Updating a metric is a dict update under the metric's own lock, cheap
+# enough for every chunk of a transfer. Values that already live elsewhere
+# (peer table size, beacon counts, transfers in flight) are not copied into
+# the registry; those metrics are given a function that reads them when
+# /metrics is scraped.
+#
+# Labels are for bounded sets only (endpoints, directions, peers).
+import bisect
+import math
+import threading
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PREFIX = "lfs_"
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = PREFIX + name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._collect = collect  # () -> {label values: value}, for values kept elsewhere
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _samples(self):
+        if self._collect is not None:
+            values = self._collect()
+            return {key if isinstance(key, tuple) else (key,): value for key, value in values.items()}
+        with self._lock:
+            return dict(self._values)
+
+    def value(self, *labels):
+        """Current value for the given label values (mostly for tests and the UI)."""
+        return self._samples().get(tuple(str(label) for label in labels), 0)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = tuple(str(label) for label in labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        key = tuple(str(label) for label in labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount=1):
+        key = tuple(str(label) for label in labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        key = tuple(str(label) for label in labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            return {key: ([*counts], total, count) for key, (counts, total, count) in self._values.items()}
+
+
+def counter(name, help, labels=(), collect=None):
+    return Counter(name, help, labels, collect)
+
+
+def gauge(name, help, labels=(), collect=None):
+    return Gauge(name, help, labels, collect)
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return Histogram(name, help, labels, buckets)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format (version 0.0.4)."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        try:
+            samples = metric._samples()
+        except Exception as e:  # One broken collector must not take the others down
+            lines.append(f"# {metric.name} unavailable: {e!r}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in sorted(samples.items()):
+            if metric.kind != "histogram":
+                lines.append(f"{metric.name}{_labels(metric.label_names, key)} {_number(value)}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip((*metric.buckets, math.inf), counts):
+                cumulative += bucket_count
+                le = ("le", _number(float(bound)) if bound != math.inf else "+Inf")
+                lines.append(f"{metric.name}_bucket{_labels(metric.label_names, key, le)} {cumulative}")
+            lines.append(f"{metric.name}_sum{_labels(metric.label_names, key)} {_number(total)}")
+            lines.append(f"{metric.name}_count{_labels(metric.label_names, key)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+# Shared by the Flask app (server.py) and the sendfile data server, told apart by endpoint
+http_requests_total = counter("http_requests_total", "HTTP requests handled.", ("endpoint", "method", "status"))
+http_request_seconds = histogram(
+    "http_request_duration_seconds", "Time until the response started (bodies stream on afterwards).", ("endpoint",))
@@ -2,10 +2,14 @@
 import time
 
 class Peer:
-    def __init__(self, address, port, username):
+    def __init__(self, address, port, username, data_port=None, catalog_version=None, via="multicast", node_id=None):
         self.address = address
         self.port = port
         self.username = username
+        self.data_port = data_port # Port of the peer's sendfile data server, if it runs one
+        self.catalog_version = catalog_version # Version of the peer's file listing, as last announced
+        self.via = via # How we last heard of it: "multicast" beacon, or "pex" from another peer
+        self.node_id = node_id # Random ID the node announces, the same on all of its addresses
         self.last_seen = time.time()
 
     def __repr__(self):
@@ -16,11 +20,16 @@ class Peer:
             "address": self.address,
             "port": self.port,
             "username": self.username,
+            "data_port": self.data_port,
+            "catalog_version": self.catalog_version,
+            "via": self.via,
+            "node_id": self.node_id,
             "last_seen": self.last_seen
         }
 
     @staticmethod
     def from_dict(data):
-        peer = Peer(data["address"], data["port"], data["username"])
+        peer = Peer(data["address"], data["port"], data["username"], data.get("data_port"), data.get("catalog_version"),
+                    data.get("via", "multicast"), data.get("node_id"))
         peer.last_seen = data.get("last_seen", time.time())
         return peer
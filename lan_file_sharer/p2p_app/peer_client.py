@@ -0,0 +1,319 @@
+# p2p_app/peer_client.py
+# Outgoing connections to other peers: pooled keep-alive sessions for blocking
+# calls, and an asyncio client that fans small JSON requests out to many peers.
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from . import compression
+from . import config
+
+# --- Pooled blocking sessions ---
+
+# Key: (address, port), Value: requests.Session; most recently used last
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def get_session(peer_address, peer_port):
+    """Shared keep-alive session for one peer (thread-safe for concurrent requests).
+
+    Covers both the peer's main server and its data server port.
+    """
+    key = (peer_address, int(peer_port))
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is not None:
+            _sessions.move_to_end(key)
+            return session
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=config.PEER_POOL_MAXSIZE, max_retries=0)
+        session.mount("http://", adapter)
+        session.headers["Accept-Encoding"] = compression.ACCEPT_ENCODING
+        _sessions[key] = session
+        while len(_sessions) > config.PEER_POOL_MAX_PEERS:
+            _, evicted = _sessions.popitem(last=False)
+            evicted.close()
+        return session
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def _read(response, size):
+    # response.raw.read() with the exceptions iter_content() would raise, so
+    # callers catching requests.RequestException see a broken body too
+    try:
+        return response.raw.read(size, decode_content=True)
+    except urllib3.exceptions.ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except urllib3.exceptions.DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+    except urllib3.exceptions.ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+
+
+def iter_adaptive(response):
+    """Yield a streamed response body, growing reads while the peer keeps up.
+
+    Reads start at PROXY_MIN_BUFFER and double while full buffers arrive
+    quickly; a slow read halves the size again so a trickling peer does not
+    stall the client behind one huge buffer.
+    """
+    size = config.PROXY_MIN_BUFFER
+    while True:
+        started = time.monotonic()
+        chunk = _read(response, size)
+        if not chunk:
+            return
+        yield chunk
+        elapsed = time.monotonic() - started
+        if len(chunk) == size and elapsed < 0.05:
+            size = min(size * 2, config.PROXY_MAX_BUFFER)
+        elif elapsed > 0.5:
+            size = max(size // 2, config.PROXY_MIN_BUFFER)
+
+
+def body_length(response):
+    """Length of a response's decoded body, or None if the peer didn't say.
+
+    A compressed body has no Content-Length; the peer sends the decoded
+    length as X-Uncompressed-Length instead.
+    """
+    length = response.headers.get("Content-Length")
+    if "Content-Encoding" in response.headers:
+        length = response.headers.get(compression.UNCOMPRESSED_LENGTH)
+    return int(length) if length is not None else None
+
+
+def iter_body(response, chunk_size):
+    """Yield a streamed response body, decoded, in pieces of `chunk_size` (the last may be shorter).
+
+    Unlike iter_content(), this reads through response.raw.read(), which is
+    what WireMeter needs to count a chunked body.
+    """
+    while True:
+        piece = _read(response, chunk_size)
+        if not piece:
+            return
+        yield piece
+
+
+class WireMeter:
+    """Counts what a streamed response has taken off the network, step by step.
+
+    Decoded chunks of a compressed body are larger than what arrived, and the
+    bandwidth limits are about the network, so transfers throttle by this.
+    The body has to be read with iter_body() or iter_adaptive(): urllib3
+    doesn't count the bytes of a chunked body read through stream().
+    """
+
+    def __init__(self, response):
+        self._raw = response.raw
+        self._seen = self._raw.tell()
+
+    def advance(self, *_chunk):
+        """Bytes received since the last call."""
+        now = self._raw.tell()
+        count, self._seen = now - self._seen, now
+        return count
+
+
+class PeerBusy(Exception):
+    """The peer is at its transfer limit (503); worth asking again after `retry_after` seconds."""
+    def __init__(self, retry_after):
+        super().__init__(f"Peer is busy; retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+def raise_if_busy(response):
+    """Raise PeerBusy for a 503, honouring its Retry-After (in seconds) up to PEER_BUSY_MAX_WAIT."""
+    if response.status_code != 503:
+        return
+    try:
+        retry_after = float(response.headers.get("Retry-After", 1))
+    except ValueError:  # An HTTP date; peers of this app always send seconds
+        retry_after = 1
+    raise PeerBusy(min(max(retry_after, 0), config.PEER_BUSY_MAX_WAIT))
+
+
+# --- asyncio fan-out client ---
+
+class PeerHTTPError(Exception):
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.body = body
+
+
+class AsyncPeerClient:
+    """Minimal HTTP/1.1 client on asyncio streams with per-peer keep-alive.
+
+    Meant for small control requests (listings, search, manifests) sent to
+    many peers at once; bulk bodies go through the blocking sessions above.
+    """
+
+    def __init__(self, max_concurrency, idle_per_peer):
+        self._idle = {}  # (host, port) -> [(reader, writer)]
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._idle_per_peer = idle_per_peer
+
+    async def _connect(self, host, port):
+        idle = self._idle.get((host, port))
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.open_connection(host, port)
+        return reader, writer, False
+
+    def _release(self, host, port, reader, writer, reusable):
+        idle = self._idle.setdefault((host, port), [])
+        if reusable and len(idle) < self._idle_per_peer:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _read_body(self, reader, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip(), 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b""):
+                        pass
+                    return b"".join(parts), True
+                parts.append(await reader.readexactly(size))
+                await reader.readline()
+        if "content-length" in headers:
+            return await reader.readexactly(int(headers["content-length"])), True
+        return await reader.read(), False
+
+    async def request(self, method, host, port, path, headers=None, body=None):
+        """Returns (status, headers_dict_lowercase, body_bytes)."""
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {host}:{port}", "Connection: keep-alive"]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        raw_request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+
+        reader, writer, reused = await self._connect(host, port)
+        try:
+            writer.write(raw_request)
+            await writer.drain()
+            status_line = await reader.readline()
+        except (ConnectionError, OSError):
+            status_line = b""
+        except BaseException:  # Timed out / cancelled
+            writer.close()
+            raise
+        if not status_line:
+            writer.close()
+            if reused:
+                # The peer dropped an idle keep-alive connection; try another one
+                return await self.request(method, host, port, path, headers, body)
+            raise ConnectionError("Peer closed the connection")
+
+        try:
+            status = int(status_line.split()[1])
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+            response_body, complete = await self._read_body(reader, response_headers)
+        except BaseException:
+            writer.close()
+            raise
+        reusable = complete and response_headers.get("connection", "").lower() != "close"
+        self._release(host, port, reader, writer, reusable)
+        return status, response_headers, response_body
+
+    async def get_json(self, host, port, path, timeout, headers=None):
+        """Decoded JSON body, or None for 304 Not Modified."""
+        # The timeout starts once a slot is free, so queueing behind other
+        # peers in a large fan-out does not count against this one.
+        async with self._semaphore:
+            status, _, body = await asyncio.wait_for(self.request("GET", host, port, path, headers), timeout)
+        if status == 304:
+            return None
+        if status >= 400:
+            raise PeerHTTPError(status, body)
+        return json.loads(body)
+
+
+_loop = None
+_client = None
+_loop_lock = threading.Lock()
+
+
+def _ensure_loop():
+    global _loop, _client
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="peer-fanout", daemon=True).start()
+            _client = asyncio.run_coroutine_threadsafe(_make_client(), _loop).result()
+    return _loop, _client
+
+
+async def _make_client():
+    # The semaphore must be created on the loop that uses it
+    return AsyncPeerClient(config.FANOUT_MAX_CONCURRENCY, config.FANOUT_IDLE_PER_PEER)
+
+
+def iter_fan_out_json(targets, path, timeout, headers=None):
+    """GET `path` as JSON from every (address, port) in `targets` concurrently.
+
+    Yields (target, result, error) in completion order; error is None on
+    success and result is None on failure or a 304 reply. Each peer gets
+    `timeout` seconds. `path` and `headers` may also be functions of the
+    target, for requests that differ per peer.
+    """
+    targets = list(targets)
+    if not targets:
+        return
+    loop, client = _ensure_loop()
+    results = []
+    ready = threading.Condition()
+
+    async def fetch(target):
+        try:
+            target_path = path(target) if callable(path) else path
+            target_headers = headers(target) if callable(headers) else headers
+            result = await client.get_json(target[0], target[1], target_path, timeout, target_headers)
+            outcome = (target, result, None)
+        except Exception as e:  # Every failure is reported to the caller per peer
+            outcome = (target, None, e)
+        with ready:
+            results.append(outcome)
+            ready.notify()
+
+    for target in targets:
+        asyncio.run_coroutine_threadsafe(fetch(target), loop)
+
+    delivered = 0
+    while delivered < len(targets):
+        with ready:
+            while len(results) <= delivered:
+                ready.wait()
+            outcome = results[delivered]
+        delivered += 1
+        yield outcome
+
+
+def fan_out_json(targets, path, timeout, headers=None):
+    """Like iter_fan_out_json, but returns {target: (result, error)} once all are done."""
+    return {target: (result, error) for target, result, error in iter_fan_out_json(targets, path, timeout, headers)}
@@ -0,0 +1,190 @@
+# p2p_app/pex.py
+# Peer exchange (PEX): nodes swap samples of their known-peer tables over
+# HTTP, so the peer graph spans routed subnets that multicast doesn't reach.
+#
+# Every PEX_INTERVAL a node contacts PEX_FANOUT random peers (plus any seed
+# it hasn't reached yet). Each side sends itself and up to
+# PEX_MAX_PEERS_PER_REPLY peers it knows, and each entry carries its age:
+# how long ago someone last heard from that peer first-hand. Ages keep
+# growing as entries are passed on, and entries older than PEX_MAX_AGE are
+# neither passed on nor kept, so dead peers fade out instead of circulating.
+import logging
+import random
+import socket
+import threading
+import time
+import requests
+from . import config
+from . import discovery
+from . import events
+from . import file_handler
+from . import metrics
+from . import peer_client
+from .peer import Peer
+
+logger = logging.getLogger(__name__)
+
+pex_stats = {"rounds": 0, "exchanges": 0, "failures": 0, "learned": 0}
+metrics.counter("pex_events_total", "Peer exchange rounds, exchanges, failures and peers learned.", ("kind",),
+                collect=lambda: dict(pex_stats))
+# Peers we could not reach ourselves: (address, port) -> time until we ignore gossip about them
+_unreachable = {}
+_gossip_thread = None
+
+
+def self_record():
+    return {
+        "address": discovery.my_ip,
+        "port": discovery.my_server_port,
+        "username": discovery.my_username,
+        "data_port": discovery.my_data_port,
+        "catalog_version": file_handler.get_catalog_version(),
+        "node_id": discovery.my_node_id,
+        "age": 0,
+    }
+
+
+def peer_records(exclude=None):
+    """A random sample of the peers we know, with their ages."""
+    now = time.time()
+    records = []
+    for peer in discovery.discovered_peers.values():
+        age = now - peer.last_seen
+        if age > config.PEX_MAX_AGE or (peer.address, peer.port) == exclude:
+            continue
+        records.append({
+            "address": peer.address,
+            "port": peer.port,
+            "username": peer.username,
+            "data_port": peer.data_port,
+            "catalog_version": peer.catalog_version,
+            "node_id": peer.node_id,
+            "age": round(age, 1),
+        })
+    if len(records) > config.PEX_MAX_PEERS_PER_REPLY:
+        records = random.sample(records, config.PEX_MAX_PEERS_PER_REPLY)
+    return records
+
+
+def merge_records(records):
+    """Add peers learned from another node. Returns how many were new to us.
+
+    A second-hand entry never replaces fresher knowledge of the same peer.
+    """
+    if not isinstance(records, list):
+        return 0
+    now = time.time()
+    learned = 0
+    for record in records[:config.PEX_MAX_PEERS_PER_REPLY + 1]:
+        try:
+            address = str(record["address"])
+            port = int(record["port"])
+            username = str(record["username"])
+            age = max(float(record.get("age", 0)), 0.0)
+            node_id = record.get("node_id")
+            node_id = str(node_id) if node_id else None
+        except (KeyError, TypeError, ValueError, AttributeError):
+            continue
+        if not address or age > config.PEX_MAX_AGE or discovery.is_self(address, port, username, node_id):
+            continue
+        if _unreachable.get((address, port), 0) > now:
+            continue
+        current = discovery.discovered_peers.get((address, port))
+        last_seen = now - age
+        if current is not None and current.last_seen >= last_seen:
+            continue
+        peer = Peer(address, port, username, record.get("data_port"), record.get("catalog_version"), via="pex",
+                    node_id=node_id)
+        peer.last_seen = last_seen
+        if discovery.record_peer(peer, config.PEX_MAX_AGE - age) is None:
+            learned += 1
+    pex_stats["learned"] += learned
+    return learned
+
+
+def handle_exchange(payload, remote_address):
+    """Answer a /p2p/peers request, merging what the caller sent (if anything)."""
+    exclude = None
+    if isinstance(payload, dict):
+        sender = payload.get("self")
+        if isinstance(sender, dict):
+            # Trust the address the request came from over the one it claims
+            sender = dict(sender, address=remote_address, age=0)
+            merge_records([sender])
+            exclude = (remote_address, sender.get("port"))
+        merge_records(payload.get("peers"))
+    return {"self": self_record(), "peers": peer_records(exclude)}
+
+
+def exchange(address, port):
+    """Push-pull with one node. Returns how many peers we learned."""
+    url = f"http://{address}:{port}/p2p/peers"
+    body = {"self": self_record(), "peers": peer_records(exclude=(address, port))}
+    response = peer_client.get_session(address, port).post(url, json=body, timeout=config.PEX_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
+    learned = 0
+    remote = data.get("self")
+    if isinstance(remote, dict):
+        learned += merge_records([dict(remote, address=address, port=port, age=0)])
+    learned += merge_records(data.get("peers"))
+    pex_stats["exchanges"] += 1
+    return learned
+
+
+def seed_targets():
+    targets = []
+    for seed in config.PEX_SEEDS:
+        host, _, port = seed.rpartition(":") if ":" in seed else (seed, "", "")
+        try:
+            targets.append((socket.gethostbyname(host), int(port or config.SERVER_PORT)))
+        except (OSError, ValueError):
+            logger.warning("Ignoring unusable PEX seed: %s", seed)
+    return targets
+
+
+def gossip_round():
+    known = {(peer.address, peer.port): peer for peer in discovery.discovered_peers.values()}
+    targets = random.sample(list(known), min(config.PEX_FANOUT, len(known)))
+    # Seeds bootstrap us (and heal partitions) until we hear of them some other way
+    targets += [seed for seed in seed_targets() if seed not in known and seed not in targets]
+    pex_stats["rounds"] += 1
+
+    for address, port in targets:
+        try:
+            exchange(address, port)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            pex_stats["failures"] += 1
+            peer = known.get((address, port))
+            if peer is not None and peer.via == "pex":
+                # Gossip says it exists, but we can't reach it: forget it and
+                # stop taking it back from others for a while
+                _unreachable[(address, port)] = time.time() + config.PEX_MAX_AGE
+                if discovery.discovered_peers.pop((address, port)) is not None:
+                    events.publish("peer-left", peer.to_dict())
+            elif peer is None:
+                logger.info("PEX seed %s:%s unreachable: %s", address, port, e)
+
+    now = time.time()
+    for key in [key for key, until in _unreachable.items() if until <= now]:
+        del _unreachable[key]
+
+
+def start_gossip():
+    """Run gossip rounds in a background thread (first one shortly after startup)."""
+    global _gossip_thread
+    if _gossip_thread is not None:
+        return
+
+    def gossip_loop():
+        time.sleep(random.uniform(1, 3))  # Let multicast discovery get going first
+        while True:
+            try:
+                gossip_round()
+            except Exception as e:  # Keep gossiping whatever a peer sends back
+                logger.warning("Error during peer exchange: %s", e)
+            time.sleep(discovery.jittered(config.PEX_INTERVAL))
+
+    _gossip_thread = threading.Thread(target=gossip_loop, name="pex-gossip", daemon=True)
+    _gossip_thread.start()
+    logger.info("Peer exchange started (seeds: %s)", ", ".join(config.PEX_SEEDS) or "none")
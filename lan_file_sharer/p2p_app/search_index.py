@@ -0,0 +1,144 @@
+# p2p_app/search_index.py
+# In-memory trigram index over the names of the files this node lists, kept
+# up to date as files come and go, behind /p2p/search.
+#
+# Names are lowercased and every run of punctuation becomes a space, so
+# "Live_2019-Berlin.FLAC" is indexed as " live 2019 berlin flac". Each
+# three-character window of that is a key pointing at the files containing
+# it; the leading space makes " li" mark the start of a word, which is how
+# shorter search terms work (as word prefixes; a single character only narrows
+# down what the other terms found). A term of three or more characters
+# matches anywhere in the name.
+#
+# A query intersects the smallest posting sets first, then checks and ranks
+# the survivors: terms that start a word count more than terms found inside
+# one, and a file name (the part after the last "/") that starts with or
+# equals the whole query ranks first.
+import heapq
+import itertools
+import posixpath
+import re
+import threading
+
+_SEPARATORS = re.compile(r"[\W_]+")
+MIN_TERM_LENGTH = 2
+
+
+def normalize(text):
+    return " " + _SEPARATORS.sub(" ", text.lower()).strip()
+
+
+def _trigrams(normalized):
+    # Windows spanning two words are left out: search terms never contain a space
+    grams = {normalized[i:i + 3] for i in range(len(normalized) - 2)}
+    return {gram for gram in grams if " " not in gram[1:]}
+
+
+def terms(query):
+    return normalize(query).split()
+
+
+def is_searchable(query):
+    """Whether `query` has a term long enough to look up."""
+    return any(len(term) >= MIN_TERM_LENGTH for term in terms(query))
+
+
+def _keys(term):
+    # Index keys a name must contain to match `term`
+    if len(term) < MIN_TERM_LENGTH:
+        return set()
+    return {" " + term} if len(term) < 3 else _trigrams(term)
+
+
+def score(name, query_terms, whole_query):
+    """Rank of `name` for the query, or None if it doesn't match every term."""
+    normalized = normalize(name)
+    total = 0.0
+    for term in query_terms:
+        if " " + term in normalized:
+            total += 2  # Starts a word
+        elif len(term) >= 3 and term in normalized:
+            total += 1
+        else:
+            return None
+    if " " + whole_query not in normalized:
+        return total
+    base = name.rsplit("/", 1)[-1]
+    stem = normalize(posixpath.splitext(base)[0])[1:]
+    base = normalize(base)[1:]
+    if whole_query in (base, stem):  # With or without the extension
+        total += 4
+    elif base.startswith(whole_query):
+        total += 2
+    return total
+
+
+class TrigramIndex:
+    """Trigram keys -> sets of document IDs, updated one document at a time."""
+
+    def __init__(self):
+        self._postings = {}
+        self._names = {}  # document ID -> indexed name
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, doc_id, name):
+        """Index `name` under `doc_id`, replacing what was indexed for it before."""
+        with self._lock:
+            old = self._names.get(doc_id)
+            if old == name:
+                return
+            if old is not None:
+                self._unindex(doc_id, old)
+            self._names[doc_id] = name
+            for key in _trigrams(normalize(name)):
+                postings = self._postings.get(key)
+                if postings is None:
+                    postings = self._postings[key] = set()
+                postings.add(doc_id)
+
+    def remove(self, doc_id):
+        with self._lock:
+            name = self._names.pop(doc_id, None)
+            if name is not None:
+                self._unindex(doc_id, name)
+
+    def _unindex(self, doc_id, name):
+        for key in _trigrams(normalize(name)):
+            postings = self._postings.get(key)
+            if postings is not None:
+                postings.discard(doc_id)
+                if not postings:
+                    del self._postings[key]
+
+    def search(self, query, limit, max_candidates):
+        """Best matches for `query`: ([(score, doc_id, name)], truncated).
+
+        At most `max_candidates` documents are ranked; `truncated` says there
+        were more, so a broad query stays fast but may miss a better match.
+        """
+        if not is_searchable(query):
+            return [], False
+        query_terms = terms(query)
+        keys = set().union(*(_keys(term) for term in query_terms))
+        with self._lock:
+            postings = []
+            for key in keys:
+                found = self._postings.get(key)
+                if not found:
+                    return [], False
+                postings.append(found)
+            postings.sort(key=len)
+            candidates = postings[0].intersection(*postings[1:])
+            truncated = len(candidates) > max_candidates
+            names = [(doc_id, self._names[doc_id]) for doc_id in itertools.islice(candidates, max_candidates)]
+        whole_query = " ".join(normalize(query).split())
+        ranked = []
+        for doc_id, name in names:
+            rank = score(name, query_terms, whole_query)
+            if rank is not None:
+                ranked.append((rank, doc_id, name))
+        best = heapq.nsmallest(limit, ranked, key=lambda hit: (-hit[0], len(hit[2]), hit[2]))
+        return best, truncated
@@ -1,23 +1,70 @@
 # p2p_app/server.py
-from flask import Flask, jsonify, request, send_file, Response, stream_with_context, send_from_directory
+from flask import Flask, Request, g, jsonify, request, send_file, Response, send_from_directory
+import logging
 import requests # For making requests to other peers
 import urllib.parse # For decoding URL parameters
+import ipaddress
+import time
 from . import discovery
 from . import file_handler
 from . import config
+from . import data_server
+from . import downloads
+from . import download_manager
+from . import peer_client
+from . import catalog
+from . import events
+from . import pex
+from . import serving
+from . import manifest
+from . import transfer
+from . import bandwidth
+from . import blobstore
+from . import uploads
+from . import archive
+from . import content_cache
+from . import delta
+from . import compression
+from . import search_index
+from . import metrics
 import os # For __main__ test content
-import uuid
 from werkzeug.utils import secure_filename
 
+logger = logging.getLogger(__name__)
+
 # Get the absolute path to the frontend directory
 FRONTEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'frontend'))
-# Create a directory for uploaded files
-UPLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'uploads'))
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+
+class UploadRequest(Request):
+    """Streams uploaded files straight into the blob store, hashing them on the way.
+
+    Werkzeug would otherwise spool each upload to a temporary file, which we
+    then copied again. Uploads that are not committed are deleted when the
+    request closes.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return blobstore.BlobWriter()
 
 app = Flask(__name__, 
     static_folder=os.path.join(FRONTEND_DIR, 'js'),
     static_url_path='/js')
+app.request_class = UploadRequest
+
+proxy_bytes = metrics.counter("proxy_bytes_total", "File bytes relayed from peers to the UI through the download proxy.", ("peer",))
+
+@app.before_request
+def _start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def _record_request(response):
+    # Labelled by view function, so per-file and per-peer URLs share one series
+    endpoint = request.endpoint or "unmatched"
+    metrics.http_requests_total.inc(endpoint, request.method, response.status_code)
+    if "started" in g:
+        metrics.http_request_seconds.observe(time.perf_counter() - g.started, endpoint)
+    return response
 
 # Serve CSS files
 @app.route('/css/<path:filename>')
@@ -35,32 +82,240 @@ def p2p_hello():
     return jsonify({
         "message": f"Hello from {discovery.my_username}!",
         "username": discovery.my_username,
-        "server_port": discovery.my_server_port
+        "server_port": discovery.my_server_port,
+        "data_port": discovery.my_data_port
     })
 
 @app.route('/p2p/list_files', methods=['GET'])
 def p2p_list_files():
-    shared_files = file_handler.get_shared_files_metadata_for_remote()
-    return jsonify(shared_files)
+    """Shared files listing, versioned.
+
+    Plain GET returns the whole list. `?limit=<n>` returns it a page at a
+    time as {version, files, next}, continued with `?after=<next>` (see
+    file_handler.get_listing_page). `?since=<version>` returns only the
+    files added and removed after that version (see
+    file_handler.get_catalog_changes). Either way the ETag is the current
+    version, and a matching If-None-Match gets an empty 304.
+    """
+    version = file_handler.get_catalog_version()
+    etag = file_handler.catalog_etag(version)
+    cache_headers = {"ETag": etag, "X-Catalog-Version": str(version), "Cache-Control": "no-cache"}
+    if_none_match = [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]
+    if etag in if_none_match or '*' in if_none_match:
+        return Response(status=304, headers=cache_headers)
+
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({"error": "'since' must be a catalog version number"}), 400
+        changes = file_handler.get_catalog_changes(since)
+        cache_headers["ETag"] = file_handler.catalog_etag(changes["version"])
+        cache_headers["X-Catalog-Version"] = str(changes["version"])
+        return jsonify(changes), 200, cache_headers
+
+    if 'limit' in request.args or 'after' in request.args:
+        page = _listing_page()
+        if page is None:
+            return jsonify({"error": "'limit' must be a positive number"}), 400
+        cache_headers["ETag"] = file_handler.catalog_etag(page["version"])
+        cache_headers["X-Catalog-Version"] = str(page["version"])
+        return jsonify(page), 200, cache_headers
+
+    version, body = file_handler.get_serialized_listing()
+    cache_headers["ETag"] = file_handler.catalog_etag(version)
+    cache_headers["X-Catalog-Version"] = str(version)
+    return Response(body, mimetype='application/json', headers=cache_headers)
+
+def _listing_page():
+    # ?after=&limit= of a paged listing; None if limit isn't a positive number
+    limit = request.args.get('limit', type=int)
+    if 'limit' in request.args and (limit is None or limit < 1):
+        return None
+    return file_handler.get_listing_page(request.args.get('after'), limit)
+
+def _search_args():
+    # (query, limit) of a search request, or (None, error message)
+    query = request.args.get('q', '').strip()
+    if not search_index.is_searchable(query):
+        return None, f"'q' needs a word of at least {search_index.MIN_TERM_LENGTH} characters"
+    limit = request.args.get('limit', config.SEARCH_DEFAULT_LIMIT, type=int)
+    if limit is None or limit < 1:
+        return None, "'limit' must be a positive number"
+    return query, min(limit, config.SEARCH_MAX_LIMIT)
+
+@app.route('/p2p/search', methods=['GET'])
+def p2p_search():
+    """Shared files whose names match `?q=`, best first: {version, results, truncated}.
+
+    Each result is a listing entry with a "score"; `?limit=` caps how many
+    come back (see search_index.py for matching and ranking).
+    """
+    query, limit = _search_args()
+    if query is None:
+        return jsonify({"error": limit}), 400
+    return jsonify(file_handler.search_files(query, limit))
+
+@app.route('/p2p/peers', methods=['GET', 'POST'])
+def p2p_peers():
+    """Peer exchange: our known peers; a POST also hands us the caller's (see pex.py)."""
+    payload = request.get_json(silent=True) if request.method == 'POST' else None
+    return jsonify(pex.handle_exchange(payload, request.remote_addr))
+
+@app.route('/p2p/manifest/<file_id>', methods=['GET'])
+def p2p_get_manifest(file_id):
+    if not file_handler.get_file_metadata(file_id):
+        return jsonify({"error": "File not found or not shared"}), 404
+    file_manifest = file_handler.get_file_manifest(file_id)
+    if not file_manifest:
+        # Still being hashed; the manifest appears once the hash is known
+        return jsonify({"error": "Manifest not available yet"}), 503, {"Retry-After": "2"}
+    return jsonify(file_manifest)
 
 @app.route('/p2p/download_file/<file_id>', methods=['POST'])
 def p2p_download_file(file_id):
     data = request.get_json()
     password_attempt = data.get("password", "") if data else ""
-    filepath, password_hash = file_handler.get_file_path_and_password_hash(file_id)
-    if not filepath:
-        return jsonify({"error": "File not found or not shared"}), 404
-    if not os.path.exists(filepath): # Double check file still exists
-        file_handler.remove_shared_file(file_id) # Clean up metadata if file is gone
-        return jsonify({"error": "File no longer available on server"}), 410 # Gone
-    if password_hash:
-        if not file_handler.verify_password(file_id, password_attempt):
-            return jsonify({"error": "Incorrect password"}), 403
+    filepath, error, error_status = file_handler.authorize_download(file_id, password_attempt)
+    if error:
+        return jsonify({"error": error}), error_status
+    content_cache.touch(file_handler.resolve_file_id(file_id)) # Served as a mirror: keep it cached
     try:
-        return send_file(filepath, as_attachment=True)
+        status, headers, segments = file_handler.plan_download(
+            file_id, filepath, request.headers.get("Range"), request.headers.get("If-Range"),
+            request.headers.get("Accept-Encoding"))
+    except transfer.RangeNotSatisfiable as e:
+        headers = dict(e.headers)
+        headers["Content-Range"] = f"bytes */{e.size}"
+        return Response(status=416, headers=headers)
     except Exception as e:
-        print(f"Error sending file {filepath}: {e}")
+        logger.warning("Error sending file %s: %s", filepath, e)
         return jsonify({"error": "Could not send file"}), 500
+    encoding = headers.get("Content-Encoding")
+    length = int(headers[compression.UNCOMPRESSED_LENGTH] if encoding else headers["Content-Length"])
+    slot = bandwidth.upload_scheduler.admit(request.remote_addr, length, timeout=config.BANDWIDTH_QUEUE_TIMEOUT)
+    if slot is None:
+        return jsonify({"error": "Too many transfers from your address"}), 503, {"Retry-After": "5"}
+    if encoding:
+        # Sent chunked; the bandwidth limit counts the compressed bytes
+        chunks = compression.iter_compressed(
+            transfer.iter_segments(filepath, segments, config.COMPRESSION_CHUNK_SIZE), encoding)
+    else:
+        chunks = transfer.iter_segments(filepath, segments)
+    body = bandwidth.ThrottledBody(slot, chunks)
+    return Response(body, status=status, headers=headers, direct_passthrough=True)
+
+@app.route('/p2p/delta/<file_id>', methods=['POST'])
+def p2p_download_delta(file_id):
+    """A shared file as a delta against the caller's old copy (see delta.py).
+
+    The JSON body carries the password, the block size and the packed block
+    signatures of that copy. The reply is the delta stream; its headers give
+    the file's size, name and ETag as /p2p/download_file would.
+    """
+    data = request.get_json(silent=True) or {}
+    filepath, error, error_status = file_handler.authorize_download(file_id, data.get("password", ""))
+    if error:
+        return jsonify({"error": error}), error_status
+    block_size = data.get("block_size")
+    try:
+        table, tails = delta.parse_signatures(data.get("signatures", ""), block_size)
+    except delta.DeltaError as e:
+        return jsonify({"error": str(e)}), 400
+    content_cache.touch(file_handler.resolve_file_id(file_id))
+    size = os.path.getsize(filepath)
+    name = file_handler.get_file_name(file_id) or os.path.basename(filepath)
+    headers = {
+        "Content-Type": "application/octet-stream",
+        "Content-Disposition": transfer.content_disposition(name),
+        "X-Delta-Size": str(size),
+    }
+    etag = file_handler.get_content_etag(file_id)
+    if etag:
+        headers["ETag"] = etag
+    slot = bandwidth.upload_scheduler.admit(request.remote_addr, size, timeout=config.BANDWIDTH_QUEUE_TIMEOUT)
+    if slot is None:
+        return jsonify({"error": "Too many transfers from your address"}), 503, {"Retry-After": "5"}
+    body = bandwidth.ThrottledBody(slot, delta.iter_delta(filepath, block_size, table, tails))
+    return Response(body, status=200, headers=headers, direct_passthrough=True)
+
+def _archive_request():
+    """Arguments of an archive request, from a JSON body or a plain HTML form.
+
+    file_ids (list), folder, password (for every protected file), passwords
+    ({file_id: password}, JSON only), format ("tar" or "zip"), compress, name.
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        form = request.form
+        data = {key: form.get(key) for key in ("folder", "password", "format", "compress", "name")}
+        data["file_ids"] = form.getlist("file_ids")
+    compress = data.get("compress")
+    if isinstance(compress, str):
+        compress = compress.lower() in ("1", "true", "yes", "on")
+    return {
+        "file_ids": [str(file_id) for file_id in data.get("file_ids") or []],
+        "folder": str(data.get("folder") or "").strip("/"),
+        "password": str(data.get("password") or ""),
+        "passwords": data.get("passwords") if isinstance(data.get("passwords"), dict) else {},
+        "format": str(data.get("format") or "tar").lower(),
+        "compress": bool(compress),
+        "name": str(data.get("name") or ""),
+    }
+
+@app.route('/p2p/archive', methods=['POST'])
+def p2p_download_archive():
+    """Several shared files (or a shared folder) as one tar or zip, streamed as it is built.
+
+    Every file is authorised first, as /p2p/download_file would, so a wrong
+    password fails the request before anything is sent.
+    """
+    args = _archive_request()
+    if args["format"] not in archive.FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(archive.FORMATS)}"}), 400
+    file_ids = list(args["file_ids"])
+    if args["folder"]:
+        file_ids += [file_id for _name, file_id in file_handler.files_in_folder(args["folder"])]
+    file_ids = list(dict.fromkeys(file_handler.resolve_file_id(file_id) for file_id in file_ids))
+    if not file_ids:
+        return jsonify({"error": "No files requested"}), 400
+    if len(file_ids) > config.ARCHIVE_MAX_FILES:
+        return jsonify({"error": f"At most {config.ARCHIVE_MAX_FILES} files per archive"}), 413
+
+    paths, names = [], []
+    for file_id in file_ids:
+        password = args["passwords"].get(file_id, args["password"])
+        filepath, error, error_status = file_handler.authorize_download(file_id, str(password))
+        if error:
+            return jsonify({"error": f"{file_id}: {error}", "file_id": file_id}), error_status
+        name = file_handler.get_file_name(file_id)
+        if name is None:  # Unshared since it was authorised
+            return jsonify({"error": f"{file_id}: File no longer available on server", "file_id": file_id}), 410
+        paths.append(filepath)
+        if args["folder"] and name.startswith(args["folder"] + "/"):
+            # Inside the archive, paths start below the requested folder
+            name = name[len(args["folder"]) + 1:]
+        names.append(name)
+    try:
+        members = [archive.Member(path, name) for path, name in zip(paths, archive.member_names(names))]
+    except OSError as e:
+        logger.warning("Error preparing archive: %s", e)
+        return jsonify({"error": "A requested file could not be read"}), 410
+    content_type, length, chunks = archive.stream(members, args["format"], args["compress"])
+
+    base_name = args["name"] or os.path.basename(args["folder"]) or "files"
+    headers = {
+        "Content-Type": content_type,
+        "Content-Disposition": transfer.content_disposition(base_name + archive.file_extension(args["format"], args["compress"])),
+    }
+    if length is not None:
+        headers["Content-Length"] = str(length)
+    slot = bandwidth.upload_scheduler.admit(
+        request.remote_addr, sum(member.size for member in members), timeout=config.BANDWIDTH_QUEUE_TIMEOUT)
+    if slot is None:
+        return jsonify({"error": "Too many transfers from your address"}), 503, {"Retry-After": "5"}
+    return Response(bandwidth.ThrottledBody(slot, chunks), status=200, headers=headers, direct_passthrough=True)
 
 # --- API Endpoints for the local Frontend (existing ones) ---
 @app.route('/api/identity', methods=['GET', 'POST'])
@@ -96,16 +351,17 @@ def api_manage_shared_files():
         # Get password from form data
         password = request.form.get('password', '')
         
-        # Secure the filename and create a unique path
         filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        filepath = os.path.join(UPLOAD_DIR, unique_filename)
-        
-        # Save the file
-        file.save(filepath)
-        
-        # Add to shared files
-        file_id, message = file_handler.add_shared_file(filepath, password)
+
+        # The upload is already in the blob store; file it under its hash
+        try:
+            filepath = file.stream.commit()
+        except OSError as e:
+            logger.error("Error storing upload %s: %s", filename, e)
+            return jsonify({"error": "Could not store the uploaded file"}), 500
+
+        # Add to shared files (the share takes over the blob reference)
+        file_id, message = file_handler.add_shared_file(filepath, password, name=filename or None)
         if file_id:
             return jsonify({
                 "message": message,
@@ -113,11 +369,15 @@ def api_manage_shared_files():
                 "name": filename
             }), 200
         else:
-            # Clean up the file if sharing failed
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            # Drop the reference the upload took, freeing the blob if it was the only one
+            blobstore.release(file.stream.content_hash)
             return jsonify({"error": message}), 400
     else: # GET
+        if 'limit' in request.args or 'after' in request.args:
+            page = _listing_page()
+            if page is None:
+                return jsonify({"error": "'limit' must be a positive number"}), 400
+            return jsonify(page)
         return jsonify(file_handler.get_shared_files_metadata_for_remote())
 
 @app.route('/api/shared_files/<file_id>', methods=['DELETE'])
@@ -127,21 +387,130 @@ def api_remove_shared_file(file_id):
     else:
         return jsonify({"error": "File not found or could not be unshared"}), 404
 
+# --- Shares: files and whole directories on this machine, shared in place ---
+
+@app.route('/api/shares', methods=['GET', 'POST'])
+def api_shares():
+    if request.method == 'GET':
+        return jsonify(file_handler.list_shares())
+    if not ipaddress.ip_address(request.remote_addr).is_loopback and request.remote_addr != discovery.my_ip:
+        # Sharing by path exposes this machine's disk: only its own browser may
+        return jsonify({"error": "Shares can only be added from this machine"}), 403
+    data = request.get_json(silent=True) or {}
+    path = os.path.expanduser(str(data.get("path") or "").strip())
+    if not path:
+        return jsonify({"error": "A file or directory path is required"}), 400
+    password = data.get("password", "")
+    if os.path.isdir(path):
+        share, message = file_handler.add_shared_directory(path, password)
+        if share is None:
+            return jsonify({"error": message}), 400
+        return jsonify({"message": message, "share": share}), 201
+    file_id, message = file_handler.add_shared_file(path, password)
+    if not file_id:
+        return jsonify({"error": message}), 400
+    return jsonify({"message": message, "file_id": file_id}), 201
+
+@app.route('/api/shares/<int:share_id>', methods=['GET', 'DELETE'])
+def api_share(share_id):
+    if request.method == 'DELETE':
+        if file_handler.remove_share(share_id):
+            return jsonify({"message": "Share removed"}), 200
+        return jsonify({"error": "Share not found"}), 404
+    share = file_handler.get_share(share_id)
+    if share is None:
+        return jsonify({"error": "Share not found"}), 404
+    return jsonify(share)
+
+@app.route('/api/shares/<int:share_id>/rescan', methods=['POST'])
+def api_rescan_share(share_id):
+    """Pick up files added, changed or deleted in a shared directory since the last scan."""
+    if file_handler.get_share(share_id) is None:
+        return jsonify({"error": "Share not found"}), 404
+    if not file_handler.rescan_share(share_id):
+        return jsonify({"error": "Only directory shares can be rescanned, one scan at a time"}), 409
+    return jsonify({"message": "Rescan started"}), 202
+
+# --- Chunked, resumable uploads (large files from the browser) ---
+
+@app.route('/api/uploads', methods=['GET', 'POST'])
+def api_uploads():
+    if request.method == 'GET':
+        return jsonify(uploads.list_sessions())
+    data = request.get_json(silent=True) or {}
+    name = secure_filename(str(data.get("name") or ""))
+    size = data.get("size")
+    if not name or isinstance(size, bool) or not isinstance(size, int) or size < 0:
+        return jsonify({"error": "name and a non-negative integer size are required"}), 400
+    try:
+        session, created = uploads.create_session(name, size, key=str(data["key"]) if data.get("key") else None)
+    except uploads.UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    return jsonify(session.to_dict()), 201 if created else 200
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def api_upload_session(upload_id):
+    if request.method == 'DELETE':
+        if uploads.cancel_session(upload_id):
+            return jsonify({"message": "Upload cancelled"}), 200
+        return jsonify({"error": "Upload not found"}), 404
+    session = uploads.get_session(upload_id)
+    if session is None:
+        return jsonify({"error": "Upload not found"}), 404
+    if request.method == 'PUT':
+        # One chunk: "Content-Range: bytes START-END/SIZE" with the bytes as the body
+        content_range = downloads.parse_content_range(request.headers.get('Content-Range', ''))
+        if not content_range or content_range[2] != session.size:
+            return jsonify({"error": "Content-Range: bytes START-END/SIZE is required"}), 400
+        start, end, _ = content_range
+        if request.content_length != end - start + 1:
+            return jsonify({"error": "Content-Length does not match Content-Range"}), 400
+        try:
+            session.write_chunk(start, end - start + 1, request.stream)
+        except uploads.UploadError as e:
+            return jsonify({"error": str(e)}), e.status
+    return jsonify(session.to_dict())
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def api_finalize_upload(upload_id):
+    """Share a completed upload, the same way a single-request upload is shared."""
+    data = request.get_json(silent=True) or {}
+    session = uploads.get_session(upload_id)
+    try:
+        filepath, content_hash = uploads.finish_session(upload_id)
+    except uploads.UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    except OSError as e:
+        logger.error("Error storing upload %s: %s", upload_id, e)
+        return jsonify({"error": "Could not store the uploaded file"}), 500
+    file_id, message = file_handler.add_shared_file(filepath, data.get("password", ""), name=session.name)
+    if not file_id:
+        blobstore.release(content_hash)
+        return jsonify({"error": message}), 400
+    return jsonify({"message": message, "file_id": file_id, "name": session.name}), 200
+
 # --- NEW API Endpoints for Frontend to interact with OTHER PEERS (Proxy Endpoints) ---
 
+# Headers relayed between the browser and the serving peer by the download proxy
+PROXY_REQUEST_HEADERS = ('Range', 'If-Range')
+PROXY_RESPONSE_HEADERS = (
+    'Content-Type', 'Content-Disposition', 'Content-Length', 'Content-Range',
+    'Accept-Ranges', 'ETag', 'Last-Modified',
+)
+
 @app.route('/api/peers/<string:peer_address_encoded>/<int:peer_port>/files', methods=['GET'])
 def api_get_peer_files(peer_address_encoded, peer_port):
     peer_address = urllib.parse.unquote(peer_address_encoded)
     target_url = f"http://{peer_address}:{peer_port}/p2p/list_files"
-    print(f"Proxying request for file list from {discovery.my_username} to {target_url}")
+    logger.debug("Proxying request for file list from %s to %s", discovery.my_username, target_url)
     try:
-        response = requests.get(target_url, timeout=5) # 5 second timeout
+        response = peer_client.get_session(peer_address, peer_port).get(target_url, timeout=5) # 5 second timeout
         response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
         return jsonify(response.json())
     except requests.exceptions.Timeout:
         return jsonify({"error": f"Peer {peer_address}:{peer_port} timed out."}), 504 # Gateway Timeout
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching files from peer {peer_address}:{peer_port} - {e}")
+        logger.warning("Error fetching files from peer %s:%s - %s", peer_address, peer_port, e)
         # Try to return peer's error if available and it's JSON
         try:
             if e.response is not None and 'application/json' in e.response.headers.get('Content-Type',''):
@@ -150,71 +519,356 @@ def api_get_peer_files(peer_address_encoded, peer_port):
             pass
         return jsonify({"error": f"Could not connect to peer {peer_address}:{peer_port} or peer returned an error."}), 502 # Bad Gateway
     except Exception as e:
-        print(f"Generic error fetching files from peer {peer_address}:{peer_port} - {e}")
+        logger.exception("Generic error fetching files from peer %s:%s - %s", peer_address, peer_port, e)
         return jsonify({"error": "An unexpected error occurred while fetching peer files."}), 500
 
 
+@app.route('/api/peers/<string:peer_address_encoded>/<int:peer_port>/archive', methods=['POST'])
+def api_download_archive_from_peer(peer_address_encoded, peer_port):
+    """Relay /p2p/archive: the request body goes to the peer and the archive comes back as it is."""
+    peer_address = urllib.parse.unquote(peer_address_encoded)
+    target_url = f"http://{peer_address}:{peer_port}/p2p/archive"
+    slot = bandwidth.download_scheduler.admit(peer_address, timeout=config.BANDWIDTH_QUEUE_TIMEOUT)
+    if slot is None:
+        return jsonify({"error": f"Too many transfers from {peer_address} in progress; try again shortly."}), 503, {"Retry-After": "5"}
+    streaming = False # Once the body is handed to Flask, closing it frees the slot
+    try:
+        session = peer_client.get_session(peer_address, peer_port)
+        p2p_response = session.post(
+            target_url, data=request.get_data(),
+            headers={"Content-Type": request.headers.get("Content-Type", "application/json")},
+            stream=True, timeout=(5, 300))
+        headers = {name: p2p_response.headers[name] for name in PROXY_RESPONSE_HEADERS if name in p2p_response.headers}
+        if p2p_response.status_code != 200:
+            body = p2p_response.content
+            p2p_response.close()
+            return Response(body, status=p2p_response.status_code, headers=headers)
+
+        def generate_chunks():
+            try:
+                # Raw bytes: a gzipped tar must reach the client still gzipped
+                yield from p2p_response.raw.stream(config.PROXY_MAX_BUFFER, decode_content=False)
+            finally:
+                p2p_response.close()
+
+        streaming = True
+        body = bandwidth.ThrottledBody(slot, generate_chunks())
+        return Response(body, status=200, headers=headers)
+    except requests.exceptions.Timeout:
+        return jsonify({"error": f"Peer {peer_address}:{peer_port} timed out."}), 504
+    except requests.exceptions.RequestException as e:
+        logger.warning("Error fetching archive from peer %s:%s - %s", peer_address, peer_port, e)
+        return jsonify({"error": f"Could not connect to peer {peer_address}:{peer_port} for download."}), 502
+    finally:
+        if not streaming:
+            slot.close()
+
+
+def _make_proxy_verifier(peer_address, peer_port, file_id, p2p_response):
+    """ChunkVerifier for a proxied file body, or None if it cannot be checked."""
+    if file_id.startswith(file_handler.PENDING_ID_PREFIX):
+        return None
+    if p2p_response.status_code == 200:
+        offset = 0
+        total = peer_client.body_length(p2p_response)
+    elif p2p_response.status_code == 206 and 'Content-Range' in p2p_response.headers:
+        content_range = downloads.parse_content_range(p2p_response.headers['Content-Range'])
+        if not content_range:
+            return None
+        offset, _end, total = content_range
+    else:
+        return None # e.g. multipart/byteranges
+    file_manifest = downloads.fetch_manifest(peer_address, peer_port, file_id)
+    if not file_manifest or file_manifest["size"] != total:
+        return None
+    return manifest.ChunkVerifier(file_manifest, offset)
+
+def _send_cached(file_id, path, name):
+    """Answer a proxied download from the content cache, ranges included."""
+    try:
+        status, headers, segments = transfer.plan_file_segments(
+            path, request.headers.get("Range"), request.headers.get("If-Range"),
+            transfer.guess_content_type(name), etag=f'"sha256-{file_id}"')
+    except transfer.RangeNotSatisfiable as e:
+        headers = dict(e.headers)
+        headers["Content-Range"] = f"bytes */{e.size}"
+        return Response(status=416, headers=headers)
+    headers["Content-Disposition"] = transfer.content_disposition(name)
+    headers["X-Served-From"] = "cache"
+    return Response(transfer.iter_segments(path, segments), status=status, headers=headers, direct_passthrough=True)
+
 @app.route('/api/peers/<string:peer_address_encoded>/<int:peer_port>/download/<file_id>', methods=['POST'])
 def api_download_from_peer(peer_address_encoded, peer_port, file_id):
     peer_address = urllib.parse.unquote(peer_address_encoded)
     password_data = request.get_json()
     password = password_data.get("password", "") if password_data else ""
 
-    target_url = f"http://{peer_address}:{peer_port}/p2p/download_file/{file_id}"
-    print(f"Proxying download request for file {file_id} from {peer_address}:{peer_port}")
+    cached = content_cache.lookup(file_id)
+    if cached:
+        return _send_cached(file_id, *cached)
+
+    target_url = downloads.peer_download_url(peer_address, peer_port, file_id)
+    logger.debug("Proxying download request for file %s from %s:%s", file_id, peer_address, peer_port)
+
+    # Pass range requests through so the browser (or any other client) can
+    # resume an interrupted download without starting over.
+    forward_headers = {}
+    for header_name in PROXY_REQUEST_HEADERS:
+        if header_name in request.headers:
+            forward_headers[header_name] = request.headers[header_name]
+
+    slot = bandwidth.download_scheduler.admit(peer_address, timeout=config.BANDWIDTH_QUEUE_TIMEOUT)
+    if slot is None:
+        return jsonify({"error": f"Too many transfers from {peer_address} in progress; try again shortly."}), 503, {"Retry-After": "5"}
+    streaming = False # Once the body is handed to Flask, closing it frees the slot
 
     try:
-        p2p_response = requests.post(target_url, json={"password": password}, stream=True, timeout=(5, 300)) # 5s connect, 300s read timeout
+        session = peer_client.get_session(peer_address, peer_port)
+        p2p_response = session.post(target_url, json={"password": password}, headers=forward_headers, stream=True, timeout=(5, 300)) # 5s connect, 300s read timeout
+        if p2p_response.status_code == 416:
+            headers = {name: p2p_response.headers[name] for name in PROXY_RESPONSE_HEADERS if name in p2p_response.headers}
+            p2p_response.close()
+            return Response(status=416, headers=headers)
         p2p_response.raise_for_status() # Important to check for 4xx/5xx errors from peer
 
         # If the peer returns a JSON error (e.g., wrong password), relay it
         if 'application/json' in p2p_response.headers.get('Content-Type', '').lower():
             error_json = p2p_response.json() # This consumes the content, so do it carefully
-            print(f"Peer {peer_address}:{peer_port} returned JSON error for download: {error_json}")
+            logger.info("Peer %s:%s returned JSON error for download: %s", peer_address, peer_port, error_json)
             return jsonify({"error": error_json.get("error", "Peer error during download")}), p2p_response.status_code
 
+        verifier = _make_proxy_verifier(peer_address, peer_port, file_id, p2p_response)
+        # A whole, unprotected file is kept in the content cache on its way through
+        cache_writer = None
+        if verifier and p2p_response.status_code == 200 and not password:
+            cache_writer = content_cache.writer(
+                file_id, downloads.filename_from_response(p2p_response, file_id),
+                peer_client.body_length(p2p_response))
+
         # Stream the response back to the client
         def generate_chunks():
-            for chunk in p2p_response.iter_content(chunk_size=8192): # 8KB chunks
-                yield chunk
-
-        headers = {}
-        if 'Content-Disposition' in p2p_response.headers:
-            headers['Content-Disposition'] = p2p_response.headers['Content-Disposition']
+            try:
+                for chunk in peer_client.iter_adaptive(p2p_response):
+                    if verifier:
+                        # A bad chunk aborts the stream, so the client sees a failed
+                        # (resumable) download instead of silently corrupted data.
+                        verifier.feed(chunk)
+                    if cache_writer:
+                        cache_writer.write(chunk)
+                    proxy_bytes.inc(peer_address, amount=len(chunk))
+                    yield chunk
+                if cache_writer:
+                    cache_writer.commit()
+            except manifest.ChunkMismatch as e:
+                logger.warning("Aborting proxied download of %s from %s:%s: %s", file_id, peer_address, peer_port, e)
+                raise
+            finally:
+                p2p_response.close()
+                if cache_writer:
+                    cache_writer.discard() # No-op once committed
+
+        headers = {name: p2p_response.headers[name] for name in PROXY_RESPONSE_HEADERS if name in p2p_response.headers}
         # Ensure correct Content-Type if not an error (it shouldn't be JSON here)
-        if 'Content-Type' in p2p_response.headers and 'application/json' not in p2p_response.headers['Content-Type'].lower():
-             headers['Content-Type'] = p2p_response.headers['Content-Type']
-        else: # Fallback if peer doesn't set it correctly for file streams
+        if 'Content-Type' not in headers:
             headers['Content-Type'] = 'application/octet-stream'
+        if 'Content-Encoding' in p2p_response.headers:
+            # The body is decoded on its way through, so the client gets the plain length
+            headers.pop('Content-Length', None)
+            if compression.UNCOMPRESSED_LENGTH in p2p_response.headers:
+                headers['Content-Length'] = p2p_response.headers[compression.UNCOMPRESSED_LENGTH]
 
-
-        return Response(stream_with_context(generate_chunks()), status=p2p_response.status_code, headers=headers)
+        streaming = True
+        # The peer link is what's limited: count the bytes as they arrived from it
+        body = bandwidth.ThrottledBody(slot, generate_chunks(), cost=peer_client.WireMeter(p2p_response).advance)
+        return Response(body, status=p2p_response.status_code, headers=headers)
 
     except requests.exceptions.Timeout:
         return jsonify({"error": f"Peer {peer_address}:{peer_port} timed out during download."}), 504
     except requests.exceptions.HTTPError as e:
         # This catches 4xx/5xx from the other peer that were not JSON
         # (e.g. if peer's Flask crashes, or returns non-JSON error page)
-        print(f"HTTPError from peer {peer_address}:{peer_port} during download: {e.response.status_code} - {e.response.text[:200]}")
+        logger.warning("HTTPError from peer %s:%s during download: %s - %s", peer_address, peer_port, e.response.status_code, e.response.text[:200])
         try:
             error_content = e.response.json() # Try to parse if it is JSON despite headers
             return jsonify({"error": error_content.get("error", f"Peer error: {e.response.status_code}")}), e.response.status_code
         except:
             return jsonify({"error": f"Peer {peer_address}:{peer_port} returned error: {e.response.status_code}"}), e.response.status_code
     except requests.exceptions.RequestException as e:
-        print(f"Error downloading from peer {peer_address}:{peer_port} - {e}")
+        logger.warning("Error downloading from peer %s:%s - %s", peer_address, peer_port, e)
         return jsonify({"error": f"Could not connect to peer {peer_address}:{peer_port} for download."}), 502
     except Exception as e:
-        print(f"Generic error proxying download from peer {peer_address}:{peer_port} - {e}")
+        logger.exception("Generic error proxying download from peer %s:%s - %s", peer_address, peer_port, e)
         return jsonify({"error": "An unexpected error occurred while proxying download."}), 500
+    finally:
+        if not streaming:
+            slot.close()
+
+
+def _ui_snapshot():
+    return {
+        "peers": discovery.get_discovered_peers(),
+        "shares": file_handler.list_shares(),
+        "downloads": download_manager.list_jobs(),
+    }
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Counters, gauges and latency histograms in the Prometheus text format (metrics.py)."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/api/events', methods=['GET'])
+def api_events():
+    """Server-Sent Events stream of everything the UI shows.
+
+    Opens with a "snapshot" of peers, shares and downloads, then pushes
+    peer-joined/left/catalog-changed, share-updated/removed and
+    download-progress/removed events. A tab that falls too far behind gets a
+    fresh snapshot instead of the events it missed. A client with
+    EVENT_STREAMS_PER_CLIENT streams open already gets 429.
+    """
+    subscription = events.subscribe(request.remote_addr)
+    if subscription is None:
+        return jsonify({"error": "Too many event streams open from your address"}), 429
+
+    def stream():
+        try:
+            yield events.format_sse("snapshot", _ui_snapshot())
+            while True:
+                event = subscription.get(config.EVENT_KEEPALIVE_INTERVAL)
+                if subscription.overflowed:
+                    subscription.overflowed = False
+                    yield events.format_sse("snapshot", _ui_snapshot())
+                elif event is None:
+                    yield ": keep-alive\n\n"  # Lets both ends notice a dead connection
+                else:
+                    yield events.format_sse(*event)
+        finally:
+            subscription.close()
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # The generator's finally only runs once iteration has started; this runs
+    # even if the client is gone before the first event
+    response.call_on_close(subscription.close)
+    return response
+
+@app.route('/api/catalog', methods=['GET'])
+def api_get_catalog():
+    """Every file on the network in one response, grouped by content hash."""
+    force_refresh = request.args.get('refresh', '').lower() in ('1', 'true', 'yes')
+    return jsonify(catalog.get_catalog(force_refresh=force_refresh))
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    """Search every known peer's files by name at once (`?q=`, `?limit=`).
+
+    Results are grouped by content hash and ranked as in catalog.iter_search.
+    An EventSource (Accept: text/event-stream) gets "results" events as
+    peers answer and a final "done"; anything else gets the final merge as
+    one JSON document.
+    """
+    query, limit = _search_args()
+    if query is None:
+        return jsonify({"error": limit}), 400
+    if 'text/event-stream' not in request.headers.get('Accept', ''):
+        final = None
+        for final in catalog.iter_search(query, limit):
+            pass
+        return jsonify(final)
+
+    def stream():
+        for update in catalog.iter_search(query, limit):
+            yield events.format_sse("done" if update["done"] else "results", update)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route('/api/bandwidth', methods=['GET', 'POST'])
+def api_bandwidth():
+    """Live transfer stats per direction and peer; POST changes the global caps."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        limits = {}
+        for direction in ("upload", "download"):
+            value = data.get(f"{direction}_limit")
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                return jsonify({"error": f"{direction}_limit must be a non-negative integer (bytes per second)"}), 400
+            limits[direction] = value
+        bandwidth.set_limits(**limits)
+    return jsonify(bandwidth.get_stats())
+
+# --- Download jobs: the node fetches files from peers into its download directory ---
+
+def _job_or_404(job):
+    if job is None:
+        return jsonify({"error": "Download not found or not in a suitable state"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/downloads', methods=['GET', 'POST'])
+def api_downloads():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        file_id = data.get("file_id")
+        peer_address = data.get("peer_address")
+        peer_port = data.get("peer_port")
+        use_swarm = bool(data.get("swarm", False))
+        if not file_id:
+            return jsonify({"error": "file_id is required"}), 400
+        if not use_swarm and not (peer_address and peer_port):
+            return jsonify({"error": "peer_address and peer_port are required unless swarm is set"}), 400
+        try:
+            priority = int(data.get("priority", 0))
+            peer_port = int(peer_port) if peer_port else None
+        except (TypeError, ValueError):
+            return jsonify({"error": "priority and peer_port must be integers"}), 400
+        job, created = download_manager.add_job(
+            file_id,
+            peer_address=peer_address,
+            peer_port=peer_port,
+            name=secure_filename(data.get("name") or "") or None,
+            password=data.get("password", ""),
+            priority=priority,
+            use_swarm=use_swarm,
+        )
+        return jsonify(job.to_dict()), 201 if created else 200
+    else: # GET
+        return jsonify(download_manager.list_jobs())
+
+@app.route('/api/downloads/<job_id>', methods=['GET', 'DELETE'])
+def api_download_job(job_id):
+    if request.method == 'DELETE':
+        return _job_or_404(download_manager.cancel_job(job_id))
+    return _job_or_404(download_manager.get_job(job_id))
+
+@app.route('/api/downloads/<job_id>/pause', methods=['POST'])
+def api_pause_download(job_id):
+    return _job_or_404(download_manager.pause_job(job_id))
+
+@app.route('/api/downloads/<job_id>/resume', methods=['POST'])
+def api_resume_download(job_id):
+    return _job_or_404(download_manager.resume_job(job_id))
+
+@app.route('/api/downloads/<job_id>/file', methods=['GET'])
+def api_download_job_file(job_id):
+    """Hand a finished download to the local browser."""
+    job = download_manager.get_job(job_id)
+    if job is None or job.status != "completed" or not job.path or not os.path.exists(job.path):
+        return jsonify({"error": "Download not finished or file no longer present"}), 404
+    return send_file(job.path, as_attachment=True, download_name=os.path.basename(job.path))
 
 
 # --- Server Runner ---
 def run_server(port, debug=False):
-    print(f"Starting P2P HTTP server on 0.0.0.0 port {port}")
+    logger.info("Starting P2P HTTP server on 0.0.0.0 port %s", port)
     # Ensure discovery module knows the actual port being used by the server.
     # This is crucial if the port is dynamically assigned or changed from config.
     discovery.my_server_port = port
+    if config.SERVER_BACKEND == "pooled" and not debug:
+        # Bounded pools per traffic class, so downloads can't starve the API
+        serving.run_pooled(app, '0.0.0.0', port, on_shutdown=data_server.stop_data_server)
+        return
     # Using threaded=True allows Flask to handle multiple requests concurrently,
     # which is important for a responsive UI and for handling P2P requests
     # without blocking discovery threads or other API calls.
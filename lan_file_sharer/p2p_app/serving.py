@@ -0,0 +1,387 @@
+# p2p_app/serving.py
+# Production HTTP server for the Flask app: bounded worker pools instead of a
+# thread per connection.
+#
+# Requests are routed to a pool by path, so bulk transfers, long-lived event
+# streams and control calls never compete for the same workers:
+#   bulk    - file bodies (downloads, proxied downloads, uploads, upload chunks)
+#   stream  - /api/events
+#   control - everything else (UI API, listings, manifests, PEX)
+# Connections are kept alive (Werkzeug's own server closes every one), and
+# idle ones don't hold a worker: between requests they are parked on a
+# selector and handed back to a pool when the next request arrives. Over the
+# connection limit, or with a pool's backlog full, clients get an immediate
+# 503 with Retry-After instead of waiting in a queue.
+import io
+import logging
+import re
+import selectors
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from . import config
+
+logger = logging.getLogger(__name__)
+
+BULK_PATHS = re.compile(
+    r"^/(p2p/download_file/|p2p/delta/|p2p/archive$|api/peers/[^/]+/\d+/(download/|archive$)|api/downloads/[^/]+/file$|api/shared_files$)"
+)
+UPLOAD_CHUNK_PATHS = re.compile(r"^/api/uploads/[^/]+$")  # Bulk for PUT only
+STREAM_PATHS = re.compile(r"^/api/events$")
+
+BUSY_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Retry-After: 1\r\n"
+    b"Connection: close\r\n"
+    b"Content-Length: 29\r\n\r\n"
+    b'{"error": "Server too busy"}\n'
+)
+
+
+class _RequestBody(io.RawIOBase):
+    """One request's body: reads stop at its end, and it knows how much is left.
+
+    Stands in for rfile while a request runs, so neither the app nor
+    Werkzeug's after-response drain can read into the next request.
+    """
+
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)[:self.remaining]
+        if not view:
+            return 0
+        count = self._rfile.readinto(view) or 0
+        self.remaining -= count
+        return count
+
+
+def pool_for(method, path):
+    path = path.split("?", 1)[0]
+    if STREAM_PATHS.match(path):
+        return "stream"
+    if BULK_PATHS.match(path) and (method != "GET" or not path.startswith("/api/shared_files")):
+        return "bulk"
+    if method == "PUT" and UPLOAD_CHUNK_PATHS.match(path):
+        return "bulk"
+    return "control"
+
+
+class PooledRequestHandler(WSGIRequestHandler):
+    """WSGIRequestHandler that the server drives one request at a time."""
+
+    protocol_version = "HTTP/1.1"
+    timeout = config.SERVER_SOCKET_TIMEOUT
+
+    def __init__(self, request, client_address, server):
+        # BaseRequestHandler.__init__ would serve the whole connection right
+        # here; PooledWSGIServer calls serve() from its pools instead.
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+        self._connection_rfile = self.rfile
+        self.close_connection = False
+        self.parsed = False  # A request has been read but not yet served
+        self.idle_since = time.monotonic()
+        self._keep_alive = False
+        self._body = None
+
+    def _open_body(self):
+        self._body = None
+        if self.headers.get("Transfer-Encoding", "").strip().lower() == "chunked":
+            self._keep_alive = False  # Can't tell where an unread chunked body ends
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self._keep_alive = False
+            return
+        self._body = _RequestBody(self._connection_rfile, max(length, 0))
+        self.rfile = self._body
+
+    def send_header(self, keyword, value):
+        # Werkzeug closes every connection because http.server can't skip an
+        # unread request body; _finish_body() does that here.
+        if self._keep_alive and keyword.lower() == "connection" and value.lower() == "close":
+            return
+        super().send_header(keyword, value)
+
+    def _finish_body(self):
+        """Skip whatever the app didn't read of the request body. False if the connection must close."""
+        if self._body is None:
+            return False
+        if self._body.remaining > config.SERVER_MAX_DRAIN:
+            return False
+        while self._body.read(64 * 1024):
+            pass
+        return self._body.remaining == 0
+
+    def _read_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = self.request_version = self.command = ""
+            self.send_error(414)
+            self.close_connection = True
+            return False
+        if not self.raw_requestline:
+            self.close_connection = True
+            return False
+        return self.parse_request()  # Sends the error reply itself
+
+    def _has_buffered_request(self):
+        # A pipelined request may already sit in rfile's buffer, where the
+        # selector can't see it. Peek without blocking.
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def serve(self, pool):
+        """Serve requests on this connection from `pool`.
+
+        Returns the name of the pool the next request belongs to, "idle" when
+        the connection should be parked until more data arrives, or None when
+        it is finished.
+        """
+        try:
+            while not self.close_connection:
+                if not self.parsed:
+                    if not self._read_request():
+                        break
+                    self.parsed = True
+                target = pool_for(self.command, self.path)
+                if target != pool:
+                    return target
+                self.parsed = False
+                self._keep_alive = not self.close_connection  # HTTP/1.0 or "Connection: close" from the client
+                self._open_body()
+                try:
+                    getattr(self, "do_" + self.command)()  # Werkzeug routes every method to run_wsgi
+                finally:
+                    self.rfile = self._connection_rfile
+                self.wfile.flush()
+                if not self._keep_alive or not self._finish_body():
+                    self.close_connection = True
+                if not self.close_connection and not self._has_buffered_request():
+                    self.idle_since = time.monotonic()
+                    return "idle"
+        except (ConnectionError, socket.timeout) as e:
+            self.connection_dropped(e)
+        return None
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, host, port, app, pool_sizes=None, max_connections=None):
+        super().__init__(host, port, app, handler=PooledRequestHandler)
+        self.pool_sizes = dict(pool_sizes or config.SERVER_POOL_SIZES)
+        self.max_connections = max_connections or config.SERVER_MAX_CONNECTIONS
+        self._pools = {
+            name: ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"http-{name}")
+            for name, size in self.pool_sizes.items()
+        }
+        self._backlog = {name: 0 for name in self._pools}  # Submitted but not yet finished
+        self._connections = set()  # Every open PooledRequestHandler
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._parked = []  # Handlers to register with the selector (only its thread touches it)
+        self._closing = False
+        self._idle_thread = threading.Thread(target=self._idle_loop, name="http-idle", daemon=True)
+        self._idle_thread.start()
+
+    # --- Accepting ---
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            over_limit = self._closing or len(self._connections) >= self.max_connections
+        if over_limit:
+            self._reject(request)
+            return
+        try:
+            # Responses go out as several small writes (headers, body); on a
+            # kept-alive connection Nagle would hold each one back ~40ms
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except OSError:
+            self.shutdown_request(request)
+            return
+        with self._lock:
+            self._connections.add(handler)
+        # The first request line hasn't arrived yet; park until it does
+        self._park(handler)
+
+    def _reject(self, request):
+        try:
+            request.settimeout(1)
+            request.sendall(BUSY_RESPONSE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    # --- Pools ---
+
+    def _submit(self, handler, pool):
+        with self._lock:
+            if self._closing or self._backlog[pool] >= self.pool_sizes[pool] * config.SERVER_POOL_BACKLOG:
+                full = True
+            else:
+                full = False
+                self._backlog[pool] += 1
+        if full:
+            self._close(handler, busy=True)
+            return
+        try:
+            self._pools[pool].submit(self._run, handler, pool)
+        except RuntimeError:  # Pools already shut down (or the interpreter is exiting)
+            with self._lock:
+                self._backlog[pool] -= 1
+            self._close(handler)
+
+    def _run(self, handler, pool):
+        try:
+            next_step = handler.serve(pool)
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            next_step = None
+        finally:
+            with self._lock:
+                self._backlog[pool] -= 1
+        if next_step is None:
+            self._close(handler)
+        elif next_step == "idle":
+            self._park(handler)
+        else:
+            self._submit(handler, next_step)
+
+    def _close(self, handler, busy=False):
+        with self._lock:
+            self._connections.discard(handler)
+        if busy:
+            try:
+                handler.request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+
+    # --- Idle keep-alive connections ---
+
+    def _park(self, handler):
+        with self._lock:
+            self._parked.append(handler)
+        self._wakeup_w.send(b"\0")
+
+    def _idle_loop(self):
+        while True:
+            for key, _ in self._selector.select(timeout=1.0):
+                if key.fileobj is self._wakeup_r:
+                    self._wakeup_r.recv(4096)
+                    continue
+                try:
+                    self._selector.unregister(key.fileobj)
+                except (ValueError, KeyError, OSError):
+                    pass
+                self._submit(key.data, "control")  # Reads the request, then moves it if needed
+            with self._lock:
+                parked, self._parked = self._parked, []
+                closing = self._closing
+            for handler in parked:
+                try:
+                    self._selector.register(handler.request, selectors.EVENT_READ, handler)
+                except (ValueError, KeyError, OSError):
+                    self._close(handler)
+            now = time.monotonic()
+            for key in list(self._selector.get_map().values()):
+                if key.fileobj is self._wakeup_r:
+                    continue
+                if closing or now - key.data.idle_since > config.SERVER_KEEPALIVE_TIMEOUT:
+                    try:
+                        self._selector.unregister(key.fileobj)
+                    except (ValueError, KeyError, OSError):
+                        pass
+                    self._close(key.data)
+
+    # --- Shutdown ---
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            super(BaseWSGIServer, self).serve_forever(poll_interval=poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.drain(config.SERVER_SHUTDOWN_TIMEOUT)
+            self.server_close()
+
+    def drain(self, timeout):
+        """Stop taking requests and give the ones in flight `timeout` seconds to finish."""
+        with self._lock:
+            self._closing = True
+        self._wakeup_w.send(b"\0")  # Closes parked connections
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                busy = sum(self._backlog.values())
+            if not busy:
+                break
+            time.sleep(0.1)
+        with self._lock:
+            remaining = list(self._connections)
+        for handler in remaining:
+            # Event streams and stalled transfers: cut them off
+            try:
+                handler.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_pooled(app, host, port, on_shutdown=None):
+    """Serve `app` until interrupted or sent SIGTERM, then shut down gracefully.
+
+    `on_shutdown` (e.g. stopping the data server) runs alongside the drain,
+    and is waited for before returning.
+    """
+    server = PooledWSGIServer(host, port, app)
+    stopper = threading.Thread(target=on_shutdown, daemon=True) if on_shutdown else None
+    stopper_lock = threading.Lock()
+
+    def stop_others():
+        with stopper_lock:
+            if stopper is not None and stopper.ident is None:  # Not started yet
+                stopper.start()
+
+    def on_sigterm(signum, frame):
+        # shutdown() waits for serve_forever to return, so not from this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+        stop_others()
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, on_sigterm)
+    sizes = ", ".join(f"{name} {size}" for name, size in server.pool_sizes.items())
+    logger.info("Serving with worker pools (%s), up to %s connections", sizes, server.max_connections)
+    try:
+        server.serve_forever()
+    finally:
+        stop_others()
+        if stopper is not None:
+            stopper.join()
@@ -0,0 +1,202 @@
+# p2p_app/share_index.py
+# On-disk index of what this node shares (SQLite), so shares survive restarts
+# and a large shared directory is never walked just to start up.
+#
+#   shares - one row per thing the user shared: a single file or a directory
+#   files  - one row per shared file, with the stat fields and content hash
+#            it had when last looked at
+#
+# Directory shares are filled by an os.scandir walk. A rescan compares every
+# file's size, mtime and inode with its row and only reports the ones that
+# differ (to be hashed again) or disappeared.
+import logging
+import os
+import sqlite3
+import threading
+import time
+from . import config
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shares (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    password_hash TEXT,
+    added_at REAL NOT NULL,
+    scanned_at REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    share_id INTEGER NOT NULL REFERENCES shares(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    dev INTEGER NOT NULL,
+    sha256 TEXT,
+    merkle_root TEXT
+);
+CREATE INDEX IF NOT EXISTS files_share ON files(share_id);
+CREATE INDEX IF NOT EXISTS files_hash ON files(sha256);
+"""
+
+_FILE_COLUMNS = ("path", "share_id", "name", "size", "mtime_ns", "ino", "dev", "sha256", "merkle_root")
+_SELECT_FILES = f"SELECT {', '.join(_FILE_COLUMNS)} FROM files"
+
+_conn = None
+_lock = threading.RLock()  # One connection, shared by every thread
+
+
+def _db():
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(config.SHARE_INDEX_PATH), exist_ok=True)
+        _conn = sqlite3.connect(config.SHARE_INDEX_PATH, check_same_thread=False, isolation_level=None)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")  # WAL keeps this crash-safe; only the last commits can be lost
+        _conn.execute("PRAGMA foreign_keys=ON")
+        _conn.executescript(_SCHEMA)
+    return _conn
+
+
+def add_share(path, kind, name, password_hash):
+    """Record a share (replacing any earlier one of the same path). Returns its ID."""
+    with _lock:
+        db = _db()
+        db.execute("DELETE FROM shares WHERE path = ?", (path,))
+        cursor = db.execute(
+            "INSERT INTO shares (path, kind, name, password_hash, added_at) VALUES (?, ?, ?, ?, ?)",
+            (path, kind, name, password_hash, time.time()))
+        return cursor.lastrowid
+
+
+def remove_share(share_id):
+    with _lock:
+        _db().execute("DELETE FROM shares WHERE id = ?", (share_id,))  # Its files go with it
+
+
+def mark_scanned(share_id):
+    with _lock:
+        _db().execute("UPDATE shares SET scanned_at = ? WHERE id = ?", (time.time(), share_id))
+
+
+def list_shares():
+    with _lock:
+        rows = _db().execute(
+            "SELECT id, path, kind, name, password_hash, added_at, scanned_at FROM shares ORDER BY id").fetchall()
+    keys = ("id", "path", "kind", "name", "password_hash", "added_at", "scanned_at")
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def iter_files(share_id=None):
+    """Yield file rows as dicts (all of them, or one share's)."""
+    query = _SELECT_FILES
+    params = ()
+    if share_id is not None:
+        query += " WHERE share_id = ?"
+        params = (share_id,)
+    with _lock:
+        rows = _db().execute(query, params).fetchall()
+    for row in rows:
+        yield dict(zip(_FILE_COLUMNS, row))
+
+
+def find_by_hash(sha256):
+    """File rows (of any share) whose recorded content hash is `sha256`."""
+    with _lock:
+        rows = _db().execute(_SELECT_FILES + " WHERE sha256 = ?", (sha256,)).fetchall()
+    return [dict(zip(_FILE_COLUMNS, row)) for row in rows]
+
+
+def share_stats(share_id):
+    """{file_count, hashed_count, size} of a share's indexed files."""
+    with _lock:
+        count, hashed, size = _db().execute(
+            "SELECT COUNT(*), COUNT(sha256), COALESCE(SUM(size), 0) FROM files WHERE share_id = ?",
+            (share_id,)).fetchone()
+    return {"file_count": count, "hashed_count": hashed, "size": size}
+
+
+def put_files(rows):
+    """Insert or replace file rows: dicts with the columns of `files`."""
+    with _lock:
+        db = _db()
+        db.execute("BEGIN")
+        try:
+            db.executemany(
+                "INSERT OR REPLACE INTO files (path, share_id, name, size, mtime_ns, ino, dev, sha256, merkle_root) "
+                "VALUES (:path, :share_id, :name, :size, :mtime_ns, :ino, :dev, :sha256, :merkle_root)",
+                rows)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+
+def remove_files(paths):
+    with _lock:
+        db = _db()
+        db.execute("BEGIN")
+        try:
+            db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in paths])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+
+def set_hash(path, st, sha256, merkle_root):
+    """Store a file's content hash, with the stat it was computed against."""
+    with _lock:
+        _db().execute(
+            "UPDATE files SET sha256 = ?, merkle_root = ?, size = ?, mtime_ns = ?, ino = ?, dev = ? WHERE path = ?",
+            (sha256, merkle_root, st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev, path))
+
+
+def file_row(path, share_id, name, st, sha256=None, merkle_root=None):
+    return {
+        "path": path, "share_id": share_id, "name": name,
+        "size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino, "dev": st.st_dev,
+        "sha256": sha256, "merkle_root": merkle_root,
+    }
+
+
+def walk(root):
+    """Yield (path, stat_result) for every regular file under `root`.
+
+    Symlinks are not followed, so a link cycle can't trap the walk, and
+    unreadable directories are skipped.
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield entry.path, entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue  # Vanished or unreadable mid-walk
+        except OSError as e:
+            logger.warning("Skipping unreadable directory %s: %s", directory, e)
+
+
+def scan_changes(share_id, root):
+    """Walk `root` against the index.
+
+    Returns (changed, removed): (path, stat_result) pairs for files that are
+    new or whose size, mtime or inode differ from their row, and the paths
+    of rows whose file is gone. The index itself is not modified.
+    """
+    known = {row["path"]: (row["size"], row["mtime_ns"], row["ino"]) for row in iter_files(share_id)}
+    changed = []
+    for path, st in walk(root):
+        if known.pop(path, None) != (st.st_size, st.st_mtime_ns, st.st_ino):
+            changed.append((path, st))
+    return changed, list(known)
@@ -0,0 +1,401 @@
+# p2p_app/swarm.py
+# Multi-source downloads: fetch chunks of one file from every peer that holds it.
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter, deque
+import requests
+from werkzeug.utils import secure_filename
+from . import bandwidth
+from . import catalog
+from . import config
+from . import downloads
+from . import peer_client
+
+logger = logging.getLogger(__name__)
+
+
+class PeerUnusable(Exception):
+    """The peer answered, but will never serve this file (wrong password, gone, ...)."""
+    pass
+
+
+def find_sources(content_hash):
+    """Return [(address, port, file_meta)] for discovered peers sharing `content_hash`."""
+    sources = [(address, port, meta) for address, port, meta in catalog.find_holders(content_hash)
+               if isinstance(meta.get("size"), int) and meta["size"] >= 0]
+    return sources[:config.SWARM_MAX_PEERS]
+
+
+class SwarmDownload:
+    """Downloads one file in fixed-size chunks from several peers at once.
+
+    Every source runs a few workers that pull the next missing chunk from a
+    shared queue, so faster peers naturally end up serving more chunks. When
+    the queue runs dry, idle workers on faster peers also request chunks still
+    in flight on slower ones and the first copy to arrive wins. Failed chunks
+    go back to the front of the queue for another source to pick up. A peer
+    answering 503 is only busy: its chunk goes back without counting as a
+    failure, and its worker waits out the Retry-After before asking again.
+
+    With a manifest, chunks line up with the manifest's chunks and each one is
+    checked on arrival, so a bad source is caught early. The finished file is
+    still hashed as a whole: the manifest comes from peers rather than from the
+    content hash, and chunks restored from a saved state were never checked.
+    """
+
+    def __init__(self, content_hash, size, name, sources, password="", file_manifest=None):
+        self.id = uuid.uuid4().hex
+        self.content_hash = content_hash
+        self.size = size
+        self.name = secure_filename(name) or content_hash
+        self.password = password
+        self.manifest = file_manifest
+        self.chunk_size = file_manifest["chunk_size"] if file_manifest else config.SWARM_CHUNK_SIZE
+        self.num_chunks = (size + self.chunk_size - 1) // self.chunk_size
+
+        self.part_path = os.path.join(config.DOWNLOAD_DIR, f"{content_hash}.swarm.part")
+        self.state_path = self.part_path + ".json"
+
+        self.done = set()
+        self.pending = deque()
+        self.in_flight = {}  # chunk index -> set of source keys fetching it
+        self.attempts = {}  # chunk index -> failed attempts
+        self.sources = {}
+        for address, port, _meta in sources:
+            self.sources[f"{address}:{port}"] = {
+                "address": address,
+                "port": port,
+                "bytes": 0,
+                "seconds": 0.0,
+                "chunks": 0,
+                "failures": 0,
+                "active": True,
+            }
+
+        self.status = "queued"
+        self.error = None
+        self.path = None
+        self.started_at = None
+        self.finished_at = None
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._file = None
+
+    # --- Scheduling ---
+
+    def _rate(self, key):
+        src = self.sources[key]
+        return src["bytes"] / src["seconds"] if src["seconds"] > 0 else None
+
+    def _next_chunk(self, key):
+        with self._cond:
+            while True:
+                if self._cancelled.is_set() or self.error or len(self.done) == self.num_chunks:
+                    return None
+                if not self.sources[key]["active"]:
+                    return None
+                if self.pending:
+                    chunk = self.pending.popleft()
+                    self.in_flight.setdefault(chunk, set()).add(key)
+                    return chunk
+                chunk = self._endgame_chunk(key)
+                if chunk is not None:
+                    self.in_flight[chunk].add(key)
+                    return chunk
+                if not self.in_flight:
+                    return None
+                self._cond.wait(timeout=1.0)
+
+    def _endgame_chunk(self, key):
+        # Caller holds self._cond
+        my_rate = self._rate(key)
+        if my_rate is None:
+            return None
+        best, best_rate = None, None
+        for chunk, holders in self.in_flight.items():
+            if key in holders or len(holders) > 1:
+                continue
+            holder_rate = min((self._rate(h) or 0.0) for h in holders)
+            if holder_rate < my_rate and (best_rate is None or holder_rate < best_rate):
+                best, best_rate = chunk, holder_rate
+        return best
+
+    def _chunk_done(self, chunk, key, data, elapsed):
+        # Written before it counts as done, so a failed write never leaves a hole
+        # behind a complete-looking download (an endgame duplicate writes the same bytes)
+        with self._write_lock:
+            self._file.seek(chunk * self.chunk_size)
+            self._file.write(data)
+        with self._cond:
+            holders = self.in_flight.get(chunk, set())
+            holders.discard(key)
+            src = self.sources[key]
+            src["bytes"] += len(data)
+            src["seconds"] += elapsed
+            if chunk in self.done:
+                return  # Lost the endgame race; the bytes are identical anyway
+            self.done.add(chunk)
+            self.in_flight.pop(chunk, None)
+            src["chunks"] += 1
+            self._cond.notify_all()
+
+    def _chunk_failed(self, chunk, key, error, retire=False):
+        logger.info("Swarm chunk %s of %s failed from %s: %s", chunk, self.name, key, error)
+        with self._cond:
+            holders = self.in_flight.get(chunk, set())
+            holders.discard(key)
+            if chunk not in self.done and not holders:
+                self.in_flight.pop(chunk, None)
+                self.attempts[chunk] = self.attempts.get(chunk, 0) + 1
+                if self.attempts[chunk] >= config.SWARM_MAX_CHUNK_ATTEMPTS:
+                    self.error = f"Chunk {chunk} failed {self.attempts[chunk]} times"
+                else:
+                    self.pending.appendleft(chunk)
+            src = self.sources[key]
+            src["failures"] += 1
+            if retire or src["failures"] >= config.SWARM_MAX_PEER_FAILURES:
+                src["active"] = False
+            if not any(s["active"] for s in self.sources.values()) and len(self.done) < self.num_chunks:
+                self.error = self.error or "No working sources left"
+            self._cond.notify_all()
+
+    def _chunk_deferred(self, chunk, key):
+        # The peer was busy: give the chunk back without counting it against
+        # either of them, so another source can take it meanwhile
+        with self._cond:
+            holders = self.in_flight.get(chunk, set())
+            holders.discard(key)
+            if chunk not in self.done and not holders:
+                self.in_flight.pop(chunk, None)
+                self.pending.appendleft(chunk)
+            self._cond.notify_all()
+
+    # --- Transfer ---
+
+    def _fetch(self, key, chunk):
+        src = self.sources[key]
+        start = chunk * self.chunk_size
+        end = min(start + self.chunk_size, self.size) - 1
+        url = downloads.peer_download_url(src["address"], src["port"], self.content_hash)
+        headers = {
+            "Range": f"bytes={start}-{end}",
+            # Only accept the range if the peer still has exactly this content
+            "If-Range": f'"sha256-{self.content_hash}"',
+        }
+        slot = bandwidth.download_scheduler.admit(src["address"], end - start + 1, stop_event=self._cancelled)
+        if slot is None:
+            return None  # Cancelled while waiting for a slot
+        session = peer_client.get_session(src["address"], src["port"])
+        with slot, session.post(url, json={"password": self.password}, headers=headers,
+                                stream=True, timeout=(5, 60)) as response:
+            peer_client.raise_if_busy(response)
+            if response.status_code in (403, 404, 410):
+                raise PeerUnusable(f"HTTP {response.status_code}")
+            if response.status_code != 206:
+                raise PeerUnusable(f"Peer did not honour the range request (HTTP {response.status_code})")
+            content_range = downloads.parse_content_range(response.headers.get("Content-Range", ""))
+            if not content_range or content_range[0] != start or content_range[2] != self.size:
+                raise PeerUnusable("Peer answered with an unexpected byte range")
+            pieces = []
+            wire = peer_client.WireMeter(response)
+            for piece in peer_client.iter_body(response, config.DOWNLOAD_CHUNK_SIZE):
+                slot.throttle(wire.advance())
+                pieces.append(piece)
+            data = b"".join(pieces)
+        if len(data) != end - start + 1:
+            raise IOError(f"Short read: got {len(data)} of {end - start + 1} bytes")
+        if self.manifest and hashlib.sha256(data).hexdigest() != self.manifest["chunks"][chunk]:
+            raise PeerUnusable("Chunk failed verification against the manifest")
+        return data
+
+    def _worker(self, key):
+        while True:
+            chunk = self._next_chunk(key)
+            if chunk is None:
+                return
+            started = time.monotonic()
+            try:
+                data = self._fetch(key, chunk)
+            except peer_client.PeerBusy as e:
+                logger.debug("Swarm source %s is busy; retrying in %ss", key, e.retry_after)
+                self._chunk_deferred(chunk, key)
+                if self._cancelled.wait(e.retry_after):
+                    return
+                continue
+            except PeerUnusable as e:
+                self._chunk_failed(chunk, key, e, retire=True)
+                continue
+            except (requests.exceptions.RequestException, IOError) as e:
+                self._chunk_failed(chunk, key, e)
+                continue
+            if data is None:
+                return
+            try:
+                self._chunk_done(chunk, key, data, time.monotonic() - started)
+            except OSError as e:  # Disk full, I/O error: retrying elsewhere won't help
+                with self._cond:
+                    self.in_flight.get(chunk, set()).discard(key)
+                    self.error = self.error or f"Could not write download: {e}"
+                    self._cond.notify_all()
+                return
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if state.get("size") == self.size and state.get("chunk_size") == self.chunk_size and os.path.exists(self.part_path):
+            self.done = set(state.get("done", []))
+
+    def _save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"size": self.size, "chunk_size": self.chunk_size, "done": sorted(self.done)}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _verify(self):
+        digest = hashlib.sha256()
+        with open(self.part_path, "rb") as f:
+            while True:
+                block = f.read(config.HASH_READ_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+        return digest.hexdigest() == self.content_hash
+
+    def run(self):
+        os.makedirs(config.DOWNLOAD_DIR, exist_ok=True)
+        self.status = "running"
+        self.started_at = time.time()
+        self._load_state()
+        self.pending = deque(c for c in range(self.num_chunks) if c not in self.done)
+
+        mode = "r+b" if os.path.exists(self.part_path) else "w+b"
+        try:
+            with open(self.part_path, mode) as f:
+                f.truncate(self.size)
+                self._file = f
+                workers = []
+                for key in self.sources:
+                    for _ in range(config.SWARM_CONNECTIONS_PER_PEER):
+                        t = threading.Thread(target=self._worker, args=(key,), daemon=True)
+                        t.start()
+                        workers.append(t)
+                for t in workers:
+                    t.join()
+                self._file = None
+        except OSError as e:
+            self.error = f"Could not write download: {e}"
+
+        if self._cancelled.is_set():
+            self.status = "cancelled"
+        elif not self.error and len(self.done) < self.num_chunks:
+            self.error = "No working sources left"
+
+        if self.error or self._cancelled.is_set():
+            self._save_state()
+            if self.error:
+                self.status = "failed"
+        elif not self._verify():
+            os.remove(self.part_path)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            self.status = "failed"
+            self.error = "Downloaded data does not match the content hash"
+        else:
+            self.path = downloads.unique_destination(self.name)
+            os.replace(self.part_path, self.path)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            self.status = "completed"
+        self.finished_at = time.time()
+        if self.error:
+            logger.warning("Swarm download of %s %s: %s", self.name, self.status, self.error)
+        else:
+            logger.info("Swarm download of %s %s", self.name, self.status)
+
+    def discard_partial(self):
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def cancel(self):
+        self._cancelled.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    @property
+    def bytes_done(self):
+        done = len(self.done) * self.chunk_size
+        last = self.num_chunks - 1
+        if last in self.done:
+            done -= self.num_chunks * self.chunk_size - self.size
+        return done
+
+    def to_dict(self):
+        with self._cond:
+            sources = [
+                {
+                    "peer": key,
+                    "bytes": src["bytes"],
+                    "chunks": src["chunks"],
+                    "failures": src["failures"],
+                    "active": src["active"],
+                    "rate": self._rate(key),
+                }
+                for key, src in self.sources.items()
+            ]
+            return {
+                "id": self.id,
+                "hash": self.content_hash,
+                "name": self.name,
+                "size": self.size,
+                "status": self.status,
+                "error": self.error,
+                "path": self.path,
+                "bytes_done": self.bytes_done,
+                "chunks_done": len(self.done),
+                "chunks_total": self.num_chunks,
+                "sources": sources,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+
+
+def prepare_swarm_download(content_hash, password="", name=None):
+    """Look up sources for `content_hash` and set up a download from all of them.
+
+    Returns a SwarmDownload ready to run(), or None if no discovered peer
+    shares that content.
+    """
+    sources = find_sources(content_hash)
+    if not sources:
+        return None
+    meta = sources[0][2]
+    sources = [src for src in sources if src[2].get("size") == meta["size"]]
+
+    # Use the manifest most sources agree on and drop sources advertising a
+    # different one; a peer without a manifest still has its chunks checked.
+    roots = Counter(src[2].get("merkle_root") for src in sources if src[2].get("merkle_root"))
+    file_manifest = None
+    for root, _count in roots.most_common():
+        for address, port, src_meta in sources:
+            if src_meta.get("merkle_root") != root:
+                continue
+            candidate = downloads.fetch_manifest(address, port, content_hash, expected_root=root)
+            if candidate and candidate["hash"] == content_hash and candidate["size"] == meta["size"]:
+                file_manifest = candidate
+                break
+        if file_manifest:
+            sources = [src for src in sources if src[2].get("merkle_root") in (None, root)]
+            break
+
+    name = name or (meta.get("name") if isinstance(meta.get("name"), str) else None) or content_hash
+    return SwarmDownload(content_hash, meta["size"], name, sources, password, file_manifest)
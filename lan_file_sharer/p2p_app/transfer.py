@@ -0,0 +1,205 @@
+# p2p_app/transfer.py
+# HTTP Range / If-Range handling for serving shared files to peers.
+import mimetypes
+import os
+import urllib.parse
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+
+READ_CHUNK_SIZE = 64 * 1024
+MAX_RANGES = 32  # More ranges than this in one request is treated as a plain full request
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when a Range header is valid but none of its ranges fit the file."""
+    def __init__(self, size=None, headers=None):
+        super().__init__("Requested range not satisfiable")
+        self.size = size
+        self.headers = headers or {}
+
+
+def file_etag(filepath, stat_result=None):
+    # Strong validator that stays stable as long as the file is not modified.
+    st = stat_result or os.stat(filepath)
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def guess_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def content_disposition(filename):
+    try:
+        filename.encode("ascii")
+        escaped = filename.replace("\\", "\\\\").replace('"', '\\"')
+        return f'attachment; filename="{escaped}"'
+    except UnicodeEncodeError:
+        quoted = urllib.parse.quote(filename, safe="")
+        return f"attachment; filename*=UTF-8''{quoted}"
+
+
+def parse_range_header(header, size):
+    """Parse a 'bytes=' Range header against a resource of `size` bytes.
+
+    Returns a list of inclusive (start, end) tuples, or None if the header is
+    absent, malformed or should be ignored (the caller then sends the full
+    body). Raises RangeNotSatisfiable if no requested range overlaps the file.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if not sep:
+            return None
+        first, last = first.strip(), last.strip()
+        try:
+            if first == "":  # Suffix range: last N bytes
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start, end = max(size - suffix, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and end < start:
+                    return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        if start < 0:
+            return None
+        if start < size and start <= end:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    if not ranges:
+        raise RangeNotSatisfiable()
+    return coalesce_ranges(ranges)
+
+
+def coalesce_ranges(ranges):
+    # Merge overlapping or adjacent ranges so a client cannot make us send the
+    # same bytes many times over in one multipart response.
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(if_range, etag, last_modified):
+    """Evaluate an If-Range precondition. Absent header counts as a match."""
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # Weak validators never match for If-Range (RFC 9110, 13.1.5).
+        return not if_range.startswith("W/") and if_range == etag
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) == int(last_modified)
+    except (TypeError, ValueError):
+        return False
+
+
+def iter_file_range(filepath, start, length, chunk_size=READ_CHUNK_SIZE):
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def multipart_byteranges(ranges, size, content_type):
+    """Return (boundary, segments, total_length) for a multipart/byteranges body."""
+    boundary = uuid.uuid4().hex
+    segments = []
+    total = 0
+    for start, end in ranges:
+        header = (
+            f"\r\n--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode("ascii")
+        segments.append(header)
+        segments.append((start, end - start + 1))
+        total += len(header) + (end - start + 1)
+    closing = f"\r\n--{boundary}--\r\n".encode("ascii")
+    segments.append(closing)
+    total += len(closing)
+    return boundary, segments, total
+
+
+def iter_segments(filepath, segments, chunk_size=READ_CHUNK_SIZE):
+    """Yield a response body described by plan_file_segments()."""
+    for segment in segments:
+        if isinstance(segment, bytes):
+            yield segment
+        else:
+            start, length = segment
+            yield from iter_file_range(filepath, start, length, chunk_size)
+
+
+def plan_file_segments(filepath, range_header, if_range, content_type, etag=None):
+    """Work out status, headers and body layout for serving `filepath` to a peer.
+
+    `etag` overrides the stat-based validator (e.g. one derived from the
+    content hash, which is the same on every peer holding the file).
+
+    Returns (status, headers, segments) where each segment is either literal
+    bytes or a (file_offset, length) span to copy from the file, so callers
+    can stream spans however they like (read loop, sendfile, ...). Raises
+    RangeNotSatisfiable carrying the file size and validator headers for 416
+    replies.
+    """
+    st = os.stat(filepath)
+    size = st.st_size
+    etag = etag or file_etag(filepath, st)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": http_date(st.st_mtime),
+    }
+
+    ranges = None
+    if range_header and if_range_matches(if_range, etag, st.st_mtime):
+        try:
+            ranges = parse_range_header(range_header, size)
+        except RangeNotSatisfiable:
+            raise RangeNotSatisfiable(size, headers)
+
+    if not ranges:
+        headers["Content-Type"] = content_type
+        headers["Content-Length"] = str(size)
+        return 200, headers, [(0, size)]
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Type"] = content_type
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return 206, headers, [(start, end - start + 1)]
+
+    boundary, segments, total = multipart_byteranges(ranges, size, content_type)
+    headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    headers["Content-Length"] = str(total)
+    return 206, headers, segments
+
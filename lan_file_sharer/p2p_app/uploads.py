@@ -0,0 +1,269 @@
+# p2p_app/uploads.py
+# Chunked, resumable uploads from the browser into the blob store.
+#
+# A client creates a session with the file's name and size, PUTs chunks at
+# any offsets (several at once if it likes), asks which ranges have arrived
+# after a disconnect, and finalizes once everything is there. Chunks are
+# written in place into a preallocated file, and the contiguous prefix is
+# hashed as it grows, so finalizing rarely has much left to read. Bytes that
+# have already arrived are never written again: a chunk resent after a
+# dropped connection only fills in what is still missing, so the hashed
+# prefix always matches the file.
+#
+# A client-chosen `key` (e.g. name, size and modification time) finds an
+# unfinished session again, even after the page has been reloaded. Sessions
+# live in memory and are dropped after UPLOAD_SESSION_TIMEOUT without chunks.
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from . import blobstore
+from . import config
+from . import hashing
+from . import transfer
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """A request the session can't accept; `status` is the HTTP status to answer with."""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _overlaps(a, b):
+    return a[0] <= b[1] and b[0] <= a[1]
+
+
+def _uncovered(ranges, start, end):
+    """The parts of [start, end] not in `ranges` (coalesced, inclusive), in order."""
+    gaps = []
+    position = start
+    for low, high in ranges:
+        if high < position:
+            continue
+        if low > end:
+            break
+        if low > position:
+            gaps.append((position, low - 1))
+        position = max(position, high + 1)
+    if position <= end:
+        gaps.append((position, end))
+    return gaps
+
+
+class UploadSession:
+    def __init__(self, name, size, key=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.size = size
+        self.key = key
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.received = []  # Inclusive (start, end) byte ranges, coalesced
+        self.temp_path = blobstore.new_temp_path()
+        self._fd = os.open(self.temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self._fd, size)
+        self._lock = threading.Lock()  # received, updated_at, _writing, _closing
+        self._writers_done = threading.Condition(self._lock)
+        self._writing = []  # Inclusive ranges of the write_chunk calls using the file descriptor
+        self._closing = False  # Set once finish() or discard() starts; no new writers
+        self._hash_lock = threading.Lock()  # hasher, hashed, closing the file
+        self._hasher = hashing.StreamHasher()
+        self._hashed = 0  # Bytes of the contiguous prefix fed to the hasher
+        self.closed = False
+
+    @property
+    def bytes_received(self):
+        return sum(end - start + 1 for start, end in self.received)
+
+    def _contiguous_end(self):
+        # Caller holds _lock
+        if self.received and self.received[0][0] == 0:
+            return self.received[0][1] + 1
+        return 0
+
+    def is_complete(self):
+        with self._lock:
+            return self._contiguous_end() == self.size
+
+    def write_chunk(self, start, length, stream):
+        """Write `length` bytes read from `stream` at offset `start`."""
+        if start < 0 or length <= 0 or start + length > self.size:
+            raise UploadError(f"Chunk {start}+{length} lies outside the file ({self.size} bytes)", 416)
+        if length > config.UPLOAD_MAX_CHUNK_SIZE:
+            raise UploadError(f"Chunks may be at most {config.UPLOAD_MAX_CHUNK_SIZE} bytes", 413)
+        claim = (start, start + length - 1)
+        with self._lock:
+            if self._closing:
+                raise UploadError("Upload is already finished or cancelled", 410)
+            if any(_overlaps(claim, other) for other in self._writing):
+                raise UploadError("Another request is still writing part of this chunk", 503)
+            self._writing.append(claim)
+            # Only received changes after this, and never inside the claim
+            missing = _uncovered(self.received, *claim)
+        offset = start
+        end = start + length
+        try:
+            while offset < end:
+                block = stream.read(min(config.HASH_READ_SIZE, end - offset))
+                if not block:
+                    # Keep what arrived: a resumed upload only resends the rest
+                    break
+                block_end = offset + len(block) - 1
+                for gap_start, gap_end in missing:
+                    if gap_start <= block_end and gap_end >= offset:
+                        low = max(gap_start, offset)
+                        high = min(gap_end, block_end)
+                        os.pwrite(self._fd, block[low - offset:high - offset + 1], low)
+                offset += len(block)
+        finally:
+            with self._lock:
+                self._writing.remove(claim)
+                self._writers_done.notify_all()
+        with self._lock:
+            if offset > start:
+                self.received = transfer.coalesce_ranges(self.received + [(start, offset - 1)])
+            self.updated_at = time.time()
+        if offset < end:
+            raise UploadError(f"Chunk ended after {offset - start} of {length} bytes", 400)
+        self._advance_hash(wait=False)
+
+    def _advance_hash(self, wait):
+        # Hash whatever the contiguous prefix gained; the data was just
+        # written, so it comes from the page cache. Without `wait`, a thread
+        # that finds another one hashing leaves the work to it (or to finalize).
+        if not self._hash_lock.acquire(blocking=wait):
+            return
+        try:
+            while not self.closed:
+                with self._lock:
+                    target = self._contiguous_end()
+                if self._hashed >= target:
+                    return
+                block = os.pread(self._fd, min(config.HASH_READ_SIZE, target - self._hashed), self._hashed)
+                if not block:
+                    return
+                self._hasher.update(block)
+                self._hashed += len(block)
+        finally:
+            self._hash_lock.release()
+
+    def _stop_writers(self):
+        # The descriptor may only be closed once no write_chunk can use it:
+        # its number could be reused by another file before a late pwrite
+        with self._lock:
+            self._closing = True
+            while self._writing:
+                self._writers_done.wait()
+
+    def finish(self):
+        """Hash any remaining data and move the file into the blob store. Returns (path, content hash)."""
+        if not self.is_complete():
+            raise UploadError("Upload is missing data", 409)
+        self._stop_writers()
+        self._advance_hash(wait=True)
+        with self._hash_lock:
+            if self.closed:
+                raise UploadError("Upload is already finished or cancelled", 409)
+            os.close(self._fd)
+            self.closed = True
+            entry = self._hasher.finish()
+        return blobstore.commit_file(self.temp_path, entry), entry["sha256"]
+
+    def discard(self):
+        self._stop_writers()
+        with self._hash_lock:
+            if not self.closed:
+                self.closed = True
+                os.close(self._fd)
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "name": self.name,
+                "size": self.size,
+                "key": self.key,
+                "chunk_size": config.UPLOAD_CHUNK_SIZE,
+                "received": [[start, end] for start, end in self.received],
+                "bytes_received": self.bytes_received,
+                "created_at": self.created_at,
+                "updated_at": self.updated_at,
+            }
+
+
+_sessions = {}  # id -> UploadSession
+_sessions_lock = threading.Lock()
+
+
+def _expire_sessions():
+    cutoff = time.time() - config.UPLOAD_SESSION_TIMEOUT
+    with _sessions_lock:
+        expired = [s for s in _sessions.values() if s.updated_at < cutoff]
+        for session in expired:
+            del _sessions[session.id]
+    for session in expired:
+        logger.info("Dropping abandoned upload of %s (%s of %s bytes)", session.name, session.bytes_received, session.size)
+        session.discard()
+
+
+def create_session(name, size, key=None):
+    """Start an upload, or return the unfinished one with the same `key`.
+
+    Returns (session, created).
+    """
+    _expire_sessions()
+    with _sessions_lock:
+        if key:
+            for session in _sessions.values():
+                if session.key == key and session.size == size:
+                    return session, False
+        if len(_sessions) >= config.UPLOAD_MAX_SESSIONS:
+            raise UploadError("Too many uploads in progress", 503)
+        reserved = sum(s.size - s.bytes_received for s in _sessions.values())
+        os.makedirs(config.BLOB_TEMP_DIR, exist_ok=True)
+        if shutil.disk_usage(config.BLOB_TEMP_DIR).free - reserved < size:
+            raise UploadError("Not enough disk space for this upload", 507)
+        session = UploadSession(name, size, key)
+        _sessions[session.id] = session
+    return session, True
+
+
+def get_session(upload_id):
+    with _sessions_lock:
+        return _sessions.get(upload_id)
+
+
+def list_sessions():
+    _expire_sessions()
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+    return [session.to_dict() for session in sessions]
+
+
+def finish_session(upload_id):
+    """Complete an upload. Returns (blob path, content hash); the caller owns the blob reference."""
+    session = get_session(upload_id)
+    if session is None:
+        raise UploadError("Upload not found", 404)
+    path, content_hash = session.finish()
+    with _sessions_lock:
+        _sessions.pop(upload_id, None)
+    return path, content_hash
+
+
+def cancel_session(upload_id):
+    with _sessions_lock:
+        session = _sessions.pop(upload_id, None)
+    if session is None:
+        return False
+    session.discard()
+    return True